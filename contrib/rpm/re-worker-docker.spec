@@ -19,7 +19,7 @@ Url: https://github.com/rhinception/re-worker-docker
 
 BuildArch: noarch
 BuildRequires: python2-devel, python-setuptools
-Requires: re-worker, python-docker-py
+Requires: re-worker, python-docker-py >= 1.7, python-monotonic
 
 %description
 A basic Docker worker for Winternewt which allows for specific docker
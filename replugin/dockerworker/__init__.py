@@ -17,11 +17,55 @@
 Docker worker.
 """
 
-import docker
-import requests.exceptions
+import codecs
+import itertools
+import json
+import os
+import re
+import signal
+import socket
+import sys
+import threading
+
+import pika
 
 from reworker.worker import Worker
 
+from replugin.dockerworker import encoding, timing, tracing, watchdog
+from replugin.dockerworker.adaptive import AdaptiveConcurrency
+from replugin.dockerworker.archives import (
+    archive_name, file_digest, read_archive, read_checksum, write_archive)
+from replugin.dockerworker.cache import ResultCache
+from replugin.dockerworker.images import registry_host, split_reference
+from replugin.dockerworker.journal import Journal, RUNNING
+from replugin.dockerworker.profiles import compile_profiles
+from replugin.dockerworker.progress import (
+    iter_events, pull_summary, stream_error)
+from replugin.dockerworker.publisher import Publisher
+from replugin.dockerworker.ratelimit import RegistryLimiter
+from replugin.dockerworker.scheduler import LaneScheduler, run_parallel
+from replugin.dockerworker.startup import LazyModule, seconds_since_launch
+from replugin.dockerworker.streams import (
+    STREAM_NAMES, iter_chunks, iter_frames, iter_read)
+from replugin.dockerworker.supervisor import Supervisor, parse_processes
+from replugin.dockerworker.tarstream import Archive
+from replugin.dockerworker.validation import (
+    ValidationError, check_requirements, compile_schemas)
+from replugin.dockerworker.watchdog import Watchdog
+
+# docker-py and requests are slow to import and only needed once a
+# subcommand runs, so they are imported on first use.
+docker = LazyModule('docker')
+requests = LazyModule('requests')
+
+
+#: Seconds between checks for drain and reload requests
+HOUSEKEEPING_INTERVAL = 0.5
+
+#: Subcommands an interrupted run of is reconciled and resumed after a
+#: restart. Others get a failed reply since their outcome is unknown.
+RESUMABLE = ('PullImage', 'CreateContainer', 'StartContainer')
+
 
 class DockerWorkerError(Exception):
     """
@@ -30,6 +74,17 @@ class DockerWorkerError(Exception):
     pass
 
 
+class _NullOutput(object):
+    """
+    Output for the per replica operations of a scale; failures are
+    reported once for the whole scale instead.
+    """
+
+    @staticmethod
+    def error(msg):
+        pass
+
+
 class DockerWorker(Worker):
     """
     Worker which provides basic functionality for Docker.
@@ -43,41 +98,181 @@ class DockerWorker(Worker):
         'PullImage',
         'CreateContainer',
         'StartContainer',
+        'ScaleContainers',
+        'ExecInContainer',
+        'CopyToContainer',
+        'BuildImage',
+        'ExportImage',
+        'ImportImage',
     )
     dynamic = []
 
-    # Duplication
-    #
-    # This line (and friends) is duplicated in several places:
-    #
-    # > client = docker.Client(base_url=server_name, version=self._config['version'])
-    #
-    # I would have centralized creating the client into a separate
-    # private method.
-    #
-    # def _create_client(self, params):
-    #     server_name = ......; container_name = ......;
-    #     try:
-    #         client = docker.Client(..,..,..)
-    #         return client
-    #     except requests.exceptions.ConnectionError, ce:
-    #         do_the_needful
-    #
-    #
-    # And then down in process()...
-    #
-    # client = self._create_client(params)
-    # result = cmd_method(client, body, corr_id, output)
-    #
-    # This could also remove the need for a lot of the duplicated
-    # 'except requests.exceptions.ConnectionError' statements in each
-    # subcommand. That is assuming that creating the Client object is
-    # enough to trigger that exception. It's possible that requests
-    # isn't used until an actual client command is tried.
-    #
-    # ----------------------------------------------------------------------
-    #
-    # Similar to above, looks like you're duplicating this as well:
+    #: install SIGTERM (drain) and SIGHUP (reload) handlers on start
+    handle_signals = False
+
+    #: index of this process under --processes, None when running alone
+    process_index = None
+
+    def __init__(self, *args, **kwargs):
+        Worker.__init__(self, *args, **kwargs)
+        self._config_file = kwargs.get(
+            'config_file', args[1] if len(args) > 1 else None)
+        self._draining = False
+        self._drain_requested = False
+        self._reload_requested = False
+        self._channel_for_drain = None
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        self._first_message = True
+        # The message each thread is executing, for progress replies
+        self._replying = threading.local()
+        # Message bodies already decoded by _process, for process()
+        self._decoded = threading.local()
+
+        # Parameter schemas are compiled once and checked before a
+        # message is scheduled or a client is built.
+        self.validators = compile_schemas()
+        # Named container profiles are validated and compiled once too
+        self.profiles = compile_profiles(self._config.get('profiles'))
+
+        # Replies keyed by correlation id so redelivered messages are
+        # answered without touching the Docker host again.
+        self.replay_cache = None
+        replay_conf = self._config.get('replay_cache')
+        if replay_conf:
+            self.replay_cache = ResultCache(
+                size=replay_conf.get('size', 1024),
+                ttl=replay_conf.get('ttl', 3600),
+                path=replay_conf.get('path'),
+                flush_interval=replay_conf.get('flush_interval', 5.0),
+                logger=self.app_logger)
+
+        # Container IDs learned per host so later operations address
+        # containers by ID instead of having the daemon resolve names.
+        self.container_ids = ResultCache(
+            size=self._config.get('id_cache_size', 4096),
+            ttl=self._config.get('id_cache_ttl', 3600))
+
+        # Tag to digest resolutions shared by every host when digest
+        # pinning is enabled.
+        self.digests = None
+        # Tags whose digest a pull is resolving, by image name
+        self._resolving = {}
+        self._resolving_lock = threading.Lock()
+        pinning_conf = self._config.get('digest_pinning')
+        if pinning_conf:
+            if not isinstance(pinning_conf, dict):
+                pinning_conf = {}
+            self.digests = ResultCache(
+                size=pinning_conf.get('size', 1024),
+                ttl=pinning_conf.get('ttl', 600))
+
+        # Pulls from each registry are throttled across every host when
+        # registry_limits is configured.
+        self.registry_limits = None
+        if self._config.get('registry_limits'):
+            self.registry_limits = RegistryLimiter(
+                self._config['registry_limits'])
+
+        # Build context digest and image ID of the last build of each
+        # tag per host, so unchanged contexts are not sent again.
+        self.builds = ResultCache(
+            size=self._config.get('build_cache_size', 256),
+            ttl=self._config.get('build_cache_ttl', 86400))
+
+        # Per host caps follow the latency and failures of each daemon
+        # in adaptive mode.
+        self.adaptive = None
+        adaptive_conf = self._config.get('adaptive_concurrency')
+        if adaptive_conf:
+            if not isinstance(adaptive_conf, dict):
+                adaptive_conf = {}
+            adaptive_conf = dict(adaptive_conf)
+            adaptive_conf.setdefault(
+                'initial', self._config.get('host_concurrency') or 4)
+            self.adaptive = AdaptiveConcurrency(
+                logger=self.app_logger, **adaptive_conf)
+
+        # Subcommands run on lane threads when lanes or per host caps
+        # are configured. The watchdog needs them too: a subcommand run
+        # on the I/O thread would hold up the replies the watchdog sends
+        # through it until the stuck call returns.
+        self.scheduler = None
+        lanes = self._config.get('lanes')
+        host_limit = self._config.get('host_concurrency')
+        if (lanes or host_limit or self.adaptive is not None or
+                self._config.get('watchdog')):
+            if not lanes:
+                lanes = {'default': {
+                    'concurrency': self._config.get(
+                        'scheduler_threads', 16)}}
+            self.scheduler = LaneScheduler(
+                lanes,
+                host_limit=host_limit,
+                host_overrides=self._config.get(
+                    'host_concurrency_overrides'),
+                adaptive=self.adaptive)
+
+        # Running subcommands are checked against per subcommand
+        # deadlines when the watchdog is configured.
+        self.watchdog = None
+        watchdog_conf = self._config.get('watchdog')
+        if watchdog_conf:
+            self.watchdog = Watchdog(
+                deadlines=watchdog_conf.get('deadlines'),
+                default=watchdog_conf.get('default'),
+                cancel=watchdog_conf.get('cancel', False),
+                interval=watchdog_conf.get('interval', 1.0),
+                on_overrun=self._on_overrun,
+                on_cancel=self._on_cancel,
+                logger=self.app_logger)
+
+        # Publishes and acks are queued and run in batches on the I/O
+        # loop when the publisher section is configured. Lane and
+        # watchdog threads always hand them to the I/O loop since the
+        # connection is not thread safe.
+        self.publisher = None
+        publisher_conf = self._config.get('publisher')
+        self._batch_publishes = bool(publisher_conf)
+        if (publisher_conf or self.scheduler is not None or
+                self.watchdog is not None):
+            if not isinstance(publisher_conf, dict):
+                publisher_conf = {}
+            self.publisher = Publisher(
+                flush_interval=publisher_conf.get('flush_interval', 0.05),
+                confirms=publisher_conf.get('confirms', False),
+                max_retries=publisher_conf.get('max_retries', 5),
+                logger=self.app_logger)
+        self._io_connection = None
+        self._io_thread = None
+        self._reply_channel = None
+
+        #: subcommands which skip the started reply and success notify
+        self.quiet_subcommands = frozenset(
+            self._config.get('quiet_subcommands', []))
+
+        # Spans per message, subcommand and Docker API call are exported
+        # when tracing is configured.
+        self.tracer = tracing.from_config(
+            self._config.get('tracing'), self.app_logger)
+
+        # Operations acked up front are journaled so the ones a crash
+        # interrupts are resumed when the worker comes back. Under
+        # --processes every process keeps its own journal, suffixed with
+        # its index, and only resumes its own operations.
+        self.journal = None
+        self._recovered = False
+        journal_conf = self._config.get('journal')
+        if journal_conf:
+            journal_path = journal_conf['path']
+            if self.process_index is not None:
+                journal_path = '%s.%d' % (journal_path, self.process_index)
+            self.journal = Journal(
+                journal_path,
+                fsync=journal_conf.get('fsync', False),
+                compact_after=journal_conf.get('compact_after', 1000))
+
+    # Looks like you're duplicating this:
     #
     # > params = body.get('parameters', {})
     #
@@ -94,6 +289,129 @@ class DockerWorker(Worker):
 
     ##################################################################
 
+    def _create_client(self, server_name):
+        """
+        Builds a Docker client for server_name whose API calls are timed.
+
+        Parameters:
+
+        * server_name: The Docker host to connect to
+        """
+        kwargs = {}
+        operation = watchdog.current()
+        abortable = (
+            operation is not None and operation.deadline is not None and
+            self.watchdog.cancel)
+        if abortable:
+            # Calls stuck past the deadline give up instead of pinning
+            # the thread after the operation was cancelled
+            kwargs['timeout'] = max(1, int(operation.deadline))
+        with timing.phase('client'):
+            client = docker.Client(
+                base_url=server_name, version=self._config['version'],
+                **kwargs)
+        if abortable:
+            # Streaming calls such as pull are made without a timeout,
+            # so the watchdog shuts their socket down instead
+            client.hooks['response'].append(
+                self._abort_streams(client, operation))
+        return timing.TimedClient(client, self._observer(server_name))
+
+    def _abort_streams(self, client, operation):
+        """
+        Returns a requests response hook registering every streamed
+        response of client with operation, so cancelling the operation
+        shuts the socket down and the blocked read returns.
+
+        Parameters:
+
+        * client: The docker-py Client
+        * operation: The watched Operation using the client
+        """
+        def hook(response, **kwargs):
+            if kwargs.get('stream'):
+                operation.on_abort(lambda: client._get_raw_response_socket(
+                    response).shutdown(socket.SHUT_RDWR))
+        return hook
+
+    def _observer(self, server_name):
+        """
+        Returns the callable which feeds the Docker API calls made to
+        server_name to adaptive concurrency and tracing, or None.
+        """
+        if self.adaptive is None and self.tracer is None:
+            return None
+        adaptive = self.adaptive
+
+        def observe(method, seconds, error):
+            if adaptive is not None:
+                adaptive.observe(server_name, method, seconds, error)
+            tracing.record(
+                'docker.%s' % method, seconds, error, server_name=server_name)
+        return observe
+
+    def _container_ref(self, server_name, container_name):
+        """
+        Returns the cached ID of a container on a host, falling back to
+        the name given.
+        """
+        return self.container_ids.get(
+            (server_name, container_name)) or container_name
+
+    def _on_container(self, server_name, container_name, func):
+        """
+        Calls func with the cached ID of a container, or its name. A
+        cached ID can go stale when another worker recreates the
+        container under the same name; on a 404 the ID is dropped and
+        func is called once more with the name.
+
+        Parameters:
+
+        * server_name: The Docker host of the container
+        * container_name: The name of the container
+        * func: Callable given the container ID or name
+        """
+        ref = self._container_ref(server_name, container_name)
+        try:
+            return func(ref)
+        except docker.errors.APIError, ae:
+            response = getattr(ae, 'response', None)
+            if (ref == container_name or
+                    getattr(response, 'status_code', None) != 404):
+                raise
+            self._forget_container(dict(
+                server_name=server_name, container_name=container_name))
+            return func(container_name)
+
+    def _pinned(self, image_name):
+        """
+        Returns repository@digest when digest pinning knows the digest
+        for a tagged image_name, otherwise image_name unchanged.
+        """
+        if self.digests is None:
+            return image_name
+        digest = self.digests.get(image_name)
+        if digest is None:
+            return image_name
+        return '%s@%s' % (split_reference(image_name)[0], digest)
+
+    def _forget_container(self, params):
+        """
+        Drops a possibly stale cached container ID.
+        """
+        self.container_ids.discard(
+            (params.get('server_name'), params.get('container_name')))
+
+    def _container_result(self, server_name, container_name):
+        """
+        Returns the structured result for a container operation.
+        """
+        return {
+            'container_name': container_name,
+            'container_id': self.container_ids.get(
+                (server_name, container_name)),
+        }
+
     # Subcommand methods
     def stop_container(self, body, corr_id, output):
         """
@@ -111,8 +429,11 @@ class DockerWorker(Worker):
         try:
             server_name = params['server_name']
             container_name = params['container_name']
-            client = docker.Client(base_url=server_name, version=self._config['version'])
-            client.stop(container_name, timeout=10)
+            client = self._create_client(server_name)
+            self._on_container(
+                server_name, container_name,
+                lambda ref: client.stop(ref, timeout=10))
+            return self._container_result(server_name, container_name)
 
         except KeyError, ke:
             print ke
@@ -121,6 +442,7 @@ class DockerWorker(Worker):
                     params.get('container_name', 'IMAGE_NOT_GIVEN'), ke))
             raise DockerWorkerError('Missing input %s' % ke)
         except docker.errors.APIError, ae:
+            self._forget_container(params)
             self.app_logger.warn(
                 'Unable to stop %s. Error: %s' % (
                     params.get('container_name', 'Unknown'), ae))
@@ -149,8 +471,12 @@ class DockerWorker(Worker):
         try:
             server_name = params['server_name']
             container_name = params['container_name']
-            client = docker.Client(base_url=server_name, version=self._config['version'])
-            client.remove_container(container_name)
+            client = self._create_client(server_name)
+            result = self._container_result(server_name, container_name)
+            self._on_container(
+                server_name, container_name, client.remove_container)
+            self._forget_container(params)
+            return result
 
         except KeyError, ke:
             print ke
@@ -159,6 +485,7 @@ class DockerWorker(Worker):
                     params.get('container_name', 'IMAGE_NOT_GIVEN'), ke))
             raise DockerWorkerError('Missing input %s' % ke)
         except docker.errors.APIError, ae:
+            self._forget_container(params)
             self.app_logger.warn(
                 'Unable to remove %s. Error: %s' % (
                     params.get('container_name', 'Unknown'), ae))
@@ -187,8 +514,9 @@ class DockerWorker(Worker):
         try:
             server_name = params['server_name']
             image_name = params['image_name']
-            client = docker.Client(base_url=server_name, version=self._config['version'])
+            client = self._create_client(server_name)
             client.remove_image(image_name)
+            return {'image_name': image_name}
 
         except KeyError, ke:
             print ke
@@ -225,9 +553,40 @@ class DockerWorker(Worker):
         try:
             server_name = params['server_name']
             image_name = params['image_name']
-            registry = params['insecure_registry']
-            client = docker.Client(base_url=server_name, version=self._config['version'])
-            client.pull(image_name, insecure_registry=registry)
+            registry = params.get('insecure_registry', False)
+            client = self._create_client(server_name)
+            reference, resolving = self._resolve_pin(image_name)
+            try:
+                if split_reference(reference)[2]:
+                    # Pinned by digest: an exact match means nothing to
+                    # pull
+                    try:
+                        image = client.inspect_image(reference)
+                        return {
+                            'image_name': image_name,
+                            'image_id': image.get('Id'),
+                            'digest': split_reference(reference)[2],
+                        }
+                    except docker.errors.APIError:
+                        pass
+                digest, error = self._pull(client, reference, registry)
+                if error:
+                    self.app_logger.warn(
+                        'Unable to pull %s. Error: %s' % (reference, error))
+                    raise DockerWorkerError('Pull failed: %s' % error)
+                if (self.digests is not None and digest and
+                        split_reference(image_name)[1]):
+                    # Later pulls of this tag on any host use the digest
+                    self.digests.set(image_name, digest)
+            finally:
+                if resolving is not None:
+                    self._resolved(image_name, resolving)
+            image = client.inspect_image(reference)
+            return {
+                'image_name': image_name,
+                'image_id': image.get('Id'),
+                'digest': digest or split_reference(reference)[2],
+            }
 
         except KeyError, ke:
             print ke
@@ -255,6 +614,51 @@ class DockerWorker(Worker):
             raise DockerWorkerError(
                 'Pull error due to registry check secure/insecure.')
 
+    def _resolve_pin(self, image_name):
+        """
+        Returns (reference, event) for pulling image_name. When digest
+        pinning does not know the digest of the tag yet, only the first
+        of concurrent pulls, such as a fan-out across hosts, resolves
+        it by pulling the tag and gets the event to set once done. The
+        others wait for it and pull by digest.
+        """
+        reference = self._pinned(image_name)
+        if (self.digests is None or reference != image_name or
+                not split_reference(image_name)[1]):
+            return reference, None
+        with self._resolving_lock:
+            event = self._resolving.get(image_name)
+            if event is None:
+                event = self._resolving[image_name] = threading.Event()
+                return reference, event
+        with timing.phase('resolving'):
+            event.wait(self._config.get('digest_resolve_timeout', 300))
+        return self._pinned(image_name), None
+
+    def _resolved(self, image_name, event):
+        """
+        Ends the digest resolution of image_name, releasing the pulls
+        waiting for it.
+        """
+        with self._resolving_lock:
+            if self._resolving.get(image_name) is event:
+                del self._resolving[image_name]
+        event.set()
+
+    def _pull(self, client, reference, insecure_registry):
+        """
+        Pulls reference, waiting for a slot when its registry is
+        throttled. Returns (digest, error) from the pull output. The
+        output is streamed so a watchdog can abort a hung pull.
+        """
+        if self.registry_limits is None:
+            return pull_summary(client.pull(
+                reference, stream=True, insecure_registry=insecure_registry))
+        with self.registry_limits.slot(registry_host(reference)):
+            # Consume the whole stream while holding the slot
+            return pull_summary(client.pull(
+                reference, stream=True, insecure_registry=insecure_registry))
+
     def create_container(self, body, corr_id, output):
         """
         Create a single container.
@@ -273,10 +677,20 @@ class DockerWorker(Worker):
             image_name = params['image_name']
             container_name = params['container_name']
             container_command = params['container_command']
-            container_hostname = params.get('container_hostname', {})
-            container_ports = params.get('container_ports', {})
-            client = docker.Client(base_url=server_name, version=self._config['version'])
-            client.create_container(image_name, name=container_name, command=container_command, hostname=container_hostname, ports=[container_ports])
+            container_hostname = params.get('container_hostname')
+            container_ports = params.get('container_ports')
+            if container_ports is not None and not isinstance(
+                    container_ports, (list, tuple)):
+                container_ports = [container_ports]
+            client = self._create_client(server_name)
+            container = client.create_container(self._pinned(image_name), name=container_name, command=container_command, hostname=container_hostname, ports=container_ports)
+            self.container_ids.set(
+                (server_name, container_name), container.get('Id'))
+            return {
+                'container_name': container_name,
+                'container_id': container.get('Id'),
+                'warnings': container.get('Warnings'),
+            }
 
         except KeyError, ke:
             print ke
@@ -313,10 +727,14 @@ class DockerWorker(Worker):
         try:
             server_name = params['server_name']
             container_name = params['container_name']
-            container_binds = params.get('container_binds', {})
-            port_bindings = params.get('port_bindings', {})
-            client = docker.Client(base_url=server_name, version=self._config['version'])
-            client.start(container_name, binds=container_binds, port_bindings=port_bindings)
+            container_binds = params.get('container_binds')
+            port_bindings = params.get('port_bindings')
+            client = self._create_client(server_name)
+            self._on_container(
+                server_name, container_name,
+                lambda ref: client.start(
+                    ref, binds=container_binds, port_bindings=port_bindings))
+            return self._container_result(server_name, container_name)
         except KeyError, ke:
             print ke
             output.error(
@@ -324,6 +742,7 @@ class DockerWorker(Worker):
                     params.get('container_name', 'IMAGE_NOT_GIVEN'), ke))
             raise DockerWorkerError('Missing input %s' % ke)
         except docker.errors.APIError, ae:
+            self._forget_container(params)
             self.app_logger.warn(
                 'Unable to start %s. Error: %s' % (
                     params.get('container_name', 'Unknown'), ae))
@@ -336,92 +755,1569 @@ class DockerWorker(Worker):
             raise DockerWorkerError(
                 'Could not connect to the requested Docker Host')
 
-    def process(self, channel, basic_deliver, properties, body, output):
+    def scale_containers(self, body, corr_id, output):
         """
-        Processes DockerWorker requests from the bus.
+        Brings the replicas of a container on a host to a count.
+        Missing replicas are created and started, stopped ones started
+        and extras stopped and removed, in parallel within the host cap.
 
-        *Keys Requires*:
-            * subcommand: the subcommand to execute.
+        Parameters:
+
+        * body: The message body structure
+        * corr_id: The correlation id of the message
+        * output: The output object back to the user
         """
-        # Ack the original message
-        self.ack(basic_deliver)
-        corr_id = str(properties.correlation_id)
-        # Notify we are starting
-        self.send(
-            properties.reply_to, corr_id, {'status': 'started'}, exchange='')
+        # Get needed variables
+        params = body.get('parameters', {})
 
         try:
+            server_name = params['server_name']
+            template = params['container_name_template']
+            replicas = int(params['replicas'])
+            if '{index}' not in template:
+                raise DockerWorkerError(
+                    'container_name_template must contain {index}')
+            pattern = re.compile('^%s$' % re.escape(template).replace(
+                re.escape('{index}'), r'(\d+)'))
+            client = self._create_client(server_name)
+            existing = {}
+            for container in client.containers(all=True):
+                for name in container.get('Names') or []:
+                    match = pattern.match(name.lstrip('/'))
+                    if match:
+                        existing[name.lstrip('/')] = (
+                            int(match.group(1)), container)
+
+            jobs = []
+            result = {'created': [], 'started': [], 'removed': []}
+            for index in range(replicas):
+                name = template.format(index=index)
+                if name not in existing:
+                    jobs.append(('created', name, self._replica_up(
+                        params, name, index, create=True)))
+                elif not existing[name][1].get(
+                        'Status', '').startswith('Up'):
+                    jobs.append(('started', name, self._replica_up(
+                        params, name, index, create=False)))
+            for name, (index, container) in existing.items():
+                if index >= replicas:
+                    self.container_ids.set(
+                        (server_name, name), container.get('Id'))
+                    jobs.append(('removed', name, self._replica_down(
+                        params, name, container)))
+
+            failed = {}
+            for (kind, name, _), (_, error) in zip(jobs, self._on_host(
+                    server_name,
+                    [self._in_span(tracing.current(), job[2])
+                     for job in jobs])):
+                if error is None:
+                    result[kind].append(name)
+                else:
+                    failed[name] = str(error)
+            for names in result.values():
+                names.sort()
+            if failed:
+                self.app_logger.warn(
+                    'Unable to scale %s on %s. Errors: %s' % (
+                        template, server_name, failed))
+                raise DockerWorkerError(
+                    'Scaling failed for %s of %s replicas' % (
+                        len(failed), len(jobs)))
+            result['replicas'] = replicas
+            return result
+
+        except KeyError, ke:
+            self.app_logger.warn('Missing input %s' % ke)
+            output.error(
+                'Unable to scale containers %s because of missing input %s' % (
+                    params.get('container_name_template', 'NOT_GIVEN'), ke))
+            raise DockerWorkerError('Missing input %s' % ke)
+        except docker.errors.APIError, ae:
+            self.app_logger.warn(
+                'Unable to list containers on %s. Error: %s' % (
+                    params.get('server_name', 'Unknown'), ae))
+            raise DockerWorkerError(
+                'Unable to list containers.')
+        except requests.exceptions.ConnectionError, ce:
+            self.app_logger.warn(
+                'Unable to connect to %s. Error: %s' % (
+                    params.get('server_name', 'Unknown'), ce))
+            raise DockerWorkerError(
+                'Could not connect to the requested Docker Host')
+
+    def _in_span(self, span, func):
+        """
+        Returns func wrapped to run under span, and the watched
+        operation of this thread, on another thread.
+        """
+        operation = watchdog.current()
+        if span is None and operation is None:
+            return func
+
+        def run():
+            tracing.activate(span)
+            watchdog.activate(operation)
             try:
-                subcommand = str(body['parameters']['subcommand'])
-                if subcommand not in self.subcommands:
-                    raise KeyError()
-            except KeyError:
+                return func()
+            finally:
+                tracing.activate(None)
+                watchdog.activate(None)
+        return run
+
+    def _host_limit(self, server_name):
+        """
+        Returns how many operations may run against server_name at once.
+        """
+        limit = None
+        if self.scheduler is not None:
+            limit = self.scheduler.limits.limit_for(server_name)
+        return limit or self._config.get('scale_concurrency', 4)
+
+    def _on_host(self, server_name, funcs):
+        """
+        Runs callables against server_name in parallel and returns a list
+        of (result, exception) in the order of funcs. Under the scheduler
+        the calling job gives up its slot on the host while each callable
+        takes a slot of its own, so the fan out stays within the host cap
+        shared with every other job.
+
+        Parameters:
+
+        * server_name: The Docker host the callables operate on
+        * funcs: List of callables taking no arguments
+        """
+        if self.scheduler is None:
+            return run_parallel(funcs, self._host_limit(server_name))
+
+        def in_slot(func):
+            def run():
+                with self.scheduler.host_slot(server_name):
+                    return func()
+            return run
+        with self.scheduler.yield_slot(server_name):
+            return run_parallel(
+                [in_slot(func) for func in funcs],
+                self._host_limit(server_name))
+
+    def _replica_up(self, params, name, index, create):
+        """
+        Returns a callable which creates (optionally) and starts one
+        replica through the CreateContainer and StartContainer methods.
+        """
+        replica = dict(params, container_name=name)
+        template = params.get('hostname_template')
+        if template and not params.get('container_hostname'):
+            replica['container_hostname'] = template.format(
+                index=index, **replica)
+        body = {'parameters': replica}
+
+        def up():
+            if create:
+                self.create_container(body, None, _NullOutput)
+            return self.start_container(body, None, _NullOutput)
+        return up
+
+    def _replica_down(self, params, name, container):
+        """
+        Returns a callable which stops and removes one extra replica.
+        """
+        body = {'parameters': dict(
+            server_name=params['server_name'], container_name=name)}
+
+        def down():
+            if container.get('Status', '').startswith('Up'):
+                self.stop_container(body, None, _NullOutput)
+            return self.remove_container(body, None, _NullOutput)
+        return down
+
+    def exec_in_container(self, body, corr_id, output):
+        """
+        Runs a command in a running container, streaming its stdout and
+        stderr back to reply_to in chunks as it is produced. Requires
+        the exec API (docker-py 1.7 and Docker API 1.15).
+
+        Parameters:
+
+        * body: The message body structure
+        * corr_id: The correlation id of the message
+        * output: The output object back to the user
+        """
+        # Get needed variables
+        params = body.get('parameters', {})
+
+        try:
+            server_name = params['server_name']
+            container_name = params['container_name']
+            command = params['exec_command']
+            chunk_size = params.get('chunk_size') or 4096
+            client = self._create_client(server_name)
+            exec_id = self._on_container(
+                server_name, container_name,
+                lambda ref: client.exec_create(
+                    ref, command, stdout=True, stderr=True, tty=False,
+                    user=params.get('user') or ''))['Id']
+            sent = {'stdout': 0, 'stderr': 0}
+            # One decoder per stream carries characters split between
+            # chunks over to the next chunk
+            decoders = dict(
+                (name, codecs.getincrementaldecoder('utf-8')('replace'))
+                for name in sent)
+            output_chunks = itertools.count()
+
+            def send_output(name, text):
+                if text:
+                    self._send_progress(corr_id, {
+                        'status': 'output',
+                        'stream': name,
+                        'seq': next(output_chunks),
+                        'data': text,
+                    })
+
+            sock = client.exec_start(exec_id, socket=True)
+            try:
+                for stream, data in iter_chunks(
+                        iter_frames(sock), chunk_size):
+                    name = STREAM_NAMES.get(stream, 'stdout')
+                    sent[name] += len(data)
+                    send_output(name, decoders[name].decode(data))
+            finally:
+                sock.close()
+            for name in sorted(decoders):
+                send_output(name, decoders[name].decode('', True))
+            exit_code = client.exec_inspect(exec_id).get('ExitCode')
+            if exit_code != 0 and params.get('check_exit_code', True):
                 raise DockerWorkerError(
-                    'No valid subcommand given. Nothing to do!')
+                    'Command exited with %s' % exit_code)
+            return {
+                'container_name': container_name,
+                'exit_code': exit_code,
+                'stdout_bytes': sent['stdout'],
+                'stderr_bytes': sent['stderr'],
+            }
 
-            cmd_method = None
-            subcommand
-            if subcommand == 'StopContainer':
-                cmd_method = self.stop_container
-            elif subcommand == 'RemoveContainer':
-                cmd_method = self.remove_container
-            elif subcommand == 'RemoveImage':
-                cmd_method = self.remove_image
-            elif subcommand == 'PullImage':
-                cmd_method = self.pull_image
-            elif subcommand == 'CreateContainer':
-                cmd_method = self.create_container
-            elif subcommand == 'StartContainer':
-                cmd_method = self.start_container
-            else:
+        except KeyError, ke:
+            self.app_logger.warn('Missing input %s' % ke)
+            output.error(
+                'Unable to exec in container %s because of missing input %s' % (
+                    params.get('container_name', 'IMAGE_NOT_GIVEN'), ke))
+            raise DockerWorkerError('Missing input %s' % ke)
+        except docker.errors.APIError, ae:
+            self._forget_container(params)
+            self.app_logger.warn(
+                'Unable to exec in %s. Error: %s' % (
+                    params.get('container_name', 'Unknown'), ae))
+            raise DockerWorkerError(
+                'No such container is running currently.')
+        except (requests.exceptions.ConnectionError, socket.error), ce:
+            self.app_logger.warn(
+                'Unable to connect to %s. Error: %s' % (
+                    params.get('server_name', 'Unknown'), ce))
+            raise DockerWorkerError(
+                'Could not connect to the requested Docker Host')
+
+    def copy_to_container(self, body, corr_id, output):
+        """
+        Uploads files into one or more containers on a host, such as
+        config bundles before StartContainer. The tar archive is
+        generated while it is sent and the same Archive feeds every
+        container. Requires put_archive (docker-py 1.7 and Docker API
+        1.20).
+
+        Parameters:
+
+        * body: The message body structure
+        * corr_id: The correlation id of the message
+        * output: The output object back to the user
+        """
+        # Get needed variables
+        params = body.get('parameters', {})
+
+        try:
+            server_name = params['server_name']
+            path = params['path']
+            container_names = params.get('container_names') or [
+                params['container_name']]
+            archive = self._archive(params)
+
+            def copy(container_name):
+                def run():
+                    client = self._create_client(server_name)
+                    return self._on_container(
+                        server_name, container_name,
+                        lambda ref: client.put_archive(
+                            ref, path, iter(archive)))
+                return run
+
+            failed = {}
+            for name, (_, error) in zip(container_names, self._on_host(
+                    server_name,
+                    [self._in_span(tracing.current(), copy(name))
+                     for name in container_names])):
+                if error is not None:
+                    failed[name] = str(error)
+                    if isinstance(error, docker.errors.APIError):
+                        self._forget_container(dict(
+                            server_name=server_name, container_name=name))
+            if failed:
                 self.app_logger.warn(
-                    'Could not find the implementation of subcommand %s' % (
-                        subcommand))
-                raise DockerWorkerError('No subcommand implementation')
+                    'Unable to copy to %s on %s. Errors: %s' % (
+                        ', '.join(sorted(failed)), server_name, failed))
+                raise DockerWorkerError(
+                    'Copy failed for %s of %s containers' % (
+                        len(failed), len(container_names)))
+            return {
+                'container_names': container_names,
+                'path': path,
+                'members': len(archive),
+                'bytes': archive.size,
+            }
 
-            result = cmd_method(body, corr_id, output)
-            # Send results back
-            self.send(
-                properties.reply_to,
-                corr_id,
-                {'status': 'completed', 'data': result},
-                exchange=''
-            )
-            # Notify on result. Not required but nice to do.
-            self.notify(
-                'DockerWorker Executed Successfully',
-                'DockerWorker successfully executed %s. See logs.' % (
-                    subcommand),
-                'completed',
-                corr_id)
+        except KeyError, ke:
+            self.app_logger.warn('Missing input %s' % ke)
+            output.error(
+                'Unable to copy to container %s because of missing input %s' % (
+                    params.get('container_name', 'IMAGE_NOT_GIVEN'), ke))
+            raise DockerWorkerError('Missing input %s' % ke)
+        except (IOError, OSError), ioe:
+            self.app_logger.warn(
+                'Unable to read %s. Error: %s' % (
+                    params.get('source', 'Unknown'), ioe))
+            raise DockerWorkerError('Unable to read the source bundle')
 
-            # Send out responses
-            self.app_logger.info(
-                'DockerWorker successfully executed %s for '
-                'correlation_id %s. See logs.' % (
-                    subcommand, corr_id))
+    def _archive(self, params):
+        """
+        Returns the Archive of the source bundle and inline files of a
+        CopyToContainer message. Source bundles are directories below
+        the copy_root setting.
+        """
+        archive = Archive()
+        if params.get('source'):
+            archive.add_directory(
+                self._source_directory('copy_root', params['source']))
+        for name, content in sorted((params.get('files') or {}).items()):
+            archive.add_bytes(name, content)
+        if not len(archive):
+            raise DockerWorkerError('Nothing to copy')
+        return archive
 
-        except DockerWorkerError, fwe:
-            # If a DockerWorkerError happens send a failure log it.
-            self.app_logger.error('Failure: %s' % fwe)
+    def _source_directory(self, setting, source):
+        """
+        Returns the local directory source names below the directory of
+        the setting, refusing anything outside of it.
 
-            self.send(
-                properties.reply_to,
-                corr_id,
-                {'status': 'failed'},
-                exchange=''
-            )
-            self.notify(
-                'DockerWorker Failed',
-                str(fwe),
-                'failed',
-                corr_id)
-            output.error(str(fwe))
+        Parameters:
+
+        * setting: The config key of the root directory
+        * source: The directory relative to the root
+        """
+        root = self._config.get(setting)
+        if not root:
+            raise DockerWorkerError('No %s configured' % setting)
+        root = os.path.realpath(root)
+        directory = os.path.realpath(os.path.join(root, source))
+        if not (directory + os.sep).startswith(root + os.sep):
+            raise DockerWorkerError(
+                'Source %s is outside of %s' % (source, setting))
+        if not os.path.isdir(directory):
+            raise DockerWorkerError('No such source %s' % source)
+        return directory
+
+    def build_image(self, body, corr_id, output):
+        """
+        Builds an image from a directory below the build_root setting.
+        The build context is sent as a tar stream generated while it
+        is uploaded and build output is streamed back as progress
+        replies. A context unchanged since the last build of the tag
+        on the host is not sent again. The image can then be copied to
+        other hosts without going through a registry.
+
+        Parameters:
+
+        * body: The message body structure
+        * corr_id: The correlation id of the message
+        * output: The output object back to the user
+        """
+        # Get needed variables
+        params = body.get('parameters', {})
+
+        try:
+            server_name = params['server_name']
+            tag = params['tag']
+            archive = Archive()
+            archive.add_directory(
+                self._source_directory('build_root', params['source']))
+            with timing.phase('context'):
+                context_digest = archive.digest()
+            client = self._create_client(server_name)
+
+            image_id = self._built_image(
+                client, server_name, tag, context_digest)
+            cached = image_id is not None
+            if not cached:
+                for reference in params.get('cache_from') or []:
+                    self._warm_cache(client, reference,
+                                     params.get('insecure_registry', False))
+                image_id = self._build(client, corr_id, tag, archive, params)
+                self.builds.set((server_name, tag), {
+                    'context_digest': context_digest,
+                    'image_id': image_id,
+                })
+
+            distributed = self._distribute(
+                client, server_name, tag, image_id,
+                params.get('distribute_to') or [])
+            return {
+                'tag': tag,
+                'image_id': image_id,
+                'cached': cached,
+                'context_digest': context_digest,
+                'context_bytes': archive.size,
+                'distributed_to': distributed,
+            }
+
+        except KeyError, ke:
+            self.app_logger.warn('Missing input %s' % ke)
+            output.error(
+                'Unable to build image %s because of missing input %s' % (
+                    params.get('tag', 'IMAGE_NOT_GIVEN'), ke))
+            raise DockerWorkerError('Missing input %s' % ke)
+        except docker.errors.APIError, ae:
+            self.app_logger.warn(
+                'Unable to build %s. Error: %s' % (
+                    params.get('tag', 'Unknown'), ae))
+            raise DockerWorkerError('Build failed: %s' % ae)
+        except requests.exceptions.ConnectionError, ce:
+            self.app_logger.warn(
+                'Unable to connect to %s. Error: %s' % (
+                    params.get('server_name', 'Unknown'), ce))
+            raise DockerWorkerError(
+                'Could not connect to the requested Docker Host')
+        except (IOError, OSError), ioe:
+            self.app_logger.warn(
+                'Unable to read %s. Error: %s' % (
+                    params.get('source', 'Unknown'), ioe))
+            raise DockerWorkerError('Unable to read the build context')
+
+    def _built_image(self, client, server_name, tag, context_digest):
+        """
+        Returns the ID of the image last built for tag on the host if
+        it came from the same context and is still tagged, else None.
+        """
+        build = self.builds.get((server_name, tag))
+        if build is None or build['context_digest'] != context_digest:
+            return None
+        try:
+            if client.inspect_image(tag).get('Id') == build['image_id']:
+                return build['image_id']
+        except docker.errors.APIError:
+            pass
+        self.builds.discard((server_name, tag))
+        return None
+
+    def _warm_cache(self, client, reference, insecure_registry):
+        """
+        Pulls a cache_from hint so the builder can reuse its layers. A
+        hint which cannot be pulled only costs cache hits.
+        """
+        try:
+            error = self._pull(client, reference, insecure_registry)[1]
+        except docker.errors.APIError, ae:
+            error = ae
+        if error:
+            self.app_logger.warn(
+                'Unable to pull cache image %s. Error: %s' % (
+                    reference, error))
+
+    def _build(self, client, corr_id, tag, archive, params):
+        """
+        Sends the context, relays the build output and returns the ID
+        of the built image.
+        """
+        kwargs = {}
+        if params.get('dockerfile'):
+            kwargs['dockerfile'] = params['dockerfile']
+        if params.get('pull'):
+            kwargs['pull'] = True
+        build_output = client.build(
+            fileobj=iter(archive), custom_context=True, tag=tag, rm=True,
+            nocache=params.get('nocache', False), stream=True, **kwargs)
+        for event in iter_events(build_output):
+            error = stream_error(event)
+            if error:
+                raise DockerWorkerError('Build failed: %s' % error)
+            if event.get('stream', '').strip():
+                self._send_progress(corr_id, {
+                    'status': 'building',
+                    'stream': event['stream'],
+                })
+        return client.inspect_image(tag).get('Id')
+
+    def _distribute(self, client, server_name, tag, image_id, hosts):
+        """
+        Copies the image to every host which does not have it yet by
+        streaming it from the build host. Returns the hosts it was
+        loaded on.
+        """
+        def load(host):
+            def run():
+                target = self._create_client(host)
+                try:
+                    if target.inspect_image(tag).get('Id') == image_id:
+                        return False
+                except docker.errors.APIError:
+                    pass
+                source = client.get_image(tag)
+                try:
+                    target.load_image(iter_read(source))
+                finally:
+                    source.close()
+                return True
+            if self.scheduler is None:
+                return run
+
+            def in_slot():
+                # The load runs on the target host
+                with self.scheduler.host_slot(host):
+                    return run()
+            return in_slot
+
+        hosts = [host for host in hosts if host != server_name]
+        loaded, failed = [], {}
+        # Every load streams the image from the build host, which bounds
+        # how many run at once, and holds a slot on its target host
+        for host, (result, error) in zip(hosts, run_parallel(
+                [self._in_span(tracing.current(), load(host))
+                 for host in hosts],
+                self._host_limit(server_name))):
+            if error is not None:
+                failed[host] = str(error)
+            elif result:
+                loaded.append(host)
+        if failed:
+            self.app_logger.warn(
+                'Unable to copy %s to %s. Errors: %s' % (
+                    tag, ', '.join(sorted(failed)), failed))
+            raise DockerWorkerError(
+                'Distribution failed for %s of %s hosts' % (
+                    len(failed), len(hosts)))
+        return loaded
+
+    def export_image(self, body, corr_id, output):
+        """
+        Saves an image of a host to the image_archive directory, so it
+        can later be loaded on any host without a registry. The image
+        is written in chunks as the host sends it.
+
+        Parameters:
+
+        * body: The message body structure
+        * corr_id: The correlation id of the message
+        * output: The output object back to the user
+        """
+        # Get needed variables
+        params = body.get('parameters', {})
+
+        try:
+            server_name = params['server_name']
+            image_name = params['image_name']
+            compress = params.get('compress', False)
+            path = self._archive_path(params.get('archive_name') or (
+                archive_name(image_name, compress)))
+            client = self._create_client(server_name)
+            image_id = client.inspect_image(image_name).get('Id')
+            source = client.get_image(image_name)
+            try:
+                with timing.phase('streaming'):
+                    size, stored, digest = write_archive(
+                        iter_read(source, params['chunk_size']), path,
+                        compress=compress)
+            finally:
+                source.close()
+            return {
+                'image_name': image_name,
+                'image_id': image_id,
+                'archive_name': os.path.basename(path),
+                'bytes': size,
+                'stored_bytes': stored,
+                'sha256': digest,
+            }
+
+        except KeyError, ke:
+            self.app_logger.warn('Missing input %s' % ke)
+            output.error(
+                'Unable to export image %s because of missing input %s' % (
+                    params.get('image_name', 'IMAGE_NOT_GIVEN'), ke))
+            raise DockerWorkerError('Missing input %s' % ke)
+        except docker.errors.APIError, ae:
+            self.app_logger.warn(
+                'Unable to export %s. Error: %s' % (
+                    params.get('image_name', 'Unknown'), ae))
+            raise DockerWorkerError(
+                'No such image found.')
+        except requests.exceptions.ConnectionError, ce:
+            self.app_logger.warn(
+                'Unable to connect to %s. Error: %s' % (
+                    params.get('server_name', 'Unknown'), ce))
+            raise DockerWorkerError(
+                'Could not connect to the requested Docker Host')
+        except (IOError, OSError), ioe:
+            self.app_logger.warn(
+                'Unable to write the archive of %s. Error: %s' % (
+                    params.get('image_name', 'Unknown'), ioe))
+            raise DockerWorkerError('Unable to write the image archive')
+
+    def import_image(self, body, corr_id, output):
+        """
+        Loads an image saved by ExportImage onto a host. The archive is
+        checked against its checksum first and then sent in chunks.
+
+        Parameters:
+
+        * body: The message body structure
+        * corr_id: The correlation id of the message
+        * output: The output object back to the user
+        """
+        # Get needed variables
+        params = body.get('parameters', {})
+
+        try:
+            server_name = params['server_name']
+            if params.get('archive_name'):
+                path = self._archive_path(params['archive_name'])
+            else:
+                # Whichever of the compressed and plain archive exists
+                paths = [self._archive_path(archive_name(
+                    params['image_name'], compress))
+                    for compress in (True, False)]
+                path = ([p for p in paths if os.path.isfile(p)] or paths)[0]
+            if not os.path.isfile(path):
+                raise DockerWorkerError(
+                    'No such archive %s' % os.path.basename(path))
+            digest = None
+            if params.get('verify', True):
+                expected = read_checksum(path)
+                if expected is None:
+                    raise DockerWorkerError(
+                        'No checksum for %s' % os.path.basename(path))
+                with timing.phase('verify'):
+                    digest = file_digest(path, params['chunk_size'])
+                if digest != expected:
+                    raise DockerWorkerError(
+                        'Checksum mismatch for %s' % os.path.basename(path))
+            client = self._create_client(server_name)
+            with timing.phase('streaming'):
+                client.load_image(read_archive(path, params['chunk_size']))
+            return {
+                'archive_name': os.path.basename(path),
+                'image_name': params.get('image_name'),
+                'sha256': digest,
+            }
+
+        except KeyError, ke:
+            self.app_logger.warn('Missing input %s' % ke)
+            output.error(
+                'Unable to import image %s because of missing input %s' % (
+                    params.get('archive_name', 'IMAGE_NOT_GIVEN'), ke))
+            raise DockerWorkerError('Missing input %s' % ke)
+        except docker.errors.APIError, ae:
+            self.app_logger.warn(
+                'Unable to import %s. Error: %s' % (
+                    params.get('archive_name', 'Unknown'), ae))
+            raise DockerWorkerError('Import failed: %s' % ae)
+        except requests.exceptions.ConnectionError, ce:
+            self.app_logger.warn(
+                'Unable to connect to %s. Error: %s' % (
+                    params.get('server_name', 'Unknown'), ce))
+            raise DockerWorkerError(
+                'Could not connect to the requested Docker Host')
+        except (IOError, OSError), ioe:
+            self.app_logger.warn(
+                'Unable to read the archive %s. Error: %s' % (
+                    params.get('archive_name', 'Unknown'), ioe))
+            raise DockerWorkerError('Unable to read the image archive')
+
+    def _archive_path(self, name):
+        """
+        Returns the path of an archive in the image_archive directory.
+        """
+        root = self._config.get('image_archive')
+        if not root:
+            raise DockerWorkerError('No image_archive configured')
+        if (not name or name != os.path.basename(name) or
+                name.startswith('.')):
+            raise DockerWorkerError('Invalid archive name %s' % name)
+        return os.path.join(root, name)
+
+    def _send_progress(self, corr_id, message):
+        """
+        Sends an intermediate reply for the message this thread is
+        executing.
+
+        Parameters:
+
+        * corr_id: The correlation id of the message
+        * message: The reply structure
+        """
+        properties = getattr(self._replying, 'properties', None)
+        if properties is None:
+            return
+        with timing.phase('streaming'):
+            self.send(
+                properties.reply_to, corr_id, message, exchange='',
+                **self._reply_options(properties))
+
+    def _replay(self, properties):
+        """
+        Sends the cached final reply of an already handled message.
+        Returns True if there was one.
+
+        Parameters:
+
+        * properties: The properties of the message
+        """
+        if self.replay_cache is None:
+            return False
+        corr_id = str(properties.correlation_id)
+        reply = self.replay_cache.get(corr_id)
+        if reply is None:
+            return False
+        self.app_logger.info(
+            'Replaying %s reply for correlation_id %s' % (
+                reply['status'], corr_id))
+        self.send(
+            properties.reply_to, corr_id, reply, exchange='',
+            **self._reply_options(properties))
+        self._journal_done(corr_id, reply['status'])
+        return True
+
+    def _remember_reply(self, corr_id, reply):
+        """
+        Stores a final reply in the replay cache if it is enabled.
+
+        Parameters:
+
+        * corr_id: The correlation id of the message
+        * reply: The final reply structure sent back to the user
+        """
+        if self.replay_cache is not None:
+            self.replay_cache.set(corr_id, reply)
+
+    def _journal_done(self, corr_id, status):
+        """
+        Records in the journal that the final reply of an operation went
+        out. Replies going through the publisher are only recorded once
+        published, and with confirms once the broker confirmed them.
+
+        Parameters:
+
+        * corr_id: The correlation id of the message
+        * status: The status of the final reply
+        """
+        if self.journal is not None:
+            self._on_io_loop(False, self.journal.done, corr_id, status)
+
+    def _on_io_loop(self, is_publish, func, *args, **kwargs):
+        """
+        Calls func right away or queues it on the publisher when
+        batching is enabled or when called off the I/O loop thread.
+
+        Parameters:
+
+        * is_publish: If func publishes a message
+        * func: The callable to run
+        """
+        if self.publisher is None or self._io_thread is None or not (
+                self._batch_publishes or
+                threading.current_thread() is not self._io_thread):
+            return func(*args, **kwargs)
+        if is_publish:
+            self.publisher.publish(func, *args, **kwargs)
+        else:
+            self.publisher.put(func, *args, **kwargs)
+
+    def send(self, *args, **kwargs):
+        """
+        Thread safe, optionally batched, wrapper around Worker.send.
+        A content_type keyword of msgpack sends the message msgpack
+        encoded instead of as JSON.
+        """
+        func = Worker.send
+        if encoding.is_msgpack(kwargs.pop('content_type', None)):
+            func = DockerWorker._send_msgpack
+        with timing.phase('publishing'):
+            self._on_io_loop(True, func, self, *args, **kwargs)
+
+    def _send_msgpack(self, topic, corr_id, message_struct, exchange=''):
+        """
+        Publishes a msgpack encoded message. Must run on the I/O loop.
+
+        Parameters:
+
+        * topic: The routing key to send to
+        * corr_id: The correlation id of the message
+        * message_struct: The structure to send
+        * exchange: The exchange to publish to
+        """
+        self._reply_channel.basic_publish(
+            exchange=exchange,
+            routing_key=topic,
+            body=encoding.encode(message_struct, encoding.MSGPACK),
+            properties=pika.BasicProperties(
+                correlation_id=corr_id,
+                content_type=encoding.MSGPACK))
+
+    def _reply_options(self, properties):
+        """
+        Returns extra send() keywords for replies to a message. Replies
+        use msgpack when the request was msgpack.
+
+        Parameters:
+
+        * properties: The properties of the request message
+        """
+        content_type = encoding.reply_content_type(properties)
+        if content_type is None:
+            return {}
+        return {'content_type': content_type}
+
+    def _process(self, channel, basic_deliver, properties, body):
+        """
+        Decodes msgpack bodies once and hands them straight to process().
+        The base worker still builds the output object, but is only
+        given an empty JSON object to decode. JSON bodies are passed
+        through untouched.
+        """
+        content_type = getattr(properties, 'content_type', None)
+        if not encoding.is_msgpack(content_type):
+            Worker._process(self, channel, basic_deliver, properties, body)
+            return
+        try:
+            decoded = encoding.decode(body, content_type)
+        except encoding.EncodingError, ee:
+            self.app_logger.error(
+                'Unable to decode %s message: %s' % (content_type, ee))
+            channel.basic_reject(
+                delivery_tag=basic_deliver.delivery_tag, requeue=False)
+            return
+        self._decoded.body = decoded
+        try:
+            Worker._process(self, channel, basic_deliver, properties, '{}')
+        finally:
+            self._decoded.body = None
+
+    def notify(self, *args, **kwargs):
+        """
+        Thread safe, optionally batched, wrapper around Worker.notify.
+        """
+        with timing.phase('publishing'):
+            self._on_io_loop(True, Worker.notify, self, *args, **kwargs)
+
+    def ack(self, *args, **kwargs):
+        """
+        Thread safe, optionally batched, wrapper around Worker.ack.
+        """
+        self._on_io_loop(False, Worker.ack, self, *args, **kwargs)
+
+    def _on_open(self, connection):
+        """
+        Keeps a handle on the connection for the I/O loop hand-off.
+
+        Parameters:
+
+        * connection: The newly opened connection
+        """
+        self._io_connection = connection
+        Worker._on_open(self, connection)
+
+    def _on_channel_open(self, channel):
+        """
+        Applies the configured prefetch count before consuming so the
+        broker never hands this worker more unacked messages than it
+        is allowed to hold.
+
+        Parameters:
+
+        * channel: The newly opened channel
+        """
+        self._reply_channel = channel
+        prefetch_count = self._config.get('prefetch_count')
+        if prefetch_count is not None:
+            if (isinstance(prefetch_count, bool) or
+                    not isinstance(prefetch_count, (int, long)) or
+                    prefetch_count < 1):
+                self.app_logger.error(
+                    'Ignoring prefetch_count %r: expected a positive '
+                    'integer' % (prefetch_count,))
+            else:
+                channel.basic_qos(prefetch_count=prefetch_count)
+        Worker._on_channel_open(self, channel)
+        if self.publisher is not None:
+            self._io_thread = threading.current_thread()
+            self.publisher.start(self._io_connection, channel)
+        if self.watchdog is not None:
+            self.watchdog.run_in_background()
+        if self.journal is not None and not self._recovered:
+            self._recovered = True
+            self._recover()
+        if self.handle_signals:
+            self._channel_for_drain = channel
+            signal.signal(signal.SIGTERM, self._on_drain_signal)
+            signal.signal(signal.SIGHUP, self._on_reload_signal)
+            self._io_connection.add_timeout(
+                HOUSEKEEPING_INTERVAL, self._housekeeping)
+
+    def _on_drain_signal(self, signum, frame):
+        """
+        Signal handler requesting a graceful drain.
+        """
+        self._drain_requested = True
+
+    def _on_reload_signal(self, signum, frame):
+        """
+        Signal handler requesting a configuration reload.
+        """
+        self._reload_requested = True
+
+    def _housekeeping(self):
+        """
+        Acts on drain and reload requests from the I/O loop, where it
+        is safe to use the connection.
+        """
+        if self._reload_requested:
+            self._reload_requested = False
+            try:
+                self.reload_config()
+            except (IOError, ValueError), ex:
+                self.app_logger.error(
+                    'Unable to reload configuration: %s' % ex)
+        if self._drain_requested and not self._draining:
+            self.drain(self._channel_for_drain)
+        if self._draining and self._in_flight == 0:
+            self._finish_drain()
+            return
+        self._io_connection.add_timeout(
+            HOUSEKEEPING_INTERVAL, self._housekeeping)
+
+    def drain(self, channel):
+        """
+        Stops consuming new messages. Messages already delivered but
+        not started are requeued for other workers while in-flight
+        subcommands run to completion.
+
+        Parameters:
+
+        * channel: The channel being consumed from
+        """
+        self.app_logger.info(
+            'Draining with %s operation(s) in flight' % self._in_flight)
+        self._draining = True
+        for consumer_tag in list(getattr(channel, 'consumer_tags', [])):
+            channel.basic_cancel(consumer_tag=consumer_tag)
+
+    def _finish_drain(self):
+        """
+        Flushes queued replies and shuts down once nothing is in flight.
+        """
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        if self.publisher is not None:
+            self.publisher.flush()
+        if self.replay_cache is not None:
+            self.replay_cache.flush()
+        if self.tracer is not None:
+            self.tracer.close()
+        self.app_logger.info('Drained. Shutting down.')
+        self._io_connection.close()
+        # Give the I/O loop a moment to write the final frames
+        self._io_connection.add_timeout(
+            1, self._io_connection.ioloop.stop)
+
+    def reload_config(self):
+        """
+        Re-reads the configuration file and applies timeouts, quiet
+        subcommands, profiles, registry limits, watchdog deadlines,
+        publisher and concurrency settings in place. The new file
+        replaces the old configuration, so removed keys fall back to
+        their defaults. A config with a bad profile is not applied.
+        Queued and running operations are not interrupted. Docker
+        clients are built per call, so a new API version applies to
+        the next operation. Lane names and routes, the journal,
+        tracing and caches are only set up at start.
+        """
+        with open(self._config_file, 'r') as config_file:
+            config = json.load(config_file)
+        profiles = compile_profiles(config.get('profiles'))
+        self._config = config
+        self.profiles = profiles
+        self.quiet_subcommands = frozenset(
+            self._config.get('quiet_subcommands', []))
+        if self._config.get('registry_limits'):
+            # Pulls holding a slot release it on the limiter they took
+            # it from
+            self.registry_limits = RegistryLimiter(
+                self._config['registry_limits'])
+        else:
+            self.registry_limits = None
+        if self.watchdog is not None:
+            # Without a watchdog section nothing is watched anymore
+            watchdog_conf = self._config.get('watchdog')
+            if not isinstance(watchdog_conf, dict):
+                watchdog_conf = {}
+            self.watchdog.deadlines = dict(
+                watchdog_conf.get('deadlines') or {})
+            self.watchdog.default = watchdog_conf.get('default')
+            self.watchdog.cancel = watchdog_conf.get('cancel', False)
+        if self.publisher is not None:
+            publisher_conf = self._config.get('publisher')
+            if not isinstance(publisher_conf, dict):
+                publisher_conf = {}
+            self.publisher.flush_interval = float(
+                publisher_conf.get('flush_interval', 0.05))
+            self.publisher.max_retries = int(
+                publisher_conf.get('max_retries', 5))
+        if self.scheduler is not None:
+            lanes = self._config.get('lanes')
+            if not lanes:
+                lanes = {'default': {
+                    'concurrency': self._config.get(
+                        'scheduler_threads', 16)}}
+            if sorted(lanes) != sorted(self.scheduler.lanes):
+                self.app_logger.warn(
+                    'Lane names changed; only sizes of existing lanes '
+                    'are applied until restart')
+            self.scheduler.reconfigure(
+                lanes,
+                host_limit=self._config.get('host_concurrency'),
+                host_overrides=self._config.get(
+                    'host_concurrency_overrides'))
+        self.app_logger.info(
+            'Reloaded configuration from %s' % self._config_file)
+
+    def process(self, channel, basic_deliver, properties, body, output):
+        """
+        Processes DockerWorker requests from the bus.
+
+        By default the message is acked on entry. When
+        ack_after_completion is set in the configuration the ack is
+        sent only after the final reply so a crash leaves the message
+        on the queue for redelivery.
+
+        When lanes or per host caps are configured the message is
+        queued on the lane for its subcommand, ordered by the message
+        priority and the optional deadline parameter and held back
+        while its server_name is at its in-flight cap. This method
+        then returns at once.
+
+        *Keys Requires*:
+            * subcommand: the subcommand to execute.
+        """
+        decoded = getattr(self._decoded, 'body', None)
+        if decoded is not None:
+            # A msgpack body _process decoded already
+            self._decoded.body = None
+            body = decoded
+
+        if self._first_message:
+            self._first_message = False
+            self.app_logger.info(
+                'First message consumed %.3f seconds after launch' % (
+                    seconds_since_launch()))
+
+        if self._draining:
+            # Hand the message to another worker
+            channel.basic_reject(
+                delivery_tag=basic_deliver.delivery_tag, requeue=True)
+            return
+
+        ack_after_completion = self._config.get(
+            'ack_after_completion', False)
+        if not ack_after_completion:
+            # Ack the original message
+            self.ack(basic_deliver)
+
+        # Redeliveries are answered before they take a lane or a slot
+        if self._replay(properties):
+            if ack_after_completion:
+                self.ack(basic_deliver)
+            return
+
+        # Time each phase of handling unless turned off
+        trace = None
+        if self._config.get('timing', True):
+            trace = timing.Trace()
+        accepted = timing.clock()
+        timing.activate(trace)
+
+        # One span covers the message from here to its final reply
+        span = None
+        if self.tracer is not None:
+            span = self.tracer.start_span(
+                'process', getattr(properties, 'headers', None),
+                {'correlation_id': properties.correlation_id})
+
+        # Reject malformed messages before they take a slot or a client
+        try:
+            with timing.phase('validating'):
+                body = self._validate(body)
+        except DockerWorkerError, dwe:
+            self._fail(
+                properties, str(properties.correlation_id), dwe, output)
+            if ack_after_completion:
+                self.ack(basic_deliver)
+            timing.activate(None)
+            if span is not None:
+                span.finish(dwe)
+            return
+        timing.activate(None)
+        if span is not None:
+            span.tags['subcommand'] = body['parameters']['subcommand']
+
+        def run():
+            timing.activate(trace)
+            tracing.activate(span)
+            if trace is not None:
+                trace.add('queued', timing.clock() - accepted)
+            try:
+                self._execute(properties, body, output)
+            finally:
+                if ack_after_completion:
+                    # The reply is out, the message can leave the queue
+                    self.ack(basic_deliver)
+                timing.activate(None)
+                tracing.activate(None)
+                if span is not None:
+                    span.finish()
+                self._track_in_flight(-1)
+
+        if self.journal is not None and not ack_after_completion:
+            # Redelivery covers crashes when acking after completion
+            self.journal.accepted(
+                str(properties.correlation_id),
+                str(body['parameters']['subcommand']),
+                body['parameters'],
+                properties.reply_to,
+                getattr(properties, 'content_type', None))
+
+        self._track_in_flight(1)
+        if self.scheduler is None:
+            run()
+            return
+
+        def expire():
+            timing.activate(trace)
+            if trace is not None:
+                trace.add('queued', timing.clock() - accepted)
+            try:
+                self._fail(
+                    properties,
+                    str(properties.correlation_id),
+                    DockerWorkerError('Deadline passed before execution'),
+                    output)
+                if ack_after_completion:
+                    self.ack(basic_deliver)
+            finally:
+                timing.activate(None)
+                if span is not None:
+                    span.finish('Deadline passed before execution')
+                self._track_in_flight(-1)
+
+        params = body.get('parameters', {})
+        self.scheduler.submit(
+            str(params.get('subcommand')),
+            run,
+            priority=getattr(properties, 'priority', None) or 0,
+            deadline=params.get('deadline'),
+            on_expired=expire,
+            host=params.get('server_name'))
+
+    def _track_in_flight(self, change):
+        """
+        Adjusts the count of accepted but unfinished messages.
+        """
+        with self._in_flight_lock:
+            self._in_flight += change
+
+    def _validate(self, body):
+        """
+        Checks the message parameters against the compiled schema for
+        its subcommand. Returns a copy of body whose parameters have
+        the referenced profile and defaults filled in.
+
+        Parameters:
+
+        * body: The message body structure
+        """
+        try:
+            params = body['parameters']
+            validator = self.validators[str(params['subcommand'])]
+        except (KeyError, TypeError):
+            raise DockerWorkerError(
+                'No valid subcommand given. Nothing to do!')
+        try:
+            if 'profile' in params:
+                try:
+                    profile = self.profiles[params['profile']]
+                except (KeyError, TypeError):
+                    raise ValidationError(
+                        'Unknown profile %s' % params['profile'])
+                params = profile.apply(params)
+            params = validator(params)
+            check_requirements(
+                validator.subcommand, docker.Client,
+                self._config.get('version'))
+        except ValidationError, ve:
+            raise DockerWorkerError(str(ve))
+        body = dict(body)
+        body['parameters'] = params
+        return body
+
+    def _execute(self, properties, body, output):
+        """
+        Runs the requested subcommand and sends the replies.
+
+        Parameters:
+
+        * properties: The properties of the message
+        * body: The message body structure
+        * output: The output object back to the user
+        """
+        corr_id = str(properties.correlation_id)
+        operation = None
+
+        # Replay the earlier reply if this message was already handled
+        if self._replay(properties):
+            return
+
+        if self.journal is not None:
+            self.journal.running(corr_id)
+
+        # High volume subcommands can skip the started reply and the
+        # success notification
+        quiet = str(body.get('parameters', {}).get(
+            'subcommand')) in self.quiet_subcommands
+
+        # Notify we are starting
+        if not quiet:
+            self.send(
+                properties.reply_to, corr_id, {'status': 'started'},
+                exchange='', **self._reply_options(properties))
+
+        try:
+            try:
+                subcommand = str(body['parameters']['subcommand'])
+                if subcommand not in self.subcommands:
+                    raise KeyError()
+            except KeyError:
+                raise DockerWorkerError(
+                    'No valid subcommand given. Nothing to do!')
+
+            cmd_method = None
+            subcommand
+            if subcommand == 'StopContainer':
+                cmd_method = self.stop_container
+            elif subcommand == 'RemoveContainer':
+                cmd_method = self.remove_container
+            elif subcommand == 'RemoveImage':
+                cmd_method = self.remove_image
+            elif subcommand == 'PullImage':
+                cmd_method = self.pull_image
+            elif subcommand == 'CreateContainer':
+                cmd_method = self.create_container
+            elif subcommand == 'StartContainer':
+                cmd_method = self.start_container
+            elif subcommand == 'ScaleContainers':
+                cmd_method = self.scale_containers
+            elif subcommand == 'ExecInContainer':
+                cmd_method = self.exec_in_container
+            elif subcommand == 'CopyToContainer':
+                cmd_method = self.copy_to_container
+            elif subcommand == 'BuildImage':
+                cmd_method = self.build_image
+            elif subcommand == 'ExportImage':
+                cmd_method = self.export_image
+            elif subcommand == 'ImportImage':
+                cmd_method = self.import_image
+            else:
+                self.app_logger.warn(
+                    'Could not find the implementation of subcommand %s' % (
+                        subcommand))
+                raise DockerWorkerError('No subcommand implementation')
+
+            operation = self._watch(corr_id, subcommand, properties, output)
+            self._replying.properties = properties
+            try:
+                with tracing.span(subcommand):
+                    result = cmd_method(body, corr_id, output)
+            finally:
+                self._replying.properties = None
+                self._unwatch(operation)
+            if operation is not None and operation.cancelled:
+                self.app_logger.info(
+                    'Dropping the late result of %s for correlation_id '
+                    '%s' % (subcommand, corr_id))
+                return
+            self._succeed(properties, corr_id, subcommand, result, quiet)
+
+        except DockerWorkerError, fwe:
+            if operation is not None and operation.cancelled:
+                # The watchdog already sent the failed reply
+                return
+            self._fail(properties, corr_id, fwe, output)
+        except requests.exceptions.Timeout, te:
+            # A client timeout set from the watchdog deadline fired
+            # before the watchdog gave up on the operation
+            if operation is not None and operation.cancelled:
+                return
+            self.app_logger.warn(
+                'Timed out handling correlation_id %s: %s' % (corr_id, te))
+            message = 'Docker host timed out'
+            if operation is not None and operation.deadline is not None:
+                message = '%s timed out after %s seconds' % (
+                    subcommand, operation.deadline)
+            self._fail(
+                properties, corr_id, DockerWorkerError(message), output,
+                reason='timeout')
+        except Exception, ex:
+            # A bug must not leave the requester without a reply
+            self.app_logger.exception(
+                'Unexpected error handling correlation_id %s' % corr_id)
+            if operation is not None and operation.cancelled:
+                return
+            self._fail(
+                properties, corr_id,
+                DockerWorkerError('Unexpected error: %s' % ex), output)
+
+    def _watch(self, corr_id, subcommand, properties, output):
+        """
+        Starts watching a subcommand on this thread when the watchdog is
+        enabled. Returns the Operation or None.
+        """
+        if self.watchdog is None:
+            return None
+        operation = self.watchdog.start(
+            corr_id, subcommand, (properties, output))
+        watchdog.activate(operation)
+        return operation
+
+    def _unwatch(self, operation):
+        """
+        Stops watching the operation of this thread, if any.
+        """
+        watchdog.activate(None)
+        if operation is not None:
+            self.watchdog.finish(operation)
+
+    def _on_overrun(self, operation):
+        """
+        Tells the requester an operation is past its deadline. Runs on
+        the watchdog thread.
+        """
+        properties = operation.context[0]
+        self.send(
+            properties.reply_to, operation.corr_id, {
+                'status': 'overrun',
+                'subcommand': operation.subcommand,
+                'deadline': operation.deadline,
+            }, exchange='', **self._reply_options(properties))
+
+    def _on_cancel(self, operation):
+        """
+        Fails an operation given up on by the watchdog. A result the
+        operation produces later is dropped. Runs on the watchdog
+        thread.
+        """
+        properties, output = operation.context
+        self._fail(
+            properties, operation.corr_id,
+            DockerWorkerError('%s timed out after %s seconds' % (
+                operation.subcommand, operation.deadline)),
+            output, reason='timeout')
+
+    def _succeed(self, properties, corr_id, subcommand, result, quiet):
+        """
+        Sends the completed reply and notification.
+
+        Parameters:
+
+        * properties: The properties of the message
+        * corr_id: The correlation id of the message
+        * subcommand: The subcommand which ran
+        * result: The structured result of the subcommand
+        * quiet: Skip the success notification
+        """
+        # Send results back
+        reply = self._with_timing({'status': 'completed', 'data': result})
+        self.send(
+            properties.reply_to, corr_id, reply, exchange='',
+            **self._reply_options(properties))
+        self._remember_reply(corr_id, reply)
+        self._journal_done(corr_id, 'completed')
+        # Notify on result. Not required but nice to do.
+        if not quiet:
+            self.notify(
+                'DockerWorker Executed Successfully',
+                'DockerWorker successfully executed %s. See logs.' % (
+                    subcommand),
+                'completed',
+                corr_id)
+
+        # Send out responses
+        self.app_logger.info(
+            'DockerWorker successfully executed %s for '
+            'correlation_id %s. See logs.' % (
+                subcommand, corr_id))
+
+    def _recover(self):
+        """
+        Resumes the operations a previous run of the worker left
+        unfinished in the journal.
+        """
+        for entry in self.journal.unfinished:
+            properties = pika.BasicProperties(
+                correlation_id=entry['corr_id'],
+                reply_to=entry['reply_to'],
+                content_type=entry.get('content_type'))
+            body = {'parameters': dict(
+                entry['params'], subcommand=entry['subcommand'])}
+
+            def run(entry=entry, properties=properties, body=body):
+                try:
+                    self._resume(entry, properties, body)
+                finally:
+                    self._track_in_flight(-1)
+
+            self.app_logger.info(
+                'Resuming %s for correlation_id %s from the journal' % (
+                    entry['subcommand'], entry['corr_id']))
+            # Resumed operations hold off a drain like any other
+            self._track_in_flight(1)
+            if self.scheduler is None:
+                run()
+            else:
+                self.scheduler.submit(
+                    entry['subcommand'], run,
+                    host=entry['params'].get('server_name'))
+
+    def _resume(self, entry, properties, body):
+        """
+        Finishes one journaled operation. Operations which never
+        started are run. Interrupted ones are reconciled with the
+        Docker host first so work already done is not repeated.
+
+        Parameters:
+
+        * entry: The journal entry
+        * properties: Properties standing in for the original message
+        * body: The message body structure
+        """
+        corr_id = str(entry['corr_id'])
+        subcommand = entry['subcommand']
+        if entry['phase'] == RUNNING:
+            if subcommand not in RESUMABLE:
+                self._fail(
+                    properties, corr_id,
+                    DockerWorkerError(
+                        'Interrupted by a worker restart; the outcome '
+                        'of %s is unknown' % subcommand),
+                    _NullOutput)
+                return
+            result = self._reconcile(subcommand, body['parameters'])
+            if result is not None:
+                self._succeed(properties, corr_id, subcommand, result,
+                              subcommand in self.quiet_subcommands)
+                return
+        self._execute(properties, body, _NullOutput)
+
+    def _reconcile(self, subcommand, params):
+        """
+        Returns the result of an interrupted CreateContainer or
+        StartContainer the Docker host shows as done, else None.
+
+        Parameters:
+
+        * subcommand: The subcommand which was interrupted
+        * params: The message parameters
+        """
+        if subcommand not in ('CreateContainer', 'StartContainer'):
+            return None
+        server_name = params['server_name']
+        container_name = params['container_name']
+        try:
+            client = self._create_client(server_name)
+            container = client.inspect_container(container_name)
+        except (docker.errors.APIError,
+                requests.exceptions.ConnectionError):
+            return None
+        if (subcommand == 'StartContainer' and
+                not container.get('State', {}).get('Running')):
+            return None
+        self.container_ids.set(
+            (server_name, container_name), container.get('Id'))
+        result = self._container_result(server_name, container_name)
+        if subcommand == 'CreateContainer':
+            result['warnings'] = None
+        return result
+
+    def _with_timing(self, reply):
+        """
+        Adds the active per-phase timing, in milliseconds, to a final
+        reply.
+
+        Parameters:
+
+        * reply: The final reply structure
+        """
+        trace = timing.current()
+        if trace is not None:
+            reply['timing'] = trace.as_dict()
+        return reply
+
+    def _fail(self, properties, corr_id, error, output, reason=None):
+        """
+        Logs a failure and sends the failed reply and notification.
+
+        Parameters:
+
+        * properties: The properties of the message
+        * corr_id: The correlation id of the message
+        * error: The DockerWorkerError describing the failure
+        * output: The output object back to the user
+        * reason: Optional machine readable cause added to the reply
+        """
+        # If a DockerWorkerError happens send a failure log it.
+        self.app_logger.error('Failure: %s' % error)
+
+        reply = self._with_timing({'status': 'failed'})
+        if reason is not None:
+            reply['reason'] = reason
+            reply['message'] = str(error)
+        self.send(
+            properties.reply_to, corr_id, reply, exchange='',
+            **self._reply_options(properties))
+        self._remember_reply(corr_id, reply)
+        self._journal_done(corr_id, 'failed')
+        self.notify(
+            'DockerWorker Failed',
+            str(error),
+            'failed',
+            corr_id)
+        output.error(str(error))
 
 
 def main():  # pragma: no cover
     from reworker.worker import runner
-    runner(DockerWorker)
+    DockerWorker.handle_signals = True
+    processes = parse_processes(sys.argv)
+    if processes > 1:
+        def child(index):
+            DockerWorker.process_index = index
+            runner(DockerWorker)
+        Supervisor(child, processes).run()
+    else:
+        runner(DockerWorker)
 
 
 if __name__ == '__main__':  # pragma nocover
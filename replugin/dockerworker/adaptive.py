@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Adaptive per host concurrency limits driven by Docker API latency.
+"""
+
+import logging
+import threading
+
+#: Latencies below this many seconds are not told apart
+LATENCY_FLOOR = 0.001
+
+
+def is_failure(error):
+    """
+    Returns True if error means the daemon is struggling. Client errors
+    such as a missing container are the caller's problem, not load.
+    """
+    if error is None:
+        return False
+    client_error = getattr(error, 'is_client_error', None)
+    if client_error is not None and client_error():
+        return False
+    return True
+
+
+class AdaptiveConcurrency(object):
+    """
+    Additive increase, multiplicative decrease of the in-flight limit of
+    each Docker host. Every window of calls to a host the limit grows by
+    increase while each API method stays within tolerance times its
+    baseline latency and the failure rate stays low, and is multiplied
+    by decrease otherwise. The limit only grows after windows in which
+    the host was running at its limit; a host with spare slots has no
+    use for more.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=64, increase=1,
+                 decrease=0.5, tolerance=2.0, max_error_rate=0.1,
+                 window=10, smoothing=0.2,
+                 ignore=('pull', 'stop', 'build', 'get_image', 'load_image',
+                         'put_archive'),
+                 on_change=None, logger=None):
+        """
+        Creates a new AdaptiveConcurrency.
+
+        Parameters:
+
+        * initial: Limit of a host before anything is observed
+        * minimum: Lowest limit a host is backed off to
+        * maximum: Highest limit a host grows to
+        * increase: Added to the limit after a healthy window
+        * decrease: Multiplies the limit after an unhealthy window
+        * tolerance: Latency over baseline times this is unhealthy
+        * max_error_rate: Failed call fraction over this is unhealthy
+        * window: Calls to a host between adjustments
+        * smoothing: Weight of a new sample in the latency average
+        * ignore: API methods whose latency is not a load signal, such
+          as pulls, builds, image transfers and archive uploads whose
+          duration depends on the amount of data
+        * on_change: Optional callable run after a limit changes
+        * logger: Optional logger for limit changes
+        """
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.smoothing = smoothing
+        self.ignore = frozenset(ignore or ())
+        self.on_change = on_change
+        self._logger = logger or logging.getLogger(
+            'replugin.dockerworker.adaptive')
+        self._lock = threading.Lock()
+        self._limits = {}
+        # (host, method) -> [average latency, baseline latency]
+        self._latency = {}
+        # host -> [calls, failures, slow, saturated] in the current window
+        self._windows = {}
+
+    def limit_for(self, host):
+        """
+        Returns the current in-flight limit of host.
+        """
+        return int(self._limits.get(host, self.initial))
+
+    def acquired(self, host, in_flight):
+        """
+        Records an operation starting on host and marks the current
+        window as saturated when host reached its limit.
+
+        Parameters:
+
+        * host: The Docker host the operation runs against
+        * in_flight: Operations running on host, including this one
+        """
+        with self._lock:
+            if in_flight >= self.limit_for(host):
+                self._windows.setdefault(
+                    host, [0, 0, False, False])[3] = True
+
+    def observe(self, host, method, seconds, error=None):
+        """
+        Records one Docker API call and adjusts the limit of host at the
+        end of each window.
+
+        Parameters:
+
+        * host: The Docker host called
+        * method: The client method name
+        * seconds: How long the call took
+        * error: The exception the call raised or None
+        """
+        if method in self.ignore:
+            return
+        failed = is_failure(error)
+        with self._lock:
+            window = self._windows.setdefault(host, [0, 0, False, False])
+            window[0] += 1
+            if failed:
+                window[1] += 1
+            else:
+                window[2] = self._sample(host, method, seconds) or window[2]
+            if window[0] < self.window:
+                return
+            del self._windows[host]
+            old = self._limits.get(host, float(self.initial))
+            unhealthy = window[2] or (
+                float(window[1]) / window[0] > self.max_error_rate)
+            if unhealthy:
+                new = max(float(self.minimum), old * self.decrease)
+            elif window[3]:
+                new = min(float(self.maximum), old + self.increase)
+            else:
+                new = old
+            self._limits[host] = new
+        if int(new) != int(old):
+            self._logger.info(
+                'Concurrency limit of %s %s from %s to %s' % (
+                    host, 'lowered' if new < old else 'raised',
+                    int(old), int(new)))
+            if self.on_change is not None:
+                self.on_change()
+
+    def _sample(self, host, method, seconds):
+        """
+        Adds a latency sample and returns True if the method is slow
+        compared to its baseline. Must be called holding the lock.
+        """
+        stats = self._latency.get((host, method))
+        if stats is None:
+            self._latency[(host, method)] = [seconds, seconds]
+            return False
+        stats[0] += (seconds - stats[0]) * self.smoothing
+        if stats[0] < stats[1]:
+            stats[1] = stats[0]
+        else:
+            # Let the baseline follow a lasting shift slowly
+            stats[1] += (stats[0] - stats[1]) * self.smoothing * 0.05
+        return stats[0] > max(stats[1], LATENCY_FLOOR) * self.tolerance
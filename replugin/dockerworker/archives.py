@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Image archives kept in a local directory.
+
+Archives are written and read in chunks, optionally gzip compressed,
+with a sha256sum compatible checksum file next to each archive.
+"""
+
+import gzip
+import hashlib
+import os
+import re
+import tempfile
+
+from replugin.dockerworker.streams import iter_read
+
+#: Bytes read or written at once
+CHUNK_SIZE = 1048576
+
+#: Suffix of the checksum file of an archive
+CHECKSUM_SUFFIX = '.sha256'
+
+_UNSAFE = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+def archive_name(image_name, compress=False):
+    """
+    Returns the archive file name of an image.
+
+    Parameters:
+
+    * image_name: The image reference
+    * compress: True for the name of a gzip compressed archive
+    """
+    name = _UNSAFE.sub('_', image_name) + '.tar'
+    if compress:
+        name += '.gz'
+    return name
+
+
+class _HashingFile(object):
+    """
+    Writes to a file while hashing and counting what was written.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.sha.update(data)
+        self.size += len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def tell(self):
+        return self.size
+
+
+def write_archive(chunks, path, compress=False):
+    """
+    Writes chunks to the archive at path and its checksum file. Both
+    are written to unique temporary files first, so concurrent writers
+    do not mix their data, and the archive only appears under path once
+    it is complete and its checksum is in place. Returns (image bytes,
+    stored bytes, sha256 of the stored archive).
+
+    Parameters:
+
+    * chunks: Iterable of strings, the image tar stream
+    * path: The archive file
+    * compress: Gzip the archive
+    """
+    directory, name = os.path.split(path)
+    tmp_paths = []
+
+    def temporary(mode):
+        fd, tmp_path = tempfile.mkstemp(
+            prefix='.%s.' % name, suffix='.tmp', dir=directory or '.')
+        tmp_paths.append(tmp_path)
+        return os.fdopen(fd, mode)
+
+    try:
+        with temporary('wb') as archive_file:
+            hashing = _HashingFile(archive_file)
+            writer = hashing
+            if compress:
+                # A fixed mtime keeps archives of the same image equal
+                writer = gzip.GzipFile(name[:-3], 'wb', 6, hashing, 0)
+            size = 0
+            for chunk in chunks:
+                writer.write(chunk)
+                size += len(chunk)
+            if compress:
+                writer.close()
+        digest = hashing.sha.hexdigest()
+        with temporary('w') as checksum_file:
+            checksum_file.write('%s  %s\n' % (digest, name))
+        os.rename(tmp_paths[1], path + CHECKSUM_SUFFIX)
+        os.rename(tmp_paths[0], path)
+    except Exception:
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+    return size, hashing.size, digest
+
+
+def file_digest(path, chunk_size=CHUNK_SIZE):
+    """
+    Returns the sha256 hex digest of a file, read in chunks.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as archive_file:
+        for data in iter_read(archive_file, chunk_size):
+            sha.update(data)
+    return sha.hexdigest()
+
+
+def read_checksum(path):
+    """
+    Returns the checksum recorded for the archive at path or None if
+    there is no checksum file.
+    """
+    try:
+        with open(path + CHECKSUM_SUFFIX, 'r') as checksum_file:
+            return checksum_file.read().split()[0]
+    except (IOError, OSError, IndexError):
+        return None
+
+
+def read_archive(path, chunk_size=CHUNK_SIZE):
+    """
+    Yields the image tar stream of an archive in chunks, decompressing
+    archives ending in .gz.
+
+    Parameters:
+
+    * path: The archive file
+    * chunk_size: Most bytes yielded at once
+    """
+    if path.endswith('.gz'):
+        archive_file = gzip.GzipFile(path, 'rb')
+    else:
+        archive_file = open(path, 'rb')
+    with archive_file:
+        for data in iter_read(archive_file, chunk_size):
+            yield data
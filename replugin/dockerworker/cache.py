@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Caches used by the Docker worker.
+"""
+
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class ResultCache(object):
+    """
+    Bounded LRU cache whose entries expire after a TTL. The cache can
+    optionally be persisted to a local JSON file so that it survives
+    a worker restart. Changes are written at most every flush_interval
+    seconds and at exit, never on every set. Failing to write the file
+    is logged and retried on the next write, never raised.
+    """
+
+    def __init__(self, size=1024, ttl=3600, path=None, clock=time.time,
+                 flush_interval=5.0, logger=None):
+        """
+        Creates a new ResultCache.
+
+        Parameters:
+
+        * size: Maximum number of entries to keep
+        * ttl: Seconds an entry stays valid
+        * path: Optional file to persist the cache to
+        * clock: Callable returning the current time in seconds
+        * flush_interval: Least seconds between writes of the file
+        * logger: Optional logger to report write failures to
+        """
+        self.size = int(size)
+        self.ttl = float(ttl)
+        self.path = path
+        self.flush_interval = float(flush_interval)
+        self._clock = clock
+        self._logger = logger or logging.getLogger(
+            'replugin.dockerworker.cache')
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = clock()
+        if self.path:
+            self.load()
+            atexit.register(self.flush)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key):
+        """
+        Returns the value stored for key or None if it is missing or
+        expired.
+        """
+        with self._lock:
+            try:
+                stored_at, value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if self._clock() - stored_at > self.ttl:
+                return None
+            # Re-insert to mark the entry as most recently used
+            self._entries[key] = (stored_at, value)
+            return value
+
+    def set(self, key, value):
+        """
+        Stores value under key, evicting the least recently used entry
+        if the cache is full.
+        """
+        with self._lock:
+            now = self._clock()
+            self._entries.pop(key, None)
+            self._entries[key] = (now, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+            self._dirty = True
+            due = now - self._saved_at >= self.flush_interval
+        if self.path and due:
+            self.save()
+
+    def flush(self):
+        """
+        Writes the persistence file if anything changed since the last
+        write.
+        """
+        if self.path and self._dirty:
+            self.save()
+
+    def discard(self, key):
+        """
+        Removes key from the cache if present.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def load(self):
+        """
+        Loads unexpired entries from the persistence file.
+        """
+        try:
+            with open(self.path, 'r') as cache_file:
+                data = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return
+        now = self._clock()
+        with self._lock:
+            for key, stored_at, value in data:
+                if now - stored_at <= self.ttl:
+                    self._entries[key] = (stored_at, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def save(self):
+        """
+        Atomically writes the cache to the persistence file through a
+        unique temporary file next to it. Only one thread writes at a
+        time and lookups are not held up meanwhile. Returns False if the
+        file could not be written.
+        """
+        with self._save_lock:
+            with self._lock:
+                data = [
+                    (key, stored_at, value)
+                    for key, (stored_at, value) in self._entries.items()]
+                self._dirty = False
+                self._saved_at = self._clock()
+            tmp_path = None
+            try:
+                directory, name = os.path.split(self.path)
+                fd, tmp_path = tempfile.mkstemp(
+                    prefix='.%s.' % name, suffix='.tmp',
+                    dir=directory or '.')
+                with os.fdopen(fd, 'w') as cache_file:
+                    json.dump(data, cache_file)
+                os.rename(tmp_path, self.path)
+                return True
+            except (IOError, OSError), ex:
+                self._logger.error(
+                    'Unable to save the cache to %s: %s' % (self.path, ex))
+                with self._lock:
+                    self._dirty = True
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                return False
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Optional msgpack encoding of message bodies. JSON stays the default;
+msgpack is only used when the msgpack module is installed and the
+message content_type asks for it.
+"""
+
+import imp
+import json
+
+from replugin.dockerworker.startup import LazyModule
+
+# msgpack is only imported once a msgpack body is seen
+try:
+    imp.find_module('msgpack')
+    msgpack = LazyModule('msgpack')
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+
+#: content types accepted as msgpack
+MSGPACK_TYPES = (MSGPACK, 'application/msgpack')
+
+
+class EncodingError(ValueError):
+    """
+    Raised when a body can not be decoded or encoded.
+    """
+    pass
+
+
+def is_msgpack(content_type):
+    """
+    Returns True if content_type asks for msgpack.
+    """
+    return content_type in MSGPACK_TYPES
+
+
+def reply_content_type(properties):
+    """
+    Returns the content type replies to a message should use: msgpack
+    when the request was msgpack and msgpack is available, else None
+    for the JSON default.
+
+    Parameters:
+
+    * properties: The properties of the request message
+    """
+    if msgpack is not None and is_msgpack(
+            getattr(properties, 'content_type', None)):
+        return MSGPACK
+    return None
+
+
+def decode(body, content_type):
+    """
+    Decodes a message body according to its content type.
+    """
+    if not is_msgpack(content_type):
+        try:
+            return json.loads(body)
+        except ValueError, ve:
+            raise EncodingError(str(ve))
+    if msgpack is None:
+        raise EncodingError('msgpack body received but msgpack is missing')
+    try:
+        try:
+            return msgpack.unpackb(body, raw=False)
+        except TypeError:
+            # msgpack < 0.5.2 has no raw keyword
+            return msgpack.unpackb(body, encoding='utf-8')
+    except Exception, ex:
+        raise EncodingError(str(ex))
+
+
+def encode(obj, content_type):
+    """
+    Encodes obj according to the content type. Python 2 str and unicode
+    are both packed as msgpack str so clients decoding with raw=False
+    get text back, not bytes.
+    """
+    if not is_msgpack(content_type):
+        return json.dumps(obj)
+    if msgpack is None:
+        raise EncodingError('msgpack requested but msgpack is missing')
+    try:
+        return msgpack.packb(obj, use_bin_type=False)
+    except TypeError:
+        # msgpack < 0.4 has no use_bin_type keyword
+        return msgpack.packb(obj)
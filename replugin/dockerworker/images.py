@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Helpers for Docker image references.
+"""
+
+#: Registry used for image names without a registry host
+DEFAULT_REGISTRY = 'docker.io'
+
+
+def split_reference(image_name):
+    """
+    Splits an image reference into (repository, tag, digest). Exactly
+    one of tag and digest is set; the tag defaults to latest.
+
+    Parameters:
+
+    * image_name: The image reference, such as registry:5000/app:1.0
+    """
+    if '@' in image_name:
+        repository, digest = image_name.split('@', 1)
+        return repository, None, digest
+    index = image_name.rfind(':')
+    if index > image_name.rfind('/'):
+        return image_name[:index], image_name[index + 1:], None
+    return image_name, 'latest', None
+
+
+def registry_host(image_name):
+    """
+    Returns the registry host an image is pulled from.
+
+    Parameters:
+
+    * image_name: The image reference
+    """
+    repository = split_reference(image_name)[0]
+    if '/' in repository:
+        first = repository.split('/', 1)[0]
+        if '.' in first or ':' in first or first == 'localhost':
+            return first
+    return DEFAULT_REGISTRY
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Append only journal of in-flight operations for crash recovery.
+"""
+
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+#: Phases an operation goes through
+ACCEPTED = 'accepted'
+RUNNING = 'running'
+DONE = 'done'
+
+
+class Journal(object):
+    """
+    Records each accepted operation, when it starts running and when
+    its final reply is sent as JSON lines. Operations left unfinished
+    by a crash are read back when the journal is opened.
+    """
+
+    def __init__(self, path, fsync=False, compact_after=1000):
+        """
+        Opens a journal, reading back unfinished operations.
+
+        Parameters:
+
+        * path: The journal file
+        * fsync: Sync every record to disk, not just to the OS
+        * compact_after: Rewrite the journal with only the open
+          operations once this many records were written
+        """
+        self.path = path
+        self.fsync = fsync
+        self.compact_after = int(compact_after)
+        self._lock = threading.Lock()
+        self._open = self._load()
+        self._records = 0
+        self._compact()
+        self._file = open(self.path, 'a')
+        #: operations found unfinished when the journal was opened
+        self.unfinished = [dict(entry) for entry in self._open.values()]
+
+    def _load(self):
+        """
+        Returns the unfinished operations in the journal file by
+        correlation id.
+        """
+        entries = OrderedDict()
+        try:
+            journal_file = open(self.path, 'r')
+        except (IOError, OSError):
+            return entries
+        with journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn final write from a crash
+                    continue
+                corr_id = record.get('corr_id')
+                if record.get('phase') == ACCEPTED:
+                    entries[corr_id] = record
+                elif corr_id in entries:
+                    if record.get('phase') == DONE:
+                        del entries[corr_id]
+                    else:
+                        entries[corr_id]['phase'] = record.get('phase')
+        return entries
+
+    def _compact(self):
+        """
+        Atomically rewrites the journal with only the open operations.
+        """
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as journal_file:
+            for entry in self._open.values():
+                json.dump(dict(entry, phase=ACCEPTED), journal_file)
+                journal_file.write('\n')
+                if entry.get('phase') != ACCEPTED:
+                    json.dump({
+                        'corr_id': entry['corr_id'],
+                        'phase': entry['phase'],
+                    }, journal_file)
+                    journal_file.write('\n')
+            journal_file.flush()
+            if self.fsync:
+                os.fsync(journal_file.fileno())
+        os.rename(tmp_path, self.path)
+
+    def _write(self, record):
+        """
+        Appends a record. Must be called holding the lock.
+        """
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._records += 1
+
+    def accepted(self, corr_id, subcommand, params, reply_to,
+                 content_type=None):
+        """
+        Records an operation accepted from the bus.
+
+        Parameters:
+
+        * corr_id: The correlation id of the message
+        * subcommand: The subcommand to run
+        * params: The validated message parameters
+        * reply_to: Where replies go
+        * content_type: The content type of the request
+        """
+        record = {
+            'corr_id': corr_id,
+            'phase': ACCEPTED,
+            'subcommand': subcommand,
+            'params': params,
+            'reply_to': reply_to,
+            'content_type': content_type,
+            'time': time.time(),
+        }
+        with self._lock:
+            self._open[corr_id] = dict(record)
+            self._write(record)
+
+    def running(self, corr_id):
+        """
+        Records that an operation started touching the Docker host.
+        """
+        with self._lock:
+            if corr_id in self._open:
+                self._open[corr_id]['phase'] = RUNNING
+                self._write({'corr_id': corr_id, 'phase': RUNNING})
+
+    def done(self, corr_id, status):
+        """
+        Records that the final reply of an operation was sent.
+
+        Parameters:
+
+        * corr_id: The correlation id of the message
+        * status: The status of the final reply
+        """
+        with self._lock:
+            if self._open.pop(corr_id, None) is None:
+                return
+            self._write({'corr_id': corr_id, 'phase': DONE, 'status': status})
+            if self._records >= self.compact_after:
+                self._file.close()
+                self._compact()
+                self._file = open(self.path, 'a')
+                self._records = 0
+
+    def close(self):
+        """
+        Closes the journal file.
+        """
+        with self._lock:
+            self._file.close()
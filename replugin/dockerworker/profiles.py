@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Named container profiles from the worker configuration.
+"""
+
+from replugin.dockerworker.validation import SCHEMAS, ValidationError
+
+#: Profile keys and the message parameter schema that checks them
+_PROFILE_KEYS = {
+    'image_name': SCHEMAS['CreateContainer']['image_name'][0],
+    'container_command': SCHEMAS['CreateContainer']['container_command'][0],
+    'container_ports': SCHEMAS['CreateContainer']['container_ports'][0],
+    'container_binds': SCHEMAS['StartContainer']['container_binds'][0],
+    'port_bindings': SCHEMAS['StartContainer']['port_bindings'][0],
+    'hostname_template': (basestring,),
+}
+
+
+class Profile(object):
+    """
+    A validated container profile whose parameters are prepared once
+    and merged under the parameters of each message using it.
+    """
+
+    __slots__ = ('name', 'params', 'hostname_template')
+
+    def __init__(self, name, conf):
+        """
+        Validates and compiles a profile.
+
+        Parameters:
+
+        * name: The name messages use to reference the profile
+        * conf: Mapping of profile keys to values
+        """
+        for key, value in conf.items():
+            if key not in _PROFILE_KEYS:
+                raise ValidationError(
+                    'Unknown key %s in profile %s' % (key, name))
+            if not isinstance(value, _PROFILE_KEYS[key]):
+                raise ValidationError(
+                    'Invalid %s in profile %s' % (key, name))
+        self.name = name
+        params = dict(conf)
+        self.hostname_template = params.pop('hostname_template', None)
+        ports = params.get('container_ports')
+        if ports is not None and not isinstance(ports, list):
+            params['container_ports'] = (
+                list(ports) if isinstance(ports, tuple) else [ports])
+        self.params = params
+
+    def apply(self, params):
+        """
+        Returns params with the profile filled in underneath. Values in
+        params override the profile.
+
+        Parameters:
+
+        * params: The message parameters
+        """
+        merged = dict(self.params)
+        if self.hostname_template and 'container_hostname' not in params:
+            if 'container_name' not in params:
+                # Filled per container, e.g. by ScaleContainers
+                merged['hostname_template'] = self.hostname_template
+                merged.update(params)
+                return merged
+            try:
+                merged['container_hostname'] = self.hostname_template.format(
+                    **params)
+            except (KeyError, IndexError, ValueError), ex:
+                raise ValidationError(
+                    'Unable to fill hostname for profile %s: %s' % (
+                        self.name, ex))
+        merged.update(params)
+        return merged
+
+
+def compile_profiles(conf):
+    """
+    Compiles the profiles section of the configuration into a mapping
+    of name to Profile. Raises ValidationError on a bad profile.
+
+    Parameters:
+
+    * conf: Mapping of profile name to profile keys
+    """
+    return dict(
+        (name, Profile(name, profile_conf))
+        for name, profile_conf in (conf or {}).items())
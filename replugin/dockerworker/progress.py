@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Parsing of the JSON progress streams returned by the Docker daemon.
+"""
+
+import json
+import re
+
+_DIGEST = re.compile(r'Digest: (\S+)')
+_decoder = json.JSONDecoder()
+
+
+def iter_events(chunks):
+    """
+    Yields each JSON object in a Docker progress stream. The daemon
+    may concatenate objects without separators and a chunk may end in
+    the middle of one.
+
+    Parameters:
+
+    * chunks: A string or an iterable of strings
+    """
+    if isinstance(chunks, basestring):
+        chunks = [chunks]
+    buf = ''
+    for chunk in chunks:
+        buf += chunk
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos >= len(buf):
+                break
+            try:
+                event, pos = _decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Incomplete object, wait for the next chunk
+                break
+            yield event
+        buf = buf[pos:]
+
+
+def stream_error(event):
+    """
+    Returns the error message of an event or None.
+    """
+    if 'error' in event:
+        return event.get('errorDetail', {}).get('message', event['error'])
+    return None
+
+
+def pull_summary(output):
+    """
+    Returns (digest, error) found in the output of a pull. Either may
+    be None.
+
+    Parameters:
+
+    * output: The string or chunks returned by the pull call
+    """
+    digest = error = None
+    if not isinstance(output, basestring) and not hasattr(output, '__iter__'):
+        return digest, error
+    for event in iter_events(output):
+        error = stream_error(event) or error
+        match = _DIGEST.match(event.get('status', ''))
+        if match:
+            digest = match.group(1)
+    return digest, error
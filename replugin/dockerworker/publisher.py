@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Batched publishing for the Docker worker.
+"""
+
+import logging
+import Queue
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class Publisher(object):
+    """
+    Queues publishes and acks from any thread and runs them in batches
+    on the I/O loop every flush interval. With confirms enabled the
+    channel is put in publisher confirm mode. Publishes are kept by
+    delivery tag until the broker confirms them; nacked ones, and
+    those still open when the channel is reopened, are published
+    again. Acks wait until every publish queued before them is
+    confirmed, so a request only leaves its queue once its reply is
+    safe with the broker.
+    """
+
+    def __init__(self, flush_interval=0.05, confirms=False, max_retries=5,
+                 logger=None):
+        """
+        Creates a new Publisher.
+
+        Parameters:
+
+        * flush_interval: Seconds between batches
+        * confirms: If publisher confirms should be requested
+        * max_retries: Times a nacked publish is sent again before it
+          is dropped
+        * logger: Optional logger to report problems to
+        """
+        self.flush_interval = float(flush_interval)
+        self.confirms = confirms
+        self.max_retries = int(max_retries)
+        self.logger = logger or logging.getLogger(
+            'replugin.dockerworker.publisher')
+        self.published = 0
+        self.confirmed = 0
+        self.nacked = 0
+        self.retried = 0
+        self._calls = Queue.Queue()
+        self._connection = None
+        self._timer_connection = None
+        self._flushed = threading.Condition()
+        self._pending = 0
+        self._seq = 0
+        # Sequence numbers of publishes not confirmed yet
+        self._open = set()
+        # Delivery tag -> (seq, func, args, kwargs, attempts)
+        self._unconfirmed = OrderedDict()
+        self._next_tag = 1
+        # Acks waiting for earlier publishes: (seq, func, args, kwargs)
+        self._held = []
+        # Publishes which failed to go out, sent again on reopen
+        self._unsent = []
+
+    @property
+    def unconfirmed(self):
+        """
+        Number of publishes the broker has not confirmed yet.
+        """
+        if not self.confirms:
+            return 0
+        return len(self._unconfirmed)
+
+    def put(self, func, *args, **kwargs):
+        """
+        Queues a call, such as an ack, for the next batch.
+        """
+        self._put(False, func, args, kwargs)
+
+    def publish(self, func, *args, **kwargs):
+        """
+        Queues a call which publishes one message for the next batch.
+        """
+        self._put(True, func, args, kwargs)
+
+    def _put(self, is_publish, func, args, kwargs, seq=None, attempts=0):
+        """
+        Adds a call to the queue.
+        """
+        with self._flushed:
+            self._pending += 1
+            if seq is None:
+                self._seq += 1
+                seq = self._seq
+                if is_publish and self.confirms:
+                    self._open.add(seq)
+        self._calls.put((is_publish, func, args, kwargs, seq, attempts))
+
+    def start(self, connection, channel):
+        """
+        Starts flushing batches on the connection I/O loop. Called
+        again when the channel is reopened, publishes the old channel
+        left unconfirmed are sent again.
+
+        Parameters:
+
+        * connection: The connection whose I/O loop runs the batches
+        * channel: The channel publishes go out on
+        """
+        self._connection = connection
+        if self.confirms:
+            self._next_tag = 1
+            unconfirmed = self._unconfirmed.values() + self._unsent
+            self._unconfirmed = OrderedDict()
+            self._unsent = []
+            for seq, func, args, kwargs, attempts in unconfirmed:
+                self._retry(seq, func, args, kwargs, attempts)
+            # Deliveries of the old channel can not be acked anymore;
+            # the broker redelivers them
+            self._held = []
+            channel.confirm_delivery(self.on_delivery_confirmation)
+        if self._timer_connection is not connection:
+            # One flush timer per connection
+            self._timer_connection = connection
+            connection.add_timeout(self.flush_interval, self._on_timer)
+
+    def flush(self):
+        """
+        Runs every queued call. Must be called on the I/O loop thread.
+        Returns the number of calls run.
+        """
+        count = 0
+        while True:
+            try:
+                (is_publish, func, args, kwargs,
+                 seq, attempts) = self._calls.get_nowait()
+            except Queue.Empty:
+                break
+            count += 1
+            if not is_publish and self._waits(seq):
+                self._held.append((seq, func, args, kwargs))
+                continue
+            try:
+                func(*args, **kwargs)
+            except Exception, ex:
+                self.logger.error('Unable to run queued publish: %s' % ex)
+                if is_publish and self.confirms:
+                    self._unsent.append((seq, func, args, kwargs, attempts))
+                continue
+            if is_publish and self.confirms:
+                self.published += 1
+                self._unconfirmed[self._next_tag] = (
+                    seq, func, args, kwargs, attempts)
+                self._next_tag += 1
+        with self._flushed:
+            self._pending -= count
+            self._flushed.notify_all()
+        return count
+
+    def _waits(self, seq):
+        """
+        Returns True if a publish queued before seq is unconfirmed.
+        """
+        with self._flushed:
+            return bool(self._open) and min(self._open) < seq
+
+    def _release(self):
+        """
+        Runs the held acks whose earlier publishes are all confirmed.
+        """
+        held, self._held = self._held, []
+        for seq, func, args, kwargs in held:
+            if self._waits(seq):
+                self._held.append((seq, func, args, kwargs))
+                continue
+            try:
+                func(*args, **kwargs)
+            except Exception, ex:
+                self.logger.error('Unable to run held call: %s' % ex)
+
+    def _retry(self, seq, func, args, kwargs, attempts):
+        """
+        Queues a publish again or drops it after max_retries.
+        """
+        if attempts >= self.max_retries:
+            self.logger.error(
+                'Dropping a message rejected %s times' % (attempts + 1))
+            with self._flushed:
+                self._open.discard(seq)
+            return
+        self.retried += 1
+        self._put(True, func, args, kwargs, seq, attempts + 1)
+
+    def wait_empty(self, timeout=None):
+        """
+        Blocks until every queued call has been flushed. Returns True
+        if the queue emptied before the timeout.
+        """
+        end = None
+        if timeout is not None:
+            end = time.time() + timeout
+        with self._flushed:
+            while self._pending:
+                remaining = None
+                if end is not None:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        break
+                self._flushed.wait(remaining)
+            return self._pending == 0
+
+    def on_delivery_confirmation(self, frame):
+        """
+        Handles Basic.Ack and Basic.Nack frames from the broker. A
+        single frame may confirm every publish up to its delivery tag.
+        Nacked publishes are queued again.
+        """
+        method = frame.method
+        tag = method.delivery_tag
+        if getattr(method, 'multiple', False):
+            tags = [t for t in self._unconfirmed if t <= tag]
+        else:
+            tags = [tag] if tag in self._unconfirmed else []
+        entries = [self._unconfirmed.pop(t) for t in tags]
+        if method.NAME.endswith('Nack'):
+            self.nacked += len(entries)
+            self.logger.error(
+                'Broker rejected %s published message(s)' % len(entries))
+            for entry in entries:
+                self._retry(*entry)
+        else:
+            self.confirmed += len(entries)
+            with self._flushed:
+                for entry in entries:
+                    self._open.discard(entry[0])
+        self._release()
+
+    def _on_timer(self):
+        """
+        Flushes a batch and reschedules the next one.
+        """
+        self.flush()
+        self._release()
+        self._timer_connection.add_timeout(
+            self.flush_interval, self._on_timer)
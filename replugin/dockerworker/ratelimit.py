@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Per-registry throttling of image pulls.
+"""
+
+import threading
+
+from contextlib import contextmanager
+
+from replugin.dockerworker import timing
+
+#: Registry key whose limits apply to registries not listed
+ANY_REGISTRY = '*'
+
+
+class TokenBucket(object):
+    """
+    Allows rate operations per second on average with bursts of up to
+    burst operations.
+    """
+
+    def __init__(self, rate, burst=None, clock=timing.clock,
+                 sleep=None):
+        """
+        Creates a new full TokenBucket.
+
+        Parameters:
+
+        * rate: Tokens added per second
+        * burst: Most tokens the bucket holds, defaults to max(1, rate)
+        * clock: Callable returning the current time in seconds
+        * sleep: Callable used to wait, defaults to an Event wait
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, self.rate))
+        self._clock = clock
+        self._sleep = sleep or threading.Event().wait
+        self._tokens = self.burst
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """
+        Takes a token and returns the seconds to wait before using it.
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """
+        Waits until a token is available and takes it.
+        """
+        wait = self._reserve()
+        if wait > 0:
+            self._sleep(wait)
+
+
+class RegistryLimit(object):
+    """
+    The pull limits of one registry: a cap on concurrent pulls and an
+    optional TokenBucket on pulls per second.
+    """
+
+    def __init__(self, concurrency=None, rate=None, burst=None):
+        """
+        Creates a new RegistryLimit.
+
+        Parameters:
+
+        * concurrency: Most pulls at the same time, None for no cap
+        * rate: Pulls started per second, None for no rate limit
+        * burst: Pulls which may start at once under the rate limit
+        """
+        self.concurrency = concurrency
+        self._slots = None
+        if concurrency:
+            self._slots = threading.Semaphore(int(concurrency))
+        self.bucket = None
+        if rate:
+            self.bucket = TokenBucket(rate, burst)
+
+    def acquire(self):
+        """
+        Waits for a pull slot and token.
+        """
+        if self._slots is not None:
+            self._slots.acquire()
+        if self.bucket is not None:
+            self.bucket.acquire()
+
+    def release(self):
+        """
+        Gives back the pull slot.
+        """
+        if self._slots is not None:
+            self._slots.release()
+
+
+class RegistryLimiter(object):
+    """
+    Pull limits per registry host, shared by every Docker host the
+    worker drives. Pulls over a limit wait for their turn.
+    """
+
+    def __init__(self, conf):
+        """
+        Creates a new RegistryLimiter.
+
+        Parameters:
+
+        * conf: Mapping of registry host, or * for any other registry,
+          to a dict with optional concurrency, rate and burst keys
+        """
+        self.limits = dict(
+            (registry, RegistryLimit(
+                concurrency=limit_conf.get('concurrency'),
+                rate=limit_conf.get('rate'),
+                burst=limit_conf.get('burst')))
+            for registry, limit_conf in (conf or {}).items())
+
+    def limit_for(self, registry):
+        """
+        Returns the RegistryLimit of registry or None.
+        """
+        return self.limits.get(registry, self.limits.get(ANY_REGISTRY))
+
+    @contextmanager
+    def slot(self, registry):
+        """
+        Holds a pull slot for registry for the enclosed block. Time spent
+        waiting is recorded as the throttled phase.
+
+        Parameters:
+
+        * registry: The registry host being pulled from
+        """
+        limit = self.limit_for(registry)
+        if limit is None:
+            yield
+            return
+        with timing.phase('throttled'):
+            limit.acquire()
+        try:
+            yield
+        finally:
+            limit.release()
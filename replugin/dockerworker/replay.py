@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Replays recorded bus messages against the worker to measure capacity.
+
+Run ``python -m replugin.dockerworker.replay trace.jsonl -c config.json``
+to feed each message of the trace to DockerWorker.process at its
+recorded offset (scaled by --speed) through a fake channel, with a
+local stand-in for the Docker API, and print throughput, latency
+percentiles and the failure mix.
+
+Each trace line is either a message body or an object with body,
+timestamp (epoch seconds) and optional properties (correlation_id,
+reply_to, priority, content_type) keys.
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+
+from StringIO import StringIO
+
+import pika
+
+from replugin.dockerworker import DockerWorker, docker, timing
+
+
+def read_trace(lines):
+    """
+    Parses trace lines into a list of (offset, body, properties) sorted
+    by offset, where offset is the seconds since the first message.
+
+    Parameters:
+
+    * lines: An iterable of JSON strings
+    """
+    records = []
+    for number, line in enumerate(lines):
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        if 'body' not in record:
+            record = {'body': record}
+        props = dict(record.get('properties') or {})
+        props.setdefault('correlation_id', 'replay-%s' % number)
+        props.setdefault('reply_to', 'replay')
+        records.append((record.get('timestamp'), record['body'], props))
+    stamps = [r[0] for r in records if r[0] is not None]
+    start = min(stamps) if stamps else 0
+    return sorted((
+        ((stamp - start if stamp is not None else 0.0), body, props)
+        for stamp, body, props in records), key=lambda record: record[0])
+
+
+def percentile(values, pct):
+    """
+    Returns the nearest rank percentile of sorted values, or None.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class _Response(object):
+    """
+    The parts of a requests response docker.errors.APIError reads.
+    """
+
+    def __init__(self, status_code, reason):
+        self.status_code = status_code
+        self.reason = reason
+        self.content = ''
+
+
+class FakeDockerHost(object):
+    """
+    In memory state of one stand-in Docker host.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.images = set()
+        self.containers = {}
+
+
+class FakeDockerClient(object):
+    """
+    Stand-in for docker.Client which answers the calls the worker makes
+    from FakeDockerHost state after a simulated latency.
+    """
+
+    def __init__(self, host, latency=0.01, error_rate=0.0, rng=None):
+        """
+        Creates a new FakeDockerClient.
+
+        Parameters:
+
+        * host: The FakeDockerHost to operate on
+        * latency: Mean seconds each call takes
+        * error_rate: Fraction of calls failing with a server error
+        * rng: Optional random.Random for reproducible runs
+        """
+        self._host = host
+        self._latency = latency
+        self._error_rate = error_rate
+        self._rng = rng or random.Random()
+
+    def _call(self):
+        """
+        Sleeps for the simulated latency and injects server errors.
+        """
+        if self._latency:
+            time.sleep(self._latency * self._rng.uniform(0.5, 1.5))
+        if self._error_rate and self._rng.random() < self._error_rate:
+            raise self._error(500, 'Internal Server Error')
+
+    def _error(self, status_code, reason):
+        return docker.errors.APIError(
+            reason, _Response(status_code, reason))
+
+    def _find(self, ref):
+        """
+        Returns the name of the container with name or ID ref.
+        """
+        if ref in self._host.containers:
+            return ref
+        for name, container in self._host.containers.items():
+            if container['Id'] == ref:
+                return name
+        raise self._error(404, 'Not Found')
+
+    def containers(self, all=False):
+        self._call()
+        with self._host.lock:
+            return [
+                {'Names': ['/' + name], 'Id': c['Id'], 'Status': c['Status']}
+                for name, c in self._host.containers.items()
+                if all or c['Status'].startswith('Up')]
+
+    def pull(self, image_name, stream=False, insecure_registry=False):
+        self._call()
+        with self._host.lock:
+            self._host.images.add(image_name)
+        output = json.dumps(
+            {'status': 'Digest: sha256:%s' % uuid.uuid4().hex})
+        if stream:
+            return iter([output])
+        return output
+
+    def inspect_image(self, image_name):
+        self._call()
+        with self._host.lock:
+            if image_name not in self._host.images:
+                raise self._error(404, 'Not Found')
+        return {'Id': image_name}
+
+    def remove_image(self, image_name):
+        self._call()
+        with self._host.lock:
+            if image_name not in self._host.images:
+                raise self._error(404, 'Not Found')
+            self._host.images.discard(image_name)
+
+    def create_container(self, image, name=None, **kwargs):
+        self._call()
+        with self._host.lock:
+            if name in self._host.containers:
+                raise self._error(409, 'Conflict')
+            container_id = uuid.uuid4().hex
+            self._host.containers[name] = {
+                'Id': container_id, 'Status': 'Created'}
+        return {'Id': container_id, 'Warnings': None}
+
+    def start(self, ref, **kwargs):
+        self._call()
+        with self._host.lock:
+            self._host.containers[self._find(ref)]['Status'] = 'Up'
+
+    def stop(self, ref, timeout=10):
+        self._call()
+        with self._host.lock:
+            self._host.containers[self._find(ref)]['Status'] = 'Exited (0)'
+
+    def remove_container(self, ref):
+        self._call()
+        with self._host.lock:
+            del self._host.containers[self._find(ref)]
+
+    def exec_create(self, ref, cmd, **kwargs):
+        self._call()
+        with self._host.lock:
+            if not self._host.containers[
+                    self._find(ref)]['Status'].startswith('Up'):
+                raise self._error(409, 'Conflict')
+        return {'Id': uuid.uuid4().hex}
+
+    def exec_start(self, exec_id, **kwargs):
+        self._call()
+        return StringIO('')
+
+    def exec_inspect(self, exec_id):
+        return {'ExitCode': 0}
+
+    def build(self, fileobj=None, tag=None, **kwargs):
+        self._call()
+        for _ in fileobj:
+            pass
+        with self._host.lock:
+            self._host.images.add(tag)
+        return json.dumps({'stream': 'Successfully built %s\n' % tag})
+
+    def get_image(self, image_name):
+        self._call()
+        with self._host.lock:
+            if image_name not in self._host.images:
+                raise self._error(404, 'Not Found')
+        return StringIO(image_name)
+
+    def load_image(self, data):
+        self._call()
+        image_name = ''.join(data)
+        with self._host.lock:
+            self._host.images.add(image_name)
+
+    def put_archive(self, ref, path, data):
+        self._call()
+        with self._host.lock:
+            self._find(ref)
+        for _ in data:
+            pass
+        return True
+
+
+class FakeChannel(object):
+    """
+    Channel which records acks and rejects and accepts everything else.
+    """
+
+    def __init__(self):
+        self.consumer_tags = []
+        self.acks = 0
+        self.rejects = 0
+
+    def basic_ack(self, *args, **kwargs):
+        self.acks += 1
+
+    def basic_reject(self, *args, **kwargs):
+        self.rejects += 1
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class FakeConnection(object):
+    """
+    Connection whose timeouts are run by Replay in its I/O loop.
+    """
+
+    def __init__(self):
+        self.timers = []
+        self._counter = itertools.count()
+
+    def add_timeout(self, delay, callback):
+        handle = next(self._counter)
+        heapq.heappush(self.timers, (time.time() + delay, handle, callback))
+        return handle
+
+    def run_due(self):
+        """
+        Runs the callbacks whose time has come.
+        """
+        while self.timers and self.timers[0][0] <= time.time():
+            heapq.heappop(self.timers)[2]()
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class _Output(object):
+    """
+    Output object collecting the errors reported for one message.
+    """
+
+    def __init__(self):
+        self.errors = []
+
+    def error(self, msg):
+        self.errors.append(msg)
+
+    def info(self, msg):
+        pass
+
+
+class ReplayWorker(DockerWorker):
+    """
+    DockerWorker using stand-in Docker hosts and recording final replies.
+    It never connects to a broker: the base worker is handed a
+    FakeConnection instead.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.latency = kwargs.pop('latency', 0.01)
+        self.error_rate = kwargs.pop('error_rate', 0.0)
+        self.rng = random.Random(kwargs.pop('seed', None))
+        select_connection = pika.SelectConnection
+        pika.SelectConnection = lambda *args, **kwargs: FakeConnection()
+        try:
+            DockerWorker.__init__(self, *args, **kwargs)
+        finally:
+            pika.SelectConnection = select_connection
+        self.fake_hosts = {}
+        self.replies = {}
+        self._replies_lock = threading.Lock()
+
+    def _create_client(self, server_name):
+        host = self.fake_hosts.setdefault(server_name, FakeDockerHost())
+        return timing.TimedClient(FakeDockerClient(
+            host, self.latency, self.error_rate, self.rng),
+            self._observer(server_name))
+
+    def send(self, topic, corr_id, message_struct, *args, **kwargs):
+        status = message_struct.get('status')
+        if status in ('completed', 'failed'):
+            with self._replies_lock:
+                self.replies.setdefault(corr_id, (time.time(), status))
+        return DockerWorker.send(
+            self, topic, corr_id, message_struct, *args, **kwargs)
+
+    def notify(self, *args, **kwargs):
+        pass
+
+
+class Replay(object):
+    """
+    Feeds a trace to a ReplayWorker and measures the replies.
+    """
+
+    def __init__(self, worker, trace, speed=1.0, timeout=60):
+        """
+        Creates a new Replay.
+
+        Parameters:
+
+        * worker: The ReplayWorker to drive
+        * trace: Records from read_trace
+        * speed: Replay speed multiplier, 0 sends everything at once
+        * timeout: Seconds to wait for outstanding replies at the end
+        """
+        self.worker = worker
+        self.trace = trace
+        self.speed = speed
+        self.timeout = timeout
+        self.channel = FakeChannel()
+        self.connection = FakeConnection()
+
+    def run(self):
+        """
+        Replays the trace and returns the report from report().
+        """
+        worker = self.worker
+        worker._on_open(self.connection)
+        worker._on_channel_open(self.channel)
+        sent = {}
+        outputs = {}
+        started = time.time()
+        pending = list(self.trace)
+        pending.reverse()
+        deadline = None
+        while True:
+            now = time.time()
+            while pending and (
+                    not self.speed or
+                    started + pending[-1][0] / self.speed <= now):
+                _, body, props = pending.pop()
+                corr_id = str(props['correlation_id'])
+                output = outputs[corr_id] = _Output()
+                deliver = pika.spec.Basic.Deliver(
+                    delivery_tag=len(sent) + 1)
+                sent[corr_id] = (time.time(), body)
+                worker.process(
+                    self.channel, deliver, pika.BasicProperties(**props),
+                    body, output)
+            self.connection.run_due()
+            if not pending:
+                if len(worker.replies) >= len(sent):
+                    break
+                if deadline is None:
+                    deadline = time.time() + self.timeout
+                elif time.time() > deadline:
+                    break
+            time.sleep(0.001)
+        if worker.scheduler is not None:
+            worker.scheduler.stop()
+        if worker.publisher is not None:
+            worker.publisher.flush()
+        return self.report(sent, outputs, time.time() - started)
+
+    def report(self, sent, outputs, duration):
+        """
+        Summarises a run.
+
+        Parameters:
+
+        * sent: Mapping of correlation id to (send time, body)
+        * outputs: Mapping of correlation id to its _Output
+        * duration: Seconds the run took
+        """
+        latencies = []
+        failures = {}
+        completed = failed = 0
+        for corr_id, (sent_at, body) in sent.items():
+            reply = self.worker.replies.get(corr_id)
+            if reply is None:
+                continue
+            latencies.append(reply[0] - sent_at)
+            if reply[1] == 'completed':
+                completed += 1
+                continue
+            failed += 1
+            try:
+                subcommand = body['parameters']['subcommand']
+            except (KeyError, TypeError):
+                subcommand = 'Unknown'
+            errors = outputs[corr_id].errors
+            key = '%s: %s' % (subcommand, errors[-1] if errors else 'failed')
+            failures[key] = failures.get(key, 0) + 1
+        latencies.sort()
+        answered = completed + failed
+        return {
+            'messages': len(sent),
+            'completed': completed,
+            'failed': failed,
+            'unanswered': len(sent) - answered,
+            'duration': duration,
+            'throughput': answered / duration if duration else 0.0,
+            'latency': dict(
+                ('p%s' % pct, percentile(latencies, pct))
+                for pct in (50, 90, 99, 100)),
+            'failures': failures,
+        }
+
+
+def format_report(report):
+    """
+    Returns a report from Replay.run as printable text.
+    """
+    lines = [
+        'messages %(messages)s completed %(completed)s failed %(failed)s '
+        'unanswered %(unanswered)s' % report,
+        'duration %.2fs throughput %.1f msg/s' % (
+            report['duration'], report['throughput']),
+    ]
+    latency = report['latency']
+    if latency['p50'] is not None:
+        lines.append(
+            'latency p50 %.1fms p90 %.1fms p99 %.1fms max %.1fms' % tuple(
+                latency[key] * 1000 for key in ('p50', 'p90', 'p99', 'p100')))
+    for key, count in sorted(
+            report['failures'].items(), key=lambda item: -item[1]):
+        lines.append('  %6d  %s' % (count, key))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay recorded bus messages against the worker.')
+    parser.add_argument('trace', help='JSON lines file of recorded messages')
+    parser.add_argument(
+        '-c', '--config', required=True, help='Worker configuration file')
+    parser.add_argument(
+        '--speed', type=float, default=1.0,
+        help='Replay speed multiplier, 0 sends everything at once')
+    parser.add_argument(
+        '--latency', type=float, default=0.01,
+        help='Mean seconds per stand-in Docker API call')
+    parser.add_argument(
+        '--error-rate', type=float, default=0.0,
+        help='Fraction of Docker API calls failing')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument(
+        '-v', '--verbose', action='store_true', help='Show worker logs')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.CRITICAL)
+    with open(args.trace, 'r') as trace_file:
+        trace = read_trace(trace_file)
+    worker = ReplayWorker(
+        {'server': '127.0.0.1', 'port': 5672, 'vhost': '/',
+         'user': 'guest', 'password': 'guest'},
+        config_file=args.config,
+        logger=logging.getLogger('replay'),
+        latency=args.latency,
+        error_rate=args.error_rate,
+        seed=args.seed)
+    print format_report(
+        Replay(worker, trace, args.speed, args.timeout).run())
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
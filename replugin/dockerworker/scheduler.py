@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Scheduling of subcommands onto worker threads.
+"""
+
+import contextlib
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+_local = threading.local()
+
+#: Lanes used when scheduling is enabled without an explicit layout. A
+#: lane's reserved_per_host slots on each host are only used by that
+#: lane, so stops are not held up by a host full of pulls.
+DEFAULT_LANES = {
+    'fast': {
+        'concurrency': 4,
+        'reserved_per_host': 1,
+        'subcommands': [
+            'StopContainer', 'StartContainer', 'RemoveContainer'],
+    },
+    'slow': {
+        'concurrency': 2,
+        'subcommands': [
+            'PullImage', 'CreateContainer', 'RemoveImage',
+            'ScaleContainers', 'ExecInContainer', 'CopyToContainer',
+            'BuildImage', 'ExportImage', 'ImportImage'],
+    },
+}
+
+
+def run_parallel(funcs, limit):
+    """
+    Runs callables on at most limit threads and waits for all of them.
+    Returns a list of (result, exception) in the order of funcs.
+
+    Parameters:
+
+    * funcs: List of callables taking no arguments
+    * limit: The most callables to run at the same time
+    """
+    results = [None] * len(funcs)
+    jobs = iter(enumerate(funcs))
+    lock = threading.Lock()
+
+    def loop():
+        while True:
+            with lock:
+                try:
+                    index, func = next(jobs)
+                except StopIteration:
+                    return
+            try:
+                results[index] = (func(), None)
+            except Exception, ex:
+                results[index] = (None, ex)
+
+    threads = []
+    for _ in range(max(1, min(int(limit), len(funcs)))):
+        thread = threading.Thread(target=loop)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class HostLimits(object):
+    """
+    Caps the number of in-flight operations per Docker host. Not thread
+    safe on its own; callers hold the scheduler condition.
+    """
+
+    def __init__(self, limit=None, overrides=None, adaptive=None):
+        """
+        Creates a new HostLimits.
+
+        Parameters:
+
+        * limit: Default in-flight cap per host, None for no cap
+        * overrides: Optional mapping of host to its own cap
+        * adaptive: Optional AdaptiveConcurrency deciding the cap of
+          hosts without an override
+        """
+        self.limit = limit
+        self.overrides = overrides or {}
+        self.adaptive = adaptive
+        self.in_flight = {}
+
+    def limit_for(self, host):
+        """
+        Returns the cap for host or None when it is not capped.
+        """
+        if host is None:
+            return None
+        if self.adaptive is not None and host not in self.overrides:
+            return self.adaptive.limit_for(host)
+        return self.overrides.get(host, self.limit)
+
+    def available(self, host):
+        """
+        Returns True if another operation may start on host.
+        """
+        limit = self.limit_for(host)
+        return limit is None or self.in_flight.get(host, 0) < limit
+
+    def acquire(self, host):
+        """
+        Records an operation starting on host.
+        """
+        count = self.in_flight.get(host, 0) + 1
+        self.in_flight[host] = count
+        if (self.adaptive is not None and host is not None and
+                host not in self.overrides):
+            self.adaptive.acquired(host, count)
+
+    def release(self, host):
+        """
+        Records an operation on host finishing.
+        """
+        count = self.in_flight.get(host, 0) - 1
+        if count > 0:
+            self.in_flight[host] = count
+        else:
+            self.in_flight.pop(host, None)
+
+
+class Lane(object):
+    """
+    A scheduling class with its own concurrency budget. Jobs are queued
+    per Docker host. The next job is the best one, highest priority
+    then earliest deadline, among hosts below their in-flight cap;
+    ties go to the host served least recently so a deep backlog on one
+    host cannot starve the others. Jobs whose deadline passes while
+    queued are expired instead of run. A lane may reserve slots on
+    every host on top of the shared cap, which it uses once the host
+    is at its cap.
+    """
+
+    def __init__(self, name, concurrency, limits=None, cond=None,
+                 clock=time.time, reserved_per_host=0):
+        """
+        Creates a new Lane and starts its threads.
+
+        Parameters:
+
+        * name: The name of the lane
+        * concurrency: How many jobs may run at the same time
+        * limits: Optional HostLimits shared with other lanes
+        * cond: Optional threading.Condition shared with other lanes
+        * clock: Callable returning the current time in seconds
+        * reserved_per_host: Slots per host only this lane uses, on top
+          of the shared cap
+        """
+        self.name = name
+        self.concurrency = int(concurrency)
+        self.limits = limits or HostLimits()
+        self.reserved_per_host = int(reserved_per_host or 0)
+        # host -> reserved slots in use
+        self._reserved = {}
+        self._cond = cond or threading.Condition()
+        self._clock = clock
+        self._queues = {}
+        self._served = {}
+        self._counter = itertools.count()
+        self._running = 0
+        self._stopped = False
+        self._retire = 0
+        self._logger = logging.getLogger('replugin.dockerworker.scheduler')
+        self._threads = []
+        self._add_threads(self.concurrency)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def running(self):
+        """
+        Number of jobs currently executing.
+        """
+        return self._running
+
+    def submit(self, func, priority=0, deadline=None, on_expired=None,
+               host=None):
+        """
+        Queues a job.
+
+        Parameters:
+
+        * func: Callable to run
+        * priority: Higher values run first
+        * deadline: Optional epoch time the job must start by
+        * on_expired: Optional callable run instead of func if the
+          deadline has passed
+        * host: Optional Docker host the job operates on
+        """
+        if deadline is None:
+            deadline = float('inf')
+        with self._cond:
+            heapq.heappush(self._queues.setdefault(host, []), (
+                -int(priority or 0), deadline, next(self._counter),
+                func, on_expired))
+            self._served.setdefault(host, -1)
+            self._cond.notify_all()
+
+    def resize(self, concurrency):
+        """
+        Changes the concurrency budget. Extra threads are started right
+        away; surplus threads exit after their current job.
+
+        Parameters:
+
+        * concurrency: How many jobs may run at the same time
+        """
+        concurrency = int(concurrency)
+        with self._cond:
+            change = concurrency - self.concurrency
+            self.concurrency = concurrency
+            if change < 0:
+                self._retire -= change
+                self._cond.notify_all()
+            else:
+                # Cancel pending retirements before adding threads
+                cancelled = min(change, self._retire)
+                self._retire -= cancelled
+                self._add_threads(change - cancelled)
+
+    def stop(self):
+        """
+        Stops the lane threads once the queue is empty.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Waits for the lane threads to exit after stop().
+        """
+        for thread in list(self._threads):
+            thread.join(timeout)
+
+    def _add_threads(self, count):
+        """
+        Starts count more lane threads.
+        """
+        for _ in range(count):
+            thread = threading.Thread(
+                target=self._loop,
+                name='%s-lane-%s' % (self.name, len(self._threads)))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_job(self):
+        """
+        Pops the next runnable job. Must be called holding the
+        condition. Returns (host, job) or None.
+        """
+        best = None
+        for host, queue in self._queues.items():
+            if not (self.limits.available(host) or
+                    self._reserve_available(host)):
+                continue
+            key = (queue[0][0], queue[0][1], self._served[host])
+            if best is None or key < best[0]:
+                best = (key, host)
+        if best is None:
+            return None
+        host = best[1]
+        queue = self._queues[host]
+        job = heapq.heappop(queue)
+        if not queue:
+            del self._queues[host]
+            del self._served[host]
+        else:
+            self._served[host] = next(self._counter)
+        return host, job
+
+    def _reserve_available(self, host):
+        """
+        Returns True if a reserved slot on host is free. Must be called
+        holding the condition.
+        """
+        return (host is not None and
+                self._reserved.get(host, 0) < self.reserved_per_host)
+
+    def _loop(self):
+        """
+        Thread body pulling jobs from the queue.
+        """
+        while True:
+            with self._cond:
+                picked = None
+                while picked is None:
+                    if self._retire:
+                        self._retire -= 1
+                        self._threads.remove(threading.current_thread())
+                        return
+                    picked = self._next_job()
+                    if picked is None:
+                        if self._stopped and not self._queues:
+                            return
+                        self._cond.wait()
+                host, (_, deadline, _, func, on_expired) = picked
+                reserved = not self.limits.available(host)
+                if reserved:
+                    self._reserved[host] = self._reserved.get(host, 0) + 1
+                else:
+                    self.limits.acquire(host)
+                self._running += 1
+            _local.reserved = reserved
+            try:
+                if deadline < self._clock():
+                    if on_expired is not None:
+                        on_expired()
+                else:
+                    func()
+            except Exception:
+                self._logger.exception(
+                    'Unhandled error in %s lane job' % self.name)
+            finally:
+                _local.reserved = False
+                with self._cond:
+                    if reserved:
+                        self._reserved[host] -= 1
+                        if not self._reserved[host]:
+                            del self._reserved[host]
+                    else:
+                        self.limits.release(host)
+                    self._running -= 1
+                    self._cond.notify_all()
+
+
+class LaneScheduler(object):
+    """
+    Routes subcommands to the Lane they are configured for. All lanes
+    share one set of per host in-flight caps.
+    """
+
+    def __init__(self, lanes=None, default_lane='slow', host_limit=None,
+                 host_overrides=None, adaptive=None):
+        """
+        Creates a new LaneScheduler.
+
+        Parameters:
+
+        * lanes: Mapping of lane name to a dict with concurrency,
+          subcommands and optionally reserved_per_host keys
+        * default_lane: Lane used for subcommands not listed in any lane
+        * host_limit: Default in-flight cap per Docker host
+        * host_overrides: Optional mapping of host to its own cap
+        * adaptive: Optional AdaptiveConcurrency for the host caps
+        """
+        if not isinstance(lanes, dict):
+            lanes = DEFAULT_LANES
+        self.limits = HostLimits(host_limit, host_overrides, adaptive)
+        if adaptive is not None:
+            adaptive.on_change = self.wake
+        self._cond = threading.Condition()
+        self.lanes = {}
+        self._routes = {}
+        for name, lane_conf in lanes.items():
+            self.lanes[name] = Lane(
+                name, lane_conf.get('concurrency', 1),
+                limits=self.limits, cond=self._cond,
+                reserved_per_host=lane_conf.get('reserved_per_host', 0))
+            for subcommand in lane_conf.get('subcommands', []):
+                self._routes[subcommand] = name
+        if default_lane not in self.lanes:
+            default_lane = sorted(self.lanes.keys())[0]
+        self.default_lane = default_lane
+
+    @property
+    def in_flight(self):
+        """
+        Number of jobs queued or running across every lane.
+        """
+        with self._cond:
+            return sum(
+                len(lane) + lane.running for lane in self.lanes.values())
+
+    def reconfigure(self, lanes=None, host_limit=None, host_overrides=None):
+        """
+        Applies new concurrency settings without dropping queued jobs.
+        Lanes missing from the new layout keep their current size.
+
+        Parameters:
+
+        * lanes: Mapping of lane name to a dict with a concurrency key
+        * host_limit: Default in-flight cap per Docker host
+        * host_overrides: Optional mapping of host to its own cap
+        """
+        if isinstance(lanes, dict):
+            for name, lane_conf in lanes.items():
+                if name in self.lanes and 'concurrency' in lane_conf:
+                    self.lanes[name].resize(lane_conf['concurrency'])
+        with self._cond:
+            if isinstance(lanes, dict):
+                for name, lane_conf in lanes.items():
+                    if name in self.lanes:
+                        self.lanes[name].reserved_per_host = int(
+                            lane_conf.get('reserved_per_host') or 0)
+            self.limits.limit = host_limit
+            self.limits.overrides = host_overrides or {}
+            self._cond.notify_all()
+
+    def wake(self):
+        """
+        Has idle lane threads look for work again, such as after a host
+        cap was raised.
+        """
+        with self._cond:
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def host_slot(self, host):
+        """
+        Holds one in-flight slot on host for the duration of the with
+        block, waiting for one to free up. For work a running job fans
+        out on a host.
+
+        Parameters:
+
+        * host: The Docker host the work operates on
+        """
+        with self._cond:
+            while not self.limits.available(host):
+                self._cond.wait()
+            self.limits.acquire(host)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.limits.release(host)
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def yield_slot(self, host):
+        """
+        Gives up the slot the calling job holds on host for the duration
+        of the with block and waits to take it back afterwards. A job
+        fanning out work on its own host through host_slot uses this so
+        the fan out is not counted on top of the job. A job running in
+        a reserved slot keeps it.
+
+        Parameters:
+
+        * host: The Docker host the calling job was queued for
+        """
+        if getattr(_local, 'reserved', False):
+            yield
+            return
+        with self._cond:
+            self.limits.release(host)
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                while not self.limits.available(host):
+                    self._cond.wait()
+                self.limits.acquire(host)
+
+    def lane_for(self, subcommand):
+        """
+        Returns the Lane a subcommand is scheduled on.
+        """
+        return self.lanes[self._routes.get(subcommand, self.default_lane)]
+
+    def submit(self, subcommand, func, priority=0, deadline=None,
+               on_expired=None, host=None):
+        """
+        Queues a job on the lane for subcommand. See Lane.submit.
+        """
+        self.lane_for(subcommand).submit(
+            func, priority=priority, deadline=deadline,
+            on_expired=on_expired, host=host)
+
+    def stop(self):
+        """
+        Stops every lane once its queue is empty.
+        """
+        for lane in self.lanes.values():
+            lane.stop()
+
+    def join(self, timeout=None):
+        """
+        Waits for every lane to finish after stop().
+        """
+        for lane in self.lanes.values():
+            lane.join(timeout)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Fast start helpers: lazy imports and startup time measurement.
+
+Run ``python -m replugin.dockerworker.startup`` to benchmark how long a
+fresh interpreter takes to import the worker. That is only the import
+share of startup: the time from launch to the first consumed message
+depends on the broker and is logged by the worker itself when it
+consumes its first message.
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+
+class LazyModule(object):
+    """
+    Stands in for a module and imports it on first attribute access.
+    """
+
+    def __init__(self, name):
+        """
+        Creates a new LazyModule.
+
+        Parameters:
+
+        * name: The dotted name of the module to import
+        """
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            __import__(self._name)
+            self._module = sys.modules[self._name]
+        return getattr(self._module, attr)
+
+
+def process_start_time():
+    """
+    Returns the epoch time this process was launched or None when it
+    can not be determined.
+    """
+    try:
+        with open('/proc/self/stat', 'r') as stat:
+            # Fields after the command name; starttime is field 22
+            fields = stat.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime', 'r') as uptime:
+            seconds_up = float(uptime.read().split()[0])
+        start_ticks = float(fields[19])
+        return (time.time() - seconds_up +
+                start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, ValueError, IndexError, KeyError):
+        return None
+
+
+#: Fallback launch time when /proc is not available
+IMPORTED_AT = time.time()
+
+
+def seconds_since_launch():
+    """
+    Returns the seconds since this process was launched.
+    """
+    started = process_start_time() or IMPORTED_AT
+    return max(0.0, time.time() - started)
+
+
+_IMPORT_SNIPPET = (
+    'import time; start = time.time(); '
+    'import replugin.dockerworker; '
+    'print(time.time() - start)')
+
+
+def import_benchmark(runs=10):
+    """
+    Imports the worker in fresh interpreters and returns the sorted
+    import times in seconds. Connecting to the broker and consuming are
+    not included.
+
+    Parameters:
+
+    * runs: How many interpreters to start
+    """
+    times = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', _IMPORT_SNIPPET])
+        times.append(float(output.strip()))
+    return sorted(times)
+
+
+def main():  # pragma: no cover
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    times = import_benchmark(runs)
+    print 'import time over %s runs: min %.1fms median %.1fms max %.1fms' % (
+        runs, times[0] * 1000, times[len(times) // 2] * 1000,
+        times[-1] * 1000)
+    print ('This is import time only; the worker logs the time from '
+           'launch to its first consumed message.')
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
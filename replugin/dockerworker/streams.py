@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Reading of the multiplexed output streams of the Docker daemon.
+"""
+
+import struct
+
+#: Stream ids in the multiplexed stream header
+STDOUT = 1
+STDERR = 2
+
+STREAM_NAMES = {STDOUT: 'stdout', STDERR: 'stderr'}
+
+#: Largest chunk of output sent in one message
+MAX_CHUNK = 65536
+
+_HEADER = struct.Struct('>BxxxL')
+
+
+def _read(sock, size):
+    """
+    Reads up to size bytes, fewer only at the end of the stream.
+    """
+    read = getattr(sock, 'recv', None) or sock.read
+    data = []
+    remaining = size
+    while remaining:
+        chunk = read(remaining)
+        if not chunk:
+            break
+        data.append(chunk)
+        remaining -= len(chunk)
+    return ''.join(data)
+
+
+def iter_read(source, chunk_size=MAX_CHUNK):
+    """
+    Yields the data of a socket or file like object in chunks of at
+    most chunk_size bytes until it ends.
+
+    Parameters:
+
+    * source: A socket or file like object
+    * chunk_size: Most bytes read at once
+    """
+    read = getattr(source, 'recv', None) or source.read
+    while True:
+        data = read(chunk_size)
+        if not data:
+            return
+        yield data
+
+
+def iter_frames(sock):
+    """
+    Yields (stream id, data) for each frame of a multiplexed stream as
+    it arrives.
+
+    Parameters:
+
+    * sock: A socket or file like object of the raw stream
+    """
+    while True:
+        header = _read(sock, _HEADER.size)
+        if len(header) < _HEADER.size:
+            return
+        stream, size = _HEADER.unpack(header)
+        data = _read(sock, size)
+        if data:
+            yield stream, data
+        if len(data) < size:
+            return
+
+
+def iter_chunks(frames, chunk_size):
+    """
+    Splits frames into (stream id, data) chunks of at most chunk_size
+    bytes.
+
+    Parameters:
+
+    * frames: Iterable of (stream id, data)
+    * chunk_size: Most bytes per chunk, capped at MAX_CHUNK
+    """
+    chunk_size = max(1, min(int(chunk_size), MAX_CHUNK))
+    for stream, data in frames:
+        for start in xrange(0, len(data), chunk_size):
+            yield stream, data[start:start + chunk_size]
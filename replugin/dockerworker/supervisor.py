@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Pre-fork supervisor running several worker processes.
+"""
+
+import argparse
+import errno
+import logging
+import os
+import signal
+import time
+
+
+def parse_processes(argv):
+    """
+    Removes --processes N from argv and returns N. The remaining
+    arguments are left for the worker runner.
+
+    Parameters:
+
+    * argv: The argument list to parse, modified in place
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--processes', type=int, default=1)
+    args, rest = parser.parse_known_args(argv[1:])
+    argv[1:] = rest
+    return max(1, args.processes)
+
+
+class Supervisor(object):
+    """
+    Forks a number of consumer processes which all read the same queue.
+    With a prefetch count set the broker spreads messages evenly across
+    them. Children that crash are restarted. SIGTERM and SIGINT are
+    passed on to the children so they can drain, and the supervisor
+    exits once they have. SIGHUP is passed on so the children reload
+    their configuration. Each child gets an index from 0 to processes - 1
+    which a restarted child keeps, so per-process state such as the
+    journal survives the restart.
+    """
+
+    def __init__(self, target, processes, restart_delay=1.0, logger=None):
+        """
+        Creates a new Supervisor.
+
+        Parameters:
+
+        * target: Callable run in each child process with its index
+        * processes: Number of children to keep running
+        * restart_delay: Seconds to wait before replacing a crashed child
+        * logger: Optional logger
+        """
+        self.target = target
+        self.processes = int(processes)
+        self.restart_delay = float(restart_delay)
+        self.logger = logger or logging.getLogger(
+            'replugin.dockerworker.supervisor')
+        #: child pid -> child index
+        self.children = {}
+        self.restarts = 0
+        self._stopping = False
+
+    def run(self):
+        """
+        Starts the children and supervises them until they all exit.
+        """
+        previous = (
+            signal.signal(signal.SIGTERM, self.stop),
+            signal.signal(signal.SIGINT, self.stop),
+            signal.signal(signal.SIGHUP, self.reload))
+        try:
+            for index in range(self.processes):
+                self._spawn(index)
+            self._supervise()
+        finally:
+            signal.signal(signal.SIGTERM, previous[0])
+            signal.signal(signal.SIGINT, previous[1])
+            signal.signal(signal.SIGHUP, previous[2])
+
+    def _supervise(self):
+        """
+        Reaps children, restarting the ones that crashed.
+        """
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError, ose:
+                if ose.errno == errno.EINTR:
+                    continue
+                if ose.errno == errno.ECHILD:
+                    break
+                raise
+            index = self.children.pop(pid, None)
+            crashed = not (os.WIFEXITED(status) and
+                           os.WEXITSTATUS(status) == 0)
+            if crashed and not self._stopping:
+                self.logger.warn(
+                    'Worker process %s died with status %s. Restarting.' % (
+                        pid, status))
+                self.restarts += 1
+                time.sleep(self.restart_delay)
+                if not self._stopping:
+                    self._spawn(index)
+
+    def stop(self, signum=signal.SIGTERM, frame=None):
+        """
+        Asks every child to drain and exit.
+        """
+        self._stopping = True
+        self._signal_children(signal.SIGTERM)
+
+    def reload(self, signum=signal.SIGHUP, frame=None):
+        """
+        Asks every child to reload its configuration.
+        """
+        self._signal_children(signal.SIGHUP)
+
+    def _signal_children(self, signum):
+        """
+        Sends signum to every child.
+        """
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                self.children.pop(pid, None)
+
+    def _spawn(self, index):
+        """
+        Forks a child running the target.
+
+        Parameters:
+
+        * index: The index handed to the target
+        """
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            return pid
+        # In the child: restore default signal handling and run
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        code = 0
+        try:
+            self.target(index)
+        except SystemExit, se:
+            code = se.code
+            if not isinstance(code, int):
+                code = int(code is not None)
+        except BaseException:
+            self.logger.exception('Worker process failed')
+            code = 1
+        os._exit(code)
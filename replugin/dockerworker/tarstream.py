@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tar archives generated on the fly while they are sent.
+"""
+
+import hashlib
+import os
+import stat
+import tarfile
+import time
+
+from StringIO import StringIO
+from contextlib import closing
+
+BLOCK = tarfile.BLOCKSIZE
+
+#: Bytes read from a file per chunk of the stream
+CHUNK_SIZE = 65536
+
+
+def _padding(size):
+    """
+    Returns the zero bytes completing the last block of size bytes.
+    """
+    return '\0' * (-size % BLOCK)
+
+
+class Archive(object):
+    """
+    A list of archive members. Iterating over an Archive generates the
+    tar stream chunk by chunk, reading files only as their data is
+    reached, so nothing is held in memory or written to disk. Every
+    iteration produces a fresh stream, so one Archive can be sent to
+    any number of containers, also at the same time.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        """
+        Creates a new empty Archive.
+
+        Parameters:
+
+        * chunk_size: Bytes read from a file per chunk of the stream
+        """
+        self.chunk_size = chunk_size
+        self.members = []
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        for info, opener in self.members:
+            yield info.tobuf(tarfile.GNU_FORMAT)
+            if opener is None:
+                continue
+            remaining = info.size
+            with opener() as source:
+                while remaining:
+                    data = source.read(min(self.chunk_size, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    yield data
+            if remaining:
+                # The file shrank since it was added; keep the archive
+                # consistent with its header
+                yield '\0' * remaining
+            yield _padding(info.size)
+        yield '\0' * (BLOCK * 2)
+
+    @property
+    def size(self):
+        """
+        Length in bytes of the generated stream.
+        """
+        return sum(
+            len(info.tobuf(tarfile.GNU_FORMAT)) + info.size +
+            len(_padding(info.size))
+            for info, _ in self.members) + BLOCK * 2
+
+    def digest(self):
+        """
+        Returns a sha256 hex digest of the names, types, modes, link
+        targets and contents of the members. Unlike the stream itself
+        it does not change when only modification times do, so it
+        tells whether a build context really changed. Files are read
+        chunk by chunk.
+        """
+        sha = hashlib.sha256()
+        for info, opener in self.members:
+            sha.update('%s\0%s\0%o\0%s\0%d\0' % (
+                info.name, info.type, info.mode, info.linkname, info.size))
+            if opener is None:
+                continue
+            with opener() as source:
+                for data in iter(lambda: source.read(self.chunk_size), ''):
+                    sha.update(data)
+        return sha.hexdigest()
+
+    def _info(self, name, type_, size=0, mode=0644, mtime=None):
+        info = tarfile.TarInfo(name)
+        info.type = type_
+        info.size = size
+        info.mode = mode
+        info.mtime = int(time.time() if mtime is None else mtime)
+        info.uname = info.gname = 'root'
+        return info
+
+    def add_bytes(self, name, data, mode=0644, mtime=None):
+        """
+        Adds a file with the given content.
+
+        Parameters:
+
+        * name: The path of the file in the archive
+        * data: The content of the file
+        * mode: The permission bits of the file
+        * mtime: Optional modification time, defaults to now
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        info = self._info(name, tarfile.REGTYPE, len(data), mode, mtime)
+        self.members.append((info, lambda: closing(StringIO(data))))
+
+    def add_directory(self, path, arcname=''):
+        """
+        Adds the contents of a local directory. Files are only stat'ed
+        here and read while the stream is generated.
+
+        Parameters:
+
+        * path: The local directory
+        * arcname: The path the directory contents get in the archive
+        """
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            relative = os.path.relpath(root, path)
+            prefix = arcname if relative == '.' else os.path.join(
+                arcname, relative)
+            for name in dirs + sorted(files):
+                full = os.path.join(root, name)
+                member = os.path.join(prefix, name)
+                info = os.lstat(full)
+                mode = stat.S_IMODE(info.st_mode)
+                if stat.S_ISLNK(info.st_mode):
+                    link = self._info(
+                        member, tarfile.SYMTYPE, mode=mode,
+                        mtime=info.st_mtime)
+                    link.linkname = os.readlink(full)
+                    self.members.append((link, None))
+                elif stat.S_ISDIR(info.st_mode):
+                    self.members.append((self._info(
+                        member, tarfile.DIRTYPE, mode=mode,
+                        mtime=info.st_mtime), None))
+                elif stat.S_ISREG(info.st_mode):
+                    self.members.append((self._info(
+                        member, tarfile.REGTYPE, info.st_size, mode,
+                        info.st_mtime),
+                        lambda full=full: open(full, 'rb')))
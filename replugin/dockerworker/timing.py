@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Per-phase timing of message handling.
+"""
+
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+#: True when clock is immune to wall clock changes
+MONOTONIC = True
+
+# Prefer a monotonic clock so timings are immune to wall clock changes
+try:
+    clock = time.monotonic
+except AttributeError:
+    try:
+        from monotonic import monotonic as clock
+    except ImportError:
+        clock = time.time
+        MONOTONIC = False
+        logging.getLogger('replugin.dockerworker.timing').warn(
+            'The monotonic package is not installed; timings use the '
+            'wall clock and are skewed when it is stepped')
+
+_local = threading.local()
+
+
+class Trace(object):
+    """
+    Accumulates the seconds spent in each named phase of handling one
+    message.
+    """
+
+    __slots__ = ('phases',)
+
+    def __init__(self):
+        self.phases = {}
+
+    def add(self, name, seconds):
+        """
+        Adds seconds to the named phase. Negative durations, from a
+        stepped wall clock without the monotonic package, count as 0.
+        """
+        self.phases[name] = self.phases.get(name, 0.0) + max(0.0, seconds)
+
+    def as_dict(self):
+        """
+        Returns the phases in milliseconds.
+        """
+        return dict(
+            (name, round(seconds * 1000.0, 3))
+            for name, seconds in self.phases.items())
+
+
+def current():
+    """
+    Returns the Trace active on this thread or None.
+    """
+    return getattr(_local, 'trace', None)
+
+
+def activate(trace):
+    """
+    Makes trace the active Trace on this thread. None deactivates.
+    """
+    _local.trace = trace
+
+
+@contextmanager
+def phase(name):
+    """
+    Times the enclosed block into the named phase of the active Trace.
+    Does nothing when no Trace is active.
+    """
+    trace = current()
+    if trace is None:
+        yield
+        return
+    start = clock()
+    try:
+        yield
+    finally:
+        trace.add(name, clock() - start)
+
+
+class TimedClient(object):
+    """
+    Proxy around a Docker client which times every API call into the
+    docker.<method> phase of the active Trace.
+    """
+
+    def __init__(self, client, observer=None):
+        """
+        Creates a new TimedClient.
+
+        Parameters:
+
+        * client: The Docker client to wrap
+        * observer: Optional callable given the method name, seconds
+          taken and the exception raised (or None) after every call
+        """
+        self._client = client
+        self._observer = observer
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        observer = self._observer
+
+        def call(*args, **kwargs):
+            if observer is None:
+                with phase('docker.%s' % name):
+                    return attr(*args, **kwargs)
+            error = None
+            start = clock()
+            try:
+                with phase('docker.%s' % name):
+                    return attr(*args, **kwargs)
+            except Exception, ex:
+                error = ex
+                raise
+            finally:
+                observer(name, max(0.0, clock() - start), error)
+        return call
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Span based tracing of message handling.
+
+Spans are exported in the Zipkin v2 JSON format, either as JSON lines
+to a local file or posted in batches to a collector.
+"""
+
+import json
+import logging
+import binascii
+import os
+import re
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+from replugin.dockerworker.startup import LazyModule
+
+requests = LazyModule('requests')
+
+_TRACEPARENT = re.compile(r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-')
+_local = threading.local()
+
+
+def new_id(bits=64):
+    """
+    Returns a random hex id of bits length. Read from os.urandom so
+    worker processes forked from one parent do not repeat ids.
+    """
+    return binascii.hexlify(os.urandom(bits // 8))
+
+
+def parse_headers(headers):
+    """
+    Returns (trace_id, parent_id) carried by message headers, either of
+    which may be None. W3C traceparent, B3 and a plain trace_id header
+    are understood.
+
+    Parameters:
+
+    * headers: The message headers or None
+    """
+    headers = headers or {}
+    match = _TRACEPARENT.match(str(headers.get('traceparent', '')))
+    if match:
+        return match.group(1), match.group(2)
+    if 'X-B3-TraceId' in headers:
+        return (str(headers['X-B3-TraceId']),
+                headers.get('X-B3-SpanId') and str(headers['X-B3-SpanId']))
+    if 'trace_id' in headers:
+        return str(headers['trace_id']), None
+    return None, None
+
+
+class Span(object):
+    """
+    A timed operation within a trace.
+    """
+
+    __slots__ = ('tracer', 'trace_id', 'span_id', 'parent_id', 'name',
+                 'start', 'end', 'tags')
+
+    def __init__(self, tracer, name, trace_id=None, parent_id=None,
+                 start=None, tags=None):
+        """
+        Starts a new Span.
+
+        Parameters:
+
+        * tracer: The Tracer exporting the span
+        * name: What the span times
+        * trace_id: The trace the span is part of, new if None
+        * parent_id: The id of the parent span or None
+        * start: Epoch start time, defaults to now
+        * tags: Optional mapping of tag to value
+        """
+        self.tracer = tracer
+        self.trace_id = trace_id or new_id(128)
+        self.span_id = new_id()
+        self.parent_id = parent_id
+        self.name = name
+        self.start = start if start is not None else time.time()
+        self.end = None
+        self.tags = dict(tags or {})
+
+    def child(self, name, start=None, tags=None):
+        """
+        Starts a Span nested in this one.
+        """
+        return Span(self.tracer, name, self.trace_id, self.span_id,
+                    start, tags)
+
+    def finish(self, error=None, end=None):
+        """
+        Ends the span and hands it to the tracer. Later calls do
+        nothing.
+
+        Parameters:
+
+        * error: Optional exception or message the operation failed with
+        * end: Epoch end time, defaults to now
+        """
+        if self.end is not None:
+            return
+        self.end = end if end is not None else time.time()
+        if error is not None:
+            self.tags['error'] = str(error) or error.__class__.__name__
+        self.tracer.export(self)
+
+    def as_zipkin(self, service_name):
+        """
+        Returns the span as a Zipkin v2 JSON structure.
+        """
+        span = {
+            'traceId': self.trace_id,
+            'id': self.span_id,
+            'name': self.name,
+            'timestamp': int(self.start * 1000000),
+            'duration': max(1, int((self.end - self.start) * 1000000)),
+            'localEndpoint': {'serviceName': service_name},
+            'tags': dict((k, str(v)) for k, v in self.tags.items()),
+        }
+        if self.parent_id:
+            span['parentId'] = self.parent_id
+        return span
+
+
+class Tracer(object):
+    """
+    Starts root spans and exports finished spans through an exporter.
+    """
+
+    def __init__(self, exporter, service_name='re-worker-docker'):
+        """
+        Creates a new Tracer.
+
+        Parameters:
+
+        * exporter: Callable given each finished span as Zipkin JSON
+        * service_name: The service name spans are reported under
+        """
+        self.exporter = exporter
+        self.service_name = service_name
+
+    def start_span(self, name, headers=None, tags=None):
+        """
+        Starts a root span, joining the trace named in headers if any.
+
+        Parameters:
+
+        * name: What the span times
+        * headers: Optional message headers carrying a trace id
+        * tags: Optional mapping of tag to value
+        """
+        trace_id, parent_id = parse_headers(headers)
+        return Span(self, name, trace_id, parent_id, tags=tags)
+
+    def export(self, span):
+        """
+        Hands a finished span to the exporter.
+        """
+        self.exporter(span.as_zipkin(self.service_name))
+
+    def close(self):
+        """
+        Writes out spans still queued by a batching exporter.
+        """
+        stop = getattr(self.exporter, 'stop', None)
+        if stop is not None:
+            stop()
+
+
+def current():
+    """
+    Returns the Span active on this thread or None.
+    """
+    return getattr(_local, 'span', None)
+
+
+def activate(span):
+    """
+    Makes span the active Span on this thread. None deactivates.
+    """
+    _local.span = span
+
+
+@contextmanager
+def span(name, **tags):
+    """
+    Times the enclosed block as a child of the active Span. Does
+    nothing when no Span is active.
+    """
+    parent = current()
+    if parent is None:
+        yield None
+        return
+    child = parent.child(name, tags=tags)
+    activate(child)
+    error = None
+    try:
+        yield child
+    except Exception, ex:
+        error = ex
+        raise
+    finally:
+        activate(parent)
+        child.finish(error)
+
+
+def record(name, seconds, error=None, **tags):
+    """
+    Records an operation which just finished after seconds as a child
+    of the active Span. Does nothing when no Span is active.
+    """
+    parent = current()
+    if parent is None:
+        return
+    end = time.time()
+    parent.child(name, start=end - seconds, tags=tags).finish(error, end)
+
+
+class BatchExporter(object):
+    """
+    Queues spans and writes them to a sink in batches from a background
+    thread. Spans are dropped, and counted, when the queue is full.
+    """
+
+    def __init__(self, sink, batch_size=100, flush_interval=1.0,
+                 max_queue=10000, logger=None):
+        """
+        Creates a new BatchExporter.
+
+        Parameters:
+
+        * sink: Callable given a list of spans to write
+        * batch_size: Most spans handed to the sink at once
+        * flush_interval: Most seconds a span waits in the queue
+        * max_queue: Most spans held before new ones are dropped
+        * logger: Optional logger for sink errors
+        """
+        self.sink = sink
+        self.batch_size = int(batch_size)
+        self.flush_interval = float(flush_interval)
+        self.max_queue = int(max_queue)
+        self.dropped = 0
+        self._logger = logger or logging.getLogger(
+            'replugin.dockerworker.tracing')
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._stopped = False
+        self._thread = threading.Thread(
+            target=self._loop, name='span-exporter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __call__(self, span):
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                return
+            self._queue.append(span)
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+
+    def _take(self):
+        """
+        Removes and returns the next batch. Must be called holding the
+        condition.
+        """
+        count = min(self.batch_size, len(self._queue))
+        return [self._queue.popleft() for _ in range(count)]
+
+    def _write(self, batch):
+        """
+        Writes a batch, logging sink failures.
+        """
+        if not batch:
+            return
+        with self._write_lock:
+            try:
+                self.sink(batch)
+            except Exception, ex:
+                self._logger.warn(
+                    'Unable to export %s spans. Error: %s' % (
+                        len(batch), ex))
+
+    def _loop(self):
+        """
+        Thread body writing batches as they fill or time out.
+        """
+        while True:
+            with self._cond:
+                if len(self._queue) < self.batch_size and not self._stopped:
+                    self._cond.wait(self.flush_interval)
+                if self._stopped and not self._queue:
+                    return
+                batch = self._take()
+            self._write(batch)
+
+    def flush(self):
+        """
+        Writes every queued span now.
+        """
+        while True:
+            with self._cond:
+                batch = self._take()
+            if not batch:
+                return
+            self._write(batch)
+
+    def stop(self):
+        """
+        Writes the queued spans and stops the background thread.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(self.flush_interval + 5)
+        self.flush()
+
+
+class FileSink(object):
+    """
+    Appends spans to a file as JSON lines.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, spans):
+        with open(self.path, 'a') as span_file:
+            for span in spans:
+                span_file.write(json.dumps(span) + '\n')
+
+
+class HttpSink(object):
+    """
+    Posts spans to a Zipkin compatible collector, for example
+    http://zipkin:9411/api/v2/spans.
+    """
+
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self, spans):
+        response = requests.post(
+            self.url, data=json.dumps(spans), timeout=self.timeout,
+            headers={'Content-Type': 'application/json'})
+        response.raise_for_status()
+
+
+def from_config(conf, logger=None):
+    """
+    Builds a Tracer from the tracing configuration section, or returns
+    None when neither path nor url is set.
+
+    Parameters:
+
+    * conf: Mapping with path or url and optional service_name,
+      batch_size, flush_interval and max_queue keys
+    * logger: Optional logger for export errors
+    """
+    if not isinstance(conf, dict):
+        return None
+    if conf.get('url'):
+        sink = HttpSink(conf['url'], conf.get('timeout', 5))
+    elif conf.get('path'):
+        sink = FileSink(conf['path'])
+    else:
+        return None
+    exporter = BatchExporter(
+        sink,
+        batch_size=conf.get('batch_size', 100),
+        flush_interval=conf.get('flush_interval', 1.0),
+        max_queue=conf.get('max_queue', 10000),
+        logger=logger)
+    return Tracer(exporter, conf.get('service_name', 're-worker-docker'))
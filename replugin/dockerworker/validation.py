@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Upfront validation of subcommand parameters.
+"""
+
+_STRING = (basestring,)
+_PORTS = (basestring, int, long, list, tuple)
+_COMMAND = (basestring, list, tuple)
+
+#: Parameter schema per subcommand. Each parameter maps to a tuple of
+#: (accepted types, required, default) with an optional fourth item, the
+#: smallest value accepted for a number.
+SCHEMAS = {
+    'StopContainer': {
+        'server_name': (_STRING, True, None),
+        'container_name': (_STRING, True, None),
+    },
+    'RemoveContainer': {
+        'server_name': (_STRING, True, None),
+        'container_name': (_STRING, True, None),
+    },
+    'RemoveImage': {
+        'server_name': (_STRING, True, None),
+        'image_name': (_STRING, True, None),
+    },
+    'PullImage': {
+        'server_name': (_STRING, True, None),
+        'image_name': (_STRING, True, None),
+        'insecure_registry': ((bool,), False, False),
+    },
+    'CreateContainer': {
+        'server_name': (_STRING, True, None),
+        'image_name': (_STRING, True, None),
+        'container_name': (_STRING, True, None),
+        'container_command': (_COMMAND, True, None),
+        'container_hostname': (_STRING, False, None),
+        'container_ports': (_PORTS, False, None),
+    },
+    'StartContainer': {
+        'server_name': (_STRING, True, None),
+        'container_name': (_STRING, True, None),
+        'container_binds': ((dict,), False, None),
+        'port_bindings': ((dict,), False, None),
+    },
+    'ScaleContainers': {
+        'server_name': (_STRING, True, None),
+        'image_name': (_STRING, True, None),
+        'container_name_template': (_STRING, True, None),
+        'replicas': ((int, long), True, None, 1),
+        'container_command': (_COMMAND, True, None),
+        'hostname_template': (_STRING, False, None),
+        'container_ports': (_PORTS, False, None),
+        'container_binds': ((dict,), False, None),
+        'port_bindings': ((dict,), False, None),
+    },
+    'ExecInContainer': {
+        'server_name': (_STRING, True, None),
+        'container_name': (_STRING, True, None),
+        'exec_command': (_COMMAND, True, None),
+        'user': (_STRING, False, None),
+        'check_exit_code': ((bool,), False, True),
+        'chunk_size': ((int, long), False, 4096, 1),
+    },
+    'CopyToContainer': {
+        'server_name': (_STRING, True, None),
+        'path': (_STRING, True, None),
+        'container_name': (_STRING, False, None),
+        'container_names': ((list,), False, None),
+        'files': ((dict,), False, None),
+        'source': (_STRING, False, None),
+    },
+    'BuildImage': {
+        'server_name': (_STRING, True, None),
+        'tag': (_STRING, True, None),
+        'source': (_STRING, True, None),
+        'dockerfile': (_STRING, False, None),
+        'cache_from': ((list,), False, None),
+        'nocache': ((bool,), False, False),
+        'pull': ((bool,), False, False),
+        'insecure_registry': ((bool,), False, False),
+        'distribute_to': ((list,), False, None),
+    },
+    'ExportImage': {
+        'server_name': (_STRING, True, None),
+        'image_name': (_STRING, True, None),
+        'archive_name': (_STRING, False, None),
+        'compress': ((bool,), False, False),
+        'chunk_size': ((int, long), False, 1048576, 1),
+    },
+    'ImportImage': {
+        'server_name': (_STRING, True, None),
+        'image_name': (_STRING, False, None),
+        'archive_name': (_STRING, False, None),
+        'verify': ((bool,), False, True),
+        'chunk_size': ((int, long), False, 1048576, 1),
+    },
+}
+
+
+#: Subcommands needing a newer docker-py or Docker API. Each maps to
+#: (Client method added in the docker-py version, docker-py version,
+#: Docker API version).
+REQUIREMENTS = {
+    'ExecInContainer': ('put_archive', '1.7', '1.15'),
+    'CopyToContainer': ('put_archive', '1.7', '1.20'),
+    'BuildImage': ('put_archive', '1.7', '1.17'),
+}
+
+
+class ValidationError(ValueError):
+    """
+    Raised when message parameters do not match the subcommand schema.
+    """
+    pass
+
+
+class Validator(object):
+    """
+    A compiled schema for one subcommand.
+    """
+
+    __slots__ = ('subcommand', 'required', 'checks', 'defaults')
+
+    def __init__(self, subcommand, schema):
+        """
+        Compiles a schema.
+
+        Parameters:
+
+        * subcommand: The subcommand the schema is for
+        * schema: Mapping of parameter to (types, required, default) or
+          (types, required, default, minimum)
+        """
+        schema = dict(
+            (name, tuple(spec) + (None,) * (4 - len(spec)))
+            for name, spec in schema.items())
+        self.subcommand = subcommand
+        self.required = tuple(sorted(
+            name for name, (_, required, _, _) in schema.items()
+            if required))
+        self.checks = tuple(
+            (name, types, minimum)
+            for name, (types, _, _, minimum) in schema.items())
+        self.defaults = tuple(
+            (name, default) for name, (_, required, default, _)
+            in schema.items() if not required)
+
+    def __call__(self, params):
+        """
+        Validates params in one pass and returns a copy with defaults
+        filled in. Raises ValidationError on the first problem.
+        """
+        for name in self.required:
+            if name not in params:
+                raise ValidationError('Missing input %s' % name)
+        for name, types, minimum in self.checks:
+            value = params.get(name)
+            if value is None:
+                continue
+            # bool is an int subclass but never a valid count
+            if not isinstance(value, types) or (
+                    isinstance(value, bool) and bool not in types):
+                raise ValidationError(
+                    'Invalid input %s: expected %s, got %s' % (
+                        name, ' or '.join(t.__name__ for t in types),
+                        type(value).__name__))
+            if minimum is not None and value < minimum:
+                raise ValidationError(
+                    'Invalid input %s: must be at least %s' % (
+                        name, minimum))
+        result = dict(params)
+        for name, default in self.defaults:
+            if result.get(name) is None:
+                result[name] = default
+        return result
+
+
+def compile_schemas(schemas=None):
+    """
+    Compiles schemas into a mapping of subcommand to Validator.
+
+    Parameters:
+
+    * schemas: Mapping of subcommand to schema, defaults to SCHEMAS
+    """
+    if schemas is None:
+        schemas = SCHEMAS
+    return dict(
+        (subcommand, Validator(subcommand, schema))
+        for subcommand, schema in schemas.items())
+
+
+def parse_version(version):
+    """
+    Returns version as a tuple of ints or None when it is not a dotted
+    number, such as 'auto'.
+    """
+    try:
+        return tuple(int(part) for part in str(version).split('.'))
+    except ValueError:
+        return None
+
+
+def check_requirements(subcommand, client_class, api_version):
+    """
+    Raises ValidationError when subcommand needs a newer docker-py or
+    Docker API than the worker is set up with.
+
+    Parameters:
+
+    * subcommand: The subcommand to run
+    * client_class: The docker-py Client class
+    * api_version: The Docker API version setting
+    """
+    requirement = REQUIREMENTS.get(subcommand)
+    if requirement is None:
+        return
+    method, client_version, minimum = requirement
+    if not hasattr(client_class, method):
+        raise ValidationError(
+            '%s requires docker-py %s or later' % (
+                subcommand, client_version))
+    version = parse_version(api_version)
+    if version is not None and version < parse_version(minimum):
+        raise ValidationError(
+            '%s requires Docker API %s or later, version is set to %s' % (
+                subcommand, minimum, api_version))
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Deadlines for running subcommands.
+"""
+
+import logging
+import threading
+import time
+
+_local = threading.local()
+
+
+class Operation(object):
+    """
+    A subcommand being watched.
+    """
+
+    def __init__(self, corr_id, subcommand, deadline, started, context=None):
+        """
+        Creates a new Operation.
+
+        Parameters:
+
+        * corr_id: The correlation id of the message
+        * subcommand: The subcommand running
+        * deadline: Seconds the subcommand may run or None
+        * started: Epoch time the subcommand started
+        * context: Optional caller data handed back to the callbacks
+        """
+        self.corr_id = corr_id
+        self.subcommand = subcommand
+        self.deadline = deadline
+        self.started = started
+        self.context = context
+        #: set once the deadline passed
+        self.overrun = False
+        #: set once the operation was given up on; its result is moot
+        self.cancelled = False
+        #: callables which unblock the operation once it is cancelled
+        self.aborts = []
+
+    def on_abort(self, func):
+        """
+        Registers a callable the watchdog runs when it gives up on the
+        operation, such as one closing a connection the operation is
+        blocked reading from.
+        """
+        self.aborts.append(func)
+
+
+class Watchdog(object):
+    """
+    Checks running operations against the deadline of their subcommand
+    from a background thread. Operations past their deadline are
+    reported once and, when cancel is set, given up on.
+    """
+
+    def __init__(self, deadlines=None, default=None, cancel=False,
+                 interval=1.0, on_overrun=None, on_cancel=None,
+                 clock=time.time, logger=None):
+        """
+        Creates a new Watchdog.
+
+        Parameters:
+
+        * deadlines: Optional mapping of subcommand to seconds
+        * default: Seconds for subcommands without a deadline, or None
+          to leave them unwatched
+        * cancel: Give up on operations past their deadline
+        * interval: Seconds between checks
+        * on_overrun: Optional callable given each overrunning Operation
+        * on_cancel: Optional callable given each cancelled Operation
+        * clock: Callable returning the current time in seconds
+        * logger: Optional logger for overruns
+        """
+        self.deadlines = dict(deadlines or {})
+        self.default = default
+        self.cancel = cancel
+        self.interval = float(interval)
+        self.on_overrun = on_overrun
+        self.on_cancel = on_cancel
+        self._clock = clock
+        self._logger = logger or logging.getLogger(
+            'replugin.dockerworker.watchdog')
+        self._lock = threading.Lock()
+        self._running = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._running)
+
+    def deadline_for(self, subcommand):
+        """
+        Returns the seconds subcommand may run or None.
+        """
+        return self.deadlines.get(subcommand, self.default)
+
+    def start(self, corr_id, subcommand, context=None):
+        """
+        Starts watching an operation and returns its Operation.
+
+        Parameters:
+
+        * corr_id: The correlation id of the message
+        * subcommand: The subcommand starting
+        * context: Optional caller data handed back to the callbacks
+        """
+        operation = Operation(
+            corr_id, subcommand, self.deadline_for(subcommand),
+            self._clock(), context)
+        if operation.deadline is not None:
+            with self._lock:
+                self._running[id(operation)] = operation
+        return operation
+
+    def finish(self, operation):
+        """
+        Stops watching an operation. Returns False if it was cancelled,
+        in which case its outcome must not be reported again.
+        """
+        with self._lock:
+            self._running.pop(id(operation), None)
+            return not operation.cancelled
+
+    def check(self):
+        """
+        Reports and, if enabled, cancels operations past their
+        deadline. Returns the operations found overrunning.
+        """
+        now = self._clock()
+        overrun, cancelled = [], []
+        with self._lock:
+            for key, operation in self._running.items():
+                if now - operation.started < operation.deadline:
+                    continue
+                if not operation.overrun:
+                    operation.overrun = True
+                    overrun.append(operation)
+                if self.cancel:
+                    operation.cancelled = True
+                    del self._running[key]
+                    cancelled.append(operation)
+        for operation in overrun:
+            self._logger.warn(
+                '%s for correlation_id %s is running for %.1f seconds, '
+                'past its deadline of %s seconds' % (
+                    operation.subcommand, operation.corr_id,
+                    now - operation.started, operation.deadline))
+            self._call(self.on_overrun, operation)
+        for operation in cancelled:
+            self._call(self.on_cancel, operation)
+            for abort in operation.aborts:
+                self._call(abort)
+        return overrun
+
+    def _call(self, func, *args):
+        """
+        Runs a callback, logging instead of raising its errors.
+        """
+        if func is None:
+            return
+        try:
+            func(*args)
+        except Exception, ex:
+            self._logger.error('Watchdog callback failed: %s' % ex)
+
+    def _loop(self):
+        """
+        Thread body checking the operations every interval.
+        """
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def run_in_background(self):
+        """
+        Starts the thread checking the operations.
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name='watchdog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(self.interval + 1)
+
+
+def current():
+    """
+    Returns the Operation watched on this thread or None.
+    """
+    return getattr(_local, 'operation', None)
+
+
+def activate(operation):
+    """
+    Makes operation the watched Operation of this thread. None clears.
+    """
+    _local.operation = operation
@@ -35,6 +35,13 @@ setup(
     license='AGPLv3',
     package_dir={'replugin': 'replugin'},
     packages=['replugin', 'replugin.dockerworker'],
+    install_requires=[
+        'docker-py>=1.7,<2.0',
+        'monotonic',
+    ],
+    extras_require={
+        'msgpack': ['msgpack'],
+    },
     entry_points={
         'console_scripts': [
             're-worker-docker = replugin.dockerworker:main',
@@ -0,0 +1,104 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import mock
+
+from . import TestCase
+
+from replugin.dockerworker.adaptive import AdaptiveConcurrency, is_failure
+
+
+class ClientError(Exception):
+
+    def is_client_error(self):
+        return True
+
+
+class TestAdaptiveConcurrency(TestCase):
+
+    def window(self, adaptive, seconds, error=None, method='start',
+               busy=True):
+        if busy:
+            adaptive.acquired('host1', adaptive.limit_for('host1'))
+        for _ in range(adaptive.window):
+            adaptive.observe('host1', method, seconds, error)
+
+    def test_additive_increase(self):
+        """
+        Verify the limit grows by one per healthy window up to maximum.
+        """
+        on_change = mock.MagicMock()
+        adaptive = AdaptiveConcurrency(
+            initial=2, maximum=4, window=5, on_change=on_change)
+        self.window(adaptive, 0.05)
+        self.assertEquals(adaptive.limit_for('host1'), 3)
+        self.assertEquals(adaptive.limit_for('host2'), 2)
+        self.window(adaptive, 0.05)
+        self.window(adaptive, 0.05)
+        self.assertEquals(adaptive.limit_for('host1'), 4)
+        self.assertEquals(on_change.call_count, 2)
+
+    def test_idle_host_does_not_grow(self):
+        """
+        Verify the limit only grows after windows the host was saturated.
+        """
+        adaptive = AdaptiveConcurrency(initial=2, window=5)
+        adaptive.acquired('host1', 1)
+        self.window(adaptive, 0.05, busy=False)
+        self.assertEquals(adaptive.limit_for('host1'), 2)
+        self.window(adaptive, 0.05)
+        self.assertEquals(adaptive.limit_for('host1'), 3)
+        # Unhealthy windows still back off when idle
+        self.window(adaptive, 0.05, error=IOError(), busy=False)
+        self.assertEquals(adaptive.limit_for('host1'), 1)
+
+    def test_multiplicative_decrease(self):
+        """
+        Verify the limit halves when latency rises over the baseline.
+        """
+        adaptive = AdaptiveConcurrency(initial=8, window=5, smoothing=0.5)
+        self.window(adaptive, 0.05)
+        self.assertEquals(adaptive.limit_for('host1'), 9)
+        self.window(adaptive, 0.5)
+        self.assertEquals(adaptive.limit_for('host1'), 4)
+        # Never below the minimum
+        for _ in range(5):
+            self.window(adaptive, 5.0)
+        self.assertEquals(adaptive.limit_for('host1'), 1)
+
+    def test_failures(self):
+        """
+        Verify server failures back off while client errors do not.
+        """
+        adaptive = AdaptiveConcurrency(initial=8, window=5)
+        self.window(adaptive, 0.05, error=ClientError())
+        self.assertEquals(adaptive.limit_for('host1'), 9)
+        self.window(adaptive, 0.05, error=IOError())
+        self.assertEquals(adaptive.limit_for('host1'), 4)
+        self.assertFalse(is_failure(None))
+
+    def test_ignored_methods(self):
+        """
+        Verify calls whose latency is not a load signal are skipped.
+        """
+        adaptive = AdaptiveConcurrency(initial=2, window=5)
+        for method in ('pull', 'build', 'get_image', 'load_image',
+                       'put_archive'):
+            self.window(adaptive, 30.0, method=method, busy=False)
+        self.assertEquals(adaptive.limit_for('host1'), 2)
+        self.assertEquals(adaptive._windows, {})
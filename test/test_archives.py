@@ -0,0 +1,113 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+
+from . import TestCase
+
+from replugin.dockerworker.archives import (
+    archive_name, file_digest, read_archive, read_checksum, write_archive)
+
+
+class TestArchives(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_archive_name(self):
+        """
+        Verify image references map to safe file names.
+        """
+        self.assertEquals(
+            archive_name('registry:5000/app:1'), 'registry_5000_app_1.tar')
+        self.assertEquals(archive_name('app', True), 'app.tar.gz')
+
+    def test_plain_round_trip(self):
+        """
+        Verify an archive and its checksum are written and read back.
+        """
+        path = os.path.join(self.tmpdir, 'app.tar')
+        size, stored, digest = write_archive(['abc', 'def'], path)
+        self.assertEquals((size, stored), (6, 6))
+        self.assertEquals(digest, hashlib.sha256('abcdef').hexdigest())
+        self.assertEquals(read_checksum(path), digest)
+        self.assertEquals(file_digest(path, 4), digest)
+        with open(path + '.sha256') as checksum_file:
+            self.assertEquals(
+                checksum_file.read(), '%s  app.tar\n' % digest)
+        self.assertEquals(list(read_archive(path, 4)), ['abcd', 'ef'])
+        self.assertEquals(
+            sorted(os.listdir(self.tmpdir)), ['app.tar', 'app.tar.sha256'])
+
+    def test_compressed_round_trip(self):
+        """
+        Verify compressed archives are gzip files checksummed as stored.
+        """
+        path = os.path.join(self.tmpdir, 'app.tar.gz')
+        data = ['x' * 10000] * 10
+        size, stored, digest = write_archive(data, path, compress=True)
+        self.assertEquals(size, 100000)
+        self.assertEquals(stored, os.path.getsize(path))
+        self.assertTrue(stored < size)
+        self.assertEquals(file_digest(path), digest)
+        self.assertEquals(gzip.open(path).read(), ''.join(data))
+        self.assertEquals(''.join(read_archive(path)), ''.join(data))
+        # Archives of the same image are identical
+        self.assertEquals(
+            write_archive(data, path, compress=True)[2], digest)
+
+    def test_concurrent_writes(self):
+        """
+        Verify concurrent writers of one archive do not mix their data
+        and the checksum matches the archive left in place.
+        """
+        path = os.path.join(self.tmpdir, 'app.tar')
+        results = []
+
+        def chunks():
+            yield 'first '
+            # Another export of the same image finishes meanwhile
+            results.append(write_archive(['second'], path))
+            yield 'export'
+        results.append(write_archive(chunks(), path))
+        self.assertEquals(results[0][0], 6)
+        self.assertEquals(results[1][0], 12)
+        with open(path, 'rb') as archive_file:
+            self.assertEquals(archive_file.read(), 'first export')
+        self.assertEquals(read_checksum(path), results[1][2])
+        self.assertEquals(
+            sorted(os.listdir(self.tmpdir)), ['app.tar', 'app.tar.sha256'])
+
+    def test_failed_write(self):
+        """
+        Verify a failing stream leaves no partial archive behind.
+        """
+        def chunks():
+            yield 'abc'
+            raise IOError('connection reset')
+        path = os.path.join(self.tmpdir, 'app.tar')
+        self.assertRaises(IOError, write_archive, chunks(), path)
+        self.assertEquals(os.listdir(self.tmpdir), [])
+        self.assertEquals(read_checksum(path), None)
@@ -0,0 +1,122 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import mock
+import os
+import shutil
+import tempfile
+
+from . import TestCase
+
+from replugin.dockerworker.cache import ResultCache
+
+
+class FakeClock(object):
+    """
+    Clock which only moves when told to.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestResultCache(TestCase):
+
+    def test_lru_eviction(self):
+        """
+        Verify the least recently used entry is evicted when full.
+        """
+        cache = ResultCache(size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Touch a so b becomes the oldest
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+
+    def test_ttl_expiry(self):
+        """
+        Verify entries expire after the ttl.
+        """
+        clock = FakeClock()
+        cache = ResultCache(ttl=10, clock=clock)
+        cache.set('a', 1)
+        clock.now += 5
+        self.assertEquals(cache.get('a'), 1)
+        clock.now += 10
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(len(cache), 0)
+
+    def test_persistence(self):
+        """
+        Verify the cache is reloaded from its persistence file.
+        """
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            cache = ResultCache(path=path)
+            cache.set('a', {'status': 'completed', 'data': None})
+            cache.flush()
+            reloaded = ResultCache(path=path)
+            self.assertEquals(
+                reloaded.get('a'), {'status': 'completed', 'data': None})
+        finally:
+            os.unlink(path)
+
+    def test_periodic_flush(self):
+        """
+        Verify sets only write the persistence file every flush_interval.
+        """
+        clock = FakeClock()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            cache = ResultCache(path=path, clock=clock, flush_interval=10)
+            with mock.patch.object(cache, 'save') as save:
+                cache.set('a', 1)
+                cache.set('b', 2)
+                self.assertEquals(save.call_count, 0)
+                clock.now += 10
+                cache.set('c', 3)
+                self.assertEquals(save.call_count, 1)
+        finally:
+            os.unlink(path)
+
+    def test_save_errors(self):
+        """
+        Verify failing to write the persistence file is logged, not
+        raised, and retried on the next flush.
+        """
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'missing', 'cache.json')
+        logger = mock.MagicMock()
+        cache = ResultCache(path=path, flush_interval=0, logger=logger)
+        cache.set('a', 1)
+        self.assertEquals(logger.error.call_count, 1)
+        self.assertEquals(cache.get('a'), 1)
+        os.mkdir(os.path.dirname(path))
+        cache.flush()
+        self.assertEquals(ResultCache(path=path).get('a'), 1)
+        # Only the file itself is left behind
+        self.assertEquals(os.listdir(os.path.dirname(path)), ['cache.json'])
+        shutil.rmtree(tmpdir)
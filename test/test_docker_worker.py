@@ -17,15 +17,29 @@ Unittests.
 """
 
 import docker
+import json
+import os
 import pika
 import mock
 import requests
+import shutil
+import socket
+import struct
+import tempfile
+import threading
 
+from StringIO import StringIO
 from contextlib import nested
 
 from . import TestCase
 
 from replugin import dockerworker
+from replugin.dockerworker import tracing, watchdog
+from replugin.dockerworker.cache import ResultCache
+from replugin.dockerworker.journal import Journal
+from replugin.dockerworker.profiles import compile_profiles
+from replugin.dockerworker.ratelimit import RegistryLimiter
+from replugin.dockerworker.scheduler import LaneScheduler
 
 
 MQ_CONF = {
@@ -722,7 +736,8 @@ class TestDockerWorker(TestCase):
                 base_url="localhost", version=worker._config['version'])
             # The docker client should call pull to grab the new image
             print _client().call_count
-            _client().pull.assert_called_once_with("testing", insecure_registry=True)
+            _client().pull.assert_called_once_with(
+                "testing", stream=True, insecure_registry=True)
 
     def test_docker_pull_image_missing_input(self):
         """
@@ -1263,3 +1278,1664 @@ class TestDockerWorker(TestCase):
             self.assertEquals(self.app_logger.warn.call_count, 1)
             self.assertEquals(self.app_logger.error.call_count, 1)
             self.assertEquals(worker.send.call_args[0][2]['status'], 'failed')
+
+    def test_replay_cache(self):
+        """
+        Verify a redelivered message is answered from the replay cache.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker.replay_cache = ResultCache()
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "StopContainer",
+                    "server_name": "localhost",
+                    "container_name": "testing",
+                },
+            }
+
+            # Execute the call twice with the same correlation id
+            for _ in range(2):
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+
+            # The second delivery should replay the completed reply
+            # without calling the docker host again
+            self.assertEquals(worker.send.call_args[0][2]['status'], 'completed')
+            self.assertEquals(_client().stop.call_count, 1)
+
+    def test_ack_after_completion(self):
+        """
+        Verify the message is acked after the reply when configured.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('replugin.dockerworker.DockerWorker.ack'),
+                mock.patch('docker.Client')) as (_, _, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._config['ack_after_completion'] = True
+            worker._config['prefetch_count'] = 4
+
+            self.channel.basic_qos = mock.Mock('basic_qos')
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            self.channel.basic_qos.assert_called_once_with(prefetch_count=4)
+
+            # Record the order of sends and acks
+            calls = []
+            worker.send.side_effect = lambda *a, **k: calls.append('send')
+            worker.ack.side_effect = lambda *a, **k: calls.append('ack')
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "StopContainer",
+                    "server_name": "localhost",
+                    "container_name": "testing",
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            self.assertEquals(calls, ['send', 'send', 'ack'])
+            worker.ack.assert_called_once_with(self.basic_deliver)
+
+            # Unexpected errors still send a failed reply and ack
+            del calls[:]
+            _client().stop.side_effect = RuntimeError('bug')
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            self.assertEquals(calls, ['send', 'send', 'ack'])
+            self.assertEquals(
+                worker.send.call_args[0][2]['status'], 'failed')
+
+    def test_invalid_prefetch_count(self):
+        """
+        Verify a prefetch_count which is not a positive integer is
+        ignored.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('docker.Client')):
+            for prefetch_count in (True, 0, -1, '4'):
+                worker = dockerworker.DockerWorker(
+                    MQ_CONF,
+                    logger=self.app_logger,
+                    config_file='conf/example.json')
+                worker._config['prefetch_count'] = prefetch_count
+                self.channel.basic_qos = mock.Mock('basic_qos')
+                worker._on_open(self.connection)
+                worker._on_channel_open(self.channel)
+                self.assertEquals(self.channel.basic_qos.call_count, 0)
+
+    def test_quiet_subcommands(self):
+        """
+        Verify quiet subcommands skip the started reply and notify.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker.quiet_subcommands = frozenset(['StopContainer'])
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "StopContainer",
+                    "server_name": "localhost",
+                    "container_name": "testing",
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            self.assertEquals(worker.send.call_count, 1)
+            self.assertEquals(worker.send.call_args[0][2]['status'], 'completed')
+            self.assertEquals(worker.notify.call_count, 0)
+
+    def test_invalid_parameter_type(self):
+        """
+        Verify parameters of the wrong type fail before any client.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "PullImage",
+                    "server_name": "localhost",
+                    "image_name": "testing",
+                    "insecure_registry": "yes",
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            self.assertEquals(self.app_logger.error.call_count, 1)
+            self.assertEquals(worker.send.call_args[0][2]['status'], 'failed')
+            self.assertEquals(_client.call_count, 0)
+
+    def test_drain_and_reload(self):
+        """
+        Verify draining requeues new messages and reload applies config.
+        """
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        with open(path, 'w') as config_file:
+            json.dump({'queue': 'docker', 'version': '1.15'}, config_file)
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file=path)
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            # Reload picks up the new API version and quiet subcommands
+            with open(path, 'w') as config_file:
+                json.dump({
+                    'queue': 'docker',
+                    'version': '1.16',
+                    'quiet_subcommands': ['StopContainer'],
+                }, config_file)
+            worker.reload_config()
+            self.assertEquals(worker._config['version'], '1.16')
+            self.assertEquals(
+                worker.quiet_subcommands, frozenset(['StopContainer']))
+
+            # Keys removed from the file stop applying
+            with open(path, 'w') as config_file:
+                json.dump({'queue': 'docker', 'version': '1.16'}, config_file)
+            worker.reload_config()
+            os.unlink(path)
+            self.assertEquals(worker.quiet_subcommands, frozenset())
+            self.assertFalse('quiet_subcommands' in worker._config)
+
+            self.channel.basic_cancel = mock.Mock('basic_cancel')
+            self.channel.basic_reject = mock.Mock('basic_reject')
+            self.channel.consumer_tags = ['ctag']
+            worker.drain(self.channel)
+            self.channel.basic_cancel.assert_called_once_with(
+                consumer_tag='ctag')
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "StopContainer",
+                    "server_name": "localhost",
+                    "container_name": "testing",
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            self.channel.basic_reject.assert_called_once_with(
+                delivery_tag=123, requeue=True)
+            self.assertEquals(worker.send.call_count, 0)
+            self.assertEquals(_client.call_count, 0)
+
+    def test_timing_in_reply(self):
+        """
+        Verify the completed reply carries the per-phase timing.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "StopContainer",
+                    "server_name": "localhost",
+                    "container_name": "testing",
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            reply = worker.send.call_args[0][2]
+            self.assertEquals(reply['status'], 'completed')
+            for phase in ('queued', 'validating', 'client', 'docker.stop'):
+                self.assertTrue(phase in reply['timing'])
+
+    def test_container_id_cache(self):
+        """
+        Verify a created container is later addressed by its ID.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            _client().create_container.return_value = {
+                'Id': 'abc123', 'Warnings': None}
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "CreateContainer",
+                    "server_name": "localhost",
+                    "image_name": "testing",
+                    "container_name": "testing",
+                    "container_command": "/bin/bash",
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            data = worker.send.call_args[0][2]['data']
+            self.assertEquals(data['container_id'], 'abc123')
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "StartContainer",
+                    "server_name": "localhost",
+                    "container_name": "testing",
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            _client().start.assert_called_once_with(
+                'abc123', binds=None, port_bindings=None)
+            data = worker.send.call_args[0][2]['data']
+            self.assertEquals(data, {
+                'container_name': 'testing', 'container_id': 'abc123'})
+
+            # A container recreated elsewhere is found again by name
+            def stop(ref, timeout=None):
+                if ref == 'abc123':
+                    raise docker.errors.APIError(
+                        'gone', mock.MagicMock(status_code=404))
+            _client().stop.side_effect = stop
+            body['parameters']['subcommand'] = 'StopContainer'
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            self.assertEquals(
+                [c[0][0] for c in _client().stop.call_args_list],
+                ['abc123', 'testing'])
+            reply = worker.send.call_args[0][2]
+            self.assertEquals(reply['status'], 'completed')
+            self.assertEquals(reply['data']['container_id'], None)
+
+    def test_digest_resolved_once(self):
+        """
+        Verify concurrent pulls of a tag resolve its digest only once.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('docker.Client')) as (_, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker.digests = ResultCache()
+
+            pulling = threading.Event()
+            release = threading.Event()
+            pulls = []
+
+            def pull(reference, stream=False, insecure_registry=False):
+                pulls.append(reference)
+                if reference == 'testing:1.0':
+                    pulling.set()
+                    release.wait(5)
+                return '{"status": "Digest: sha256:abc"}'
+            _client().pull.side_effect = pull
+
+            def inspect(reference):
+                # The digest is only present once pulled by digest
+                if '@' in reference and reference not in pulls:
+                    raise docker.errors.APIError(
+                        'missing', mock.MagicMock(status_code=404))
+                return {'Id': 'img1'}
+            _client().inspect_image.side_effect = inspect
+
+            def run(server_name):
+                worker.pull_image({'parameters': {
+                    'server_name': server_name,
+                    'image_name': 'testing:1.0'}}, 'corr', mock.MagicMock())
+
+            leader = threading.Thread(target=run, args=('host1',))
+            leader.start()
+            self.assertTrue(pulling.wait(5))
+            follower = threading.Thread(target=run, args=('host2',))
+            follower.start()
+            follower.join(0.1)
+            # The follower waits for the digest instead of pulling
+            self.assertEquals(pulls, ['testing:1.0'])
+            release.set()
+            leader.join(5)
+            follower.join(5)
+            self.assertEquals(pulls, ['testing:1.0', 'testing@sha256:abc'])
+            self.assertEquals(worker._resolving, {})
+
+    def test_digest_pinning(self):
+        """
+        Verify a tag pulled once is pulled and created by digest after.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            _client().pull.return_value = (
+                '{"status": "Digest: sha256:abc"}')
+            _client().inspect_image.return_value = {'Id': 'img1'}
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker.digests = ResultCache()
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "PullImage",
+                    "server_name": "host1",
+                    "image_name": "testing:1.0",
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            _client().pull.assert_called_once_with(
+                'testing:1.0', stream=True, insecure_registry=False)
+            self.assertEquals(worker.digests.get('testing:1.0'), 'sha256:abc')
+
+            # The second host already has the digest: no pull needed
+            body['parameters']['server_name'] = 'host2'
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            self.assertEquals(_client().pull.call_count, 1)
+            _client().inspect_image.assert_called_with('testing@sha256:abc')
+            data = worker.send.call_args[0][2]['data']
+            self.assertEquals(data['digest'], 'sha256:abc')
+
+    def test_container_profile(self):
+        """
+        Verify CreateContainer fills in a referenced profile.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker.profiles = compile_profiles({
+                'web': {
+                    'image_name': 'testing',
+                    'container_command': '/bin/bash',
+                    'container_ports': '443',
+                    'hostname_template': '{container_name}.local',
+                },
+            })
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "CreateContainer",
+                    "server_name": "localhost",
+                    "container_name": "test",
+                    "profile": "web",
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            self.assertEquals(self.app_logger.error.call_count, 0)
+            _client().create_container.assert_called_once_with(
+                'testing', name='test', command='/bin/bash',
+                hostname='test.local', ports=['443'])
+
+            # An unknown profile fails before any client is built
+            _client.reset_mock()
+            body['parameters']['profile'] = 'nope'
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            self.assertEquals(worker.send.call_args[0][2]['status'], 'failed')
+            self.assertEquals(_client.call_count, 0)
+
+    def test_scale_containers(self):
+        """
+        Verify ScaleContainers creates and starts missing replicas and
+        removes extras.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            _client().containers.return_value = [
+                {'Names': ['/web-0'], 'Status': 'Up 2 hours', 'Id': 'a'},
+                {'Names': ['/web-1'], 'Status': 'Exited (0)', 'Id': 'b'},
+                {'Names': ['/web-4'], 'Status': 'Up 1 hour', 'Id': 'e'},
+                {'Names': ['/other'], 'Status': 'Up 1 hour', 'Id': 'o'},
+            ]
+            _client().create_container.side_effect = lambda *a, **kw: {
+                'Id': kw['name'] + '-id'}
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "ScaleContainers",
+                    "server_name": "localhost",
+                    "image_name": "testing",
+                    "container_command": "/bin/bash",
+                    "container_name_template": "web-{index}",
+                    "hostname_template": "web{index}.local",
+                    "replicas": 3,
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            self.assertEquals(self.app_logger.error.call_count, 0)
+            reply = worker.send.call_args[0][2]
+            self.assertEquals(reply['status'], 'completed')
+            self.assertEquals(reply['data']['created'], ['web-2'])
+            self.assertEquals(reply['data']['started'], ['web-1'])
+            self.assertEquals(reply['data']['removed'], ['web-4'])
+            _client().create_container.assert_called_once_with(
+                'testing', name='web-2', command='/bin/bash',
+                hostname='web2.local', ports=None)
+            self.assertEquals(_client().start.call_count, 2)
+            _client().stop.assert_called_once_with('e', timeout=10)
+            _client().remove_container.assert_called_once_with('e')
+
+            # A template without {index} is rejected
+            body['parameters']['container_name_template'] = 'web'
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            self.assertEquals(worker.send.call_args[0][2]['status'], 'failed')
+
+    def test_fan_out_host_slots(self):
+        """
+        Verify fan out within a lane job stays within the host cap.
+        """
+        with mock.patch('pika.SelectConnection'):
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker.scheduler = LaneScheduler(
+                {'all': {'concurrency': 2}}, host_limit=2)
+            lock = threading.Lock()
+            state = {'running': 0, 'peak': 0}
+            done = threading.Event()
+            results = []
+
+            def replica(value):
+                def run():
+                    with lock:
+                        state['running'] += 1
+                        state['peak'] = max(state['peak'], state['running'])
+                    threading.Event().wait(0.01)
+                    with lock:
+                        state['running'] -= 1
+                    return value
+                return run
+
+            def job():
+                results.extend(worker._on_host(
+                    'localhost', [replica(i) for i in range(6)]))
+                done.set()
+
+            # Another job holds the second slot on the host, so the fan
+            # out only has the slot of its own job
+            gate = threading.Event()
+            worker.scheduler.submit(
+                'StopContainer', gate.wait, host='localhost')
+            worker.scheduler.submit('ScaleContainers', job, host='localhost')
+            self.assertTrue(done.wait(5))
+            gate.set()
+            self.assertEquals(results, [(i, None) for i in range(6)])
+            self.assertEquals(state['peak'], 1)
+            worker.scheduler.stop()
+            worker.scheduler.join(5)
+            self.assertEquals(worker.scheduler.limits.in_flight, {})
+
+    def test_distribute_host_slots(self):
+        """
+        Verify each image load holds a slot on its target host.
+        """
+        with mock.patch('pika.SelectConnection'):
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker.scheduler = LaneScheduler(
+                {'all': {'concurrency': 2}}, host_limit=2)
+            in_flight = {}
+            targets = {}
+
+            def create_client(host):
+                target = targets[host] = mock.MagicMock()
+                target.inspect_image.return_value = {'Id': 'old'}
+                target.load_image.side_effect = (
+                    lambda data: in_flight.setdefault(
+                        host, dict(worker.scheduler.limits.in_flight)))
+                return target
+            worker._create_client = create_client
+            client = mock.MagicMock()
+            client.get_image.side_effect = lambda tag: StringIO('image tar')
+
+            self.assertEquals(
+                worker._distribute(
+                    client, 'localhost', 'app:1', 'abc',
+                    ['localhost', 'a', 'b']),
+                ['a', 'b'])
+            # Loads count on their target, not on the build host
+            self.assertEquals(in_flight['a'].get('a'), 1)
+            self.assertEquals(in_flight['b'].get('b'), 1)
+            self.assertFalse('localhost' in in_flight['a'])
+            self.assertFalse('localhost' in in_flight['b'])
+            self.assertEquals(worker.scheduler.limits.in_flight, {})
+            worker.scheduler.stop()
+            worker.scheduler.join(5)
+
+    def test_registry_limits(self):
+        """
+        Verify pulls take a slot from the limits of their registry.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker.registry_limits = RegistryLimiter({
+                'registry.example.com:5000': {'concurrency': 1, 'rate': 5},
+            })
+            limit = worker.registry_limits.limit_for(
+                'registry.example.com:5000')
+            limit.acquire = mock.MagicMock()
+            limit.release = mock.MagicMock()
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "PullImage",
+                    "server_name": "localhost",
+                    "image_name": "registry.example.com:5000/testing",
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            reply = worker.send.call_args[0][2]
+            self.assertEquals(reply['status'], 'completed')
+            self.assertTrue('throttled' in reply['timing'])
+            self.assertEquals(limit.acquire.call_count, 1)
+            self.assertEquals(limit.release.call_count, 1)
+
+            # Pulls from other registries are not throttled
+            body['parameters']['image_name'] = 'testing'
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            self.assertEquals(limit.acquire.call_count, 1)
+
+    def test_adaptive_concurrency(self):
+        """
+        Verify adaptive mode schedules by host and observes API calls.
+        """
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        with open(path, 'w') as config_file:
+            json.dump({
+                'queue': 'docker',
+                'version': '1.15',
+                'host_concurrency': 3,
+                'adaptive_concurrency': {'window': 2},
+            }, config_file)
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('docker.Client')) as (_, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file=path)
+            os.unlink(path)
+
+            self.assertTrue(worker.scheduler is not None)
+            limits = worker.scheduler.limits
+            self.assertTrue(limits.adaptive is worker.adaptive)
+            self.assertEquals(limits.limit_for('host1'), 3)
+
+            client = worker._create_client('host1')
+            client.start('test')
+            client.start('test')
+            # The host never ran at its limit
+            self.assertEquals(limits.limit_for('host1'), 3)
+            for _ in range(3):
+                limits.acquire('host1')
+            client.start('test')
+            client.start('test')
+            self.assertEquals(limits.limit_for('host1'), 4)
+            worker.scheduler.stop()
+            worker.scheduler.join(5)
+
+    def test_journal_recovery(self):
+        """
+        Verify unfinished journaled operations are resumed on start.
+        """
+        tmpdir = tempfile.mkdtemp()
+        journal_path = os.path.join(tmpdir, 'journal')
+        config_path = os.path.join(tmpdir, 'config.json')
+        with open(config_path, 'w') as config_file:
+            json.dump({
+                'queue': 'docker',
+                'version': '1.15',
+                'journal': {'path': journal_path},
+            }, config_file)
+        journal = Journal(journal_path)
+        # Interrupted after the container was created
+        journal.accepted('1', 'CreateContainer', {
+            'server_name': 'localhost',
+            'image_name': 'testing',
+            'container_name': 'created',
+            'container_command': '/bin/bash'}, 'me')
+        journal.running('1')
+        # Never started
+        journal.accepted('2', 'StopContainer', {
+            'server_name': 'localhost',
+            'container_name': 'waiting'}, 'me')
+        # Interrupted with an unknown outcome
+        journal.accepted('3', 'RemoveContainer', {
+            'server_name': 'localhost',
+            'container_name': 'removing'}, 'me')
+        journal.running('3')
+        journal.close()
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            _client().inspect_container.return_value = {'Id': 'abc'}
+            in_flight = []
+            _client().stop.side_effect = (
+                lambda *a, **k: in_flight.append(worker._in_flight))
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file=config_path)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            replies = dict(
+                (call[0][1], call[0][2]) for call in worker.send.call_args_list
+                if call[0][2]['status'] != 'started')
+            self.assertEquals(replies['1']['status'], 'completed')
+            self.assertEquals(replies['1']['data']['container_id'], 'abc')
+            self.assertEquals(_client().create_container.call_count, 0)
+            self.assertEquals(replies['2']['status'], 'completed')
+            _client().stop.assert_called_once_with('waiting', timeout=10)
+            self.assertEquals(replies['3']['status'], 'failed')
+            self.assertEquals(_client().remove_container.call_count, 0)
+            # Resumed operations are counted while they run
+            self.assertEquals(in_flight, [1])
+            self.assertEquals(worker._in_flight, 0)
+
+            # Everything was answered; new messages are journaled
+            self.assertEquals(Journal(journal_path).unfinished, [])
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                {"parameters": {
+                    "command": "docker",
+                    "subcommand": "StopContainer",
+                    "server_name": "localhost",
+                    "container_name": "test"}},
+                self.logger)
+            self.assertEquals(Journal(journal_path).unfinished, [])
+            worker.journal.close()
+        shutil.rmtree(tmpdir)
+
+    def test_journal_per_process(self):
+        """
+        Verify every process under --processes keeps its own journal.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        journal_path = os.path.join(tmpdir, 'journal')
+        config_path = os.path.join(tmpdir, 'config.json')
+        with open(config_path, 'w') as config_file:
+            json.dump({
+                'queue': 'docker',
+                'version': '1.15',
+                'journal': {'path': journal_path},
+            }, config_file)
+        # A sibling's unfinished operation
+        journal = Journal(journal_path + '.0')
+        journal.accepted('1', 'StopContainer', {
+            'server_name': 'localhost',
+            'container_name': 'sibling'}, 'me')
+        journal.close()
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client'),
+                mock.patch.object(
+                    dockerworker.DockerWorker, 'process_index', 1)
+        ) as (_, _, _, _client, _):
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file=config_path)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            self.assertEquals(worker.journal.path, journal_path + '.1')
+            # The sibling's operation is left to the sibling
+            self.assertEquals(_client().stop.call_count, 0)
+            self.assertEquals(
+                len(Journal(journal_path + '.0').unfinished), 1)
+            worker.journal.close()
+
+    def test_tracing(self):
+        """
+        Verify spans cover the message, the subcommand and Docker calls.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            spans = []
+            worker.tracer = tracing.Tracer(spans.append)
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            self.properties.headers = {'trace_id': 'abc123'}
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "StopContainer",
+                    "server_name": "localhost",
+                    "container_name": "test",
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            self.assertEquals(
+                [span['name'] for span in spans],
+                ['docker.stop', 'StopContainer', 'process'])
+            self.assertTrue(all(s['traceId'] == 'abc123' for s in spans))
+            self.assertEquals(spans[2]['tags']['subcommand'], 'StopContainer')
+            self.assertEquals(spans[0]['tags']['server_name'], 'localhost')
+            self.assertEquals(tracing.current(), None)
+
+    def test_exec_in_container(self):
+        """
+        Verify ExecInContainer streams output and returns the exit code.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            frames = ''.join(
+                struct.pack('>BxxxL', stream, len(data)) + data
+                for stream, data in [(1, 'ok 123456'), (2, 'warn')])
+            _client().exec_create.return_value = {'Id': 'exec1'}
+            _client().exec_start.return_value = StringIO(frames)
+            _client().exec_inspect.return_value = {'ExitCode': 0}
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "ExecInContainer",
+                    "server_name": "localhost",
+                    "container_name": "test",
+                    "exec_command": ["/bin/check", "--quick"],
+                    "chunk_size": 5,
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            _client().exec_create.assert_called_once_with(
+                'test', ['/bin/check', '--quick'], stdout=True,
+                stderr=True, tty=False, user='')
+            _client().exec_start.assert_called_once_with(
+                'exec1', socket=True)
+            messages = [call[0][2] for call in worker.send.call_args_list]
+            chunks = [(m['stream'], m['data']) for m in messages
+                      if m['status'] == 'output']
+            self.assertEquals(chunks, [
+                ('stdout', 'ok 12'), ('stdout', '3456'), ('stderr', 'warn')])
+            reply = messages[-1]
+            self.assertEquals(reply['status'], 'completed')
+            self.assertEquals(reply['data']['exit_code'], 0)
+            self.assertEquals(reply['data']['stdout_bytes'], 9)
+
+            # Characters split between chunks are decoded whole
+            text = u'\xe9\xe9\xe9 \u2713'.encode('utf-8')
+            _client().exec_start.return_value = StringIO(
+                struct.pack('>BxxxL', 1, len(text) + 1) + text + '\xe2')
+            worker.send.reset_mock()
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            messages = [call[0][2] for call in worker.send.call_args_list]
+            output = [m for m in messages if m['status'] == 'output']
+            self.assertEquals(
+                u''.join(m['data'] for m in output),
+                u'\xe9\xe9\xe9 \u2713\ufffd')
+            self.assertEquals(
+                [m['seq'] for m in output], range(len(output)))
+            self.assertEquals(messages[-1]['data']['stdout_bytes'], 11)
+
+            # A non-zero exit fails unless check_exit_code is off
+            _client().exec_start.return_value = StringIO('')
+            _client().exec_inspect.return_value = {'ExitCode': 3}
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            self.assertEquals(worker.send.call_args[0][2]['status'], 'failed')
+
+            _client().exec_start.return_value = StringIO('')
+            body['parameters']['check_exit_code'] = False
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            reply = worker.send.call_args[0][2]
+            self.assertEquals(reply['status'], 'completed')
+            self.assertEquals(reply['data']['exit_code'], 3)
+
+    def test_copy_to_container(self):
+        """
+        Verify CopyToContainer streams one archive to every container.
+        """
+        tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(tmpdir, 'bundles', 'web'))
+        with open(os.path.join(tmpdir, 'bundles', 'web', 'app.ini'), 'w') as f:
+            f.write('[app]\n')
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._config['copy_root'] = os.path.join(tmpdir, 'bundles')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            uploads = {}
+
+            def put_archive(container, path, data):
+                uploads[container] = (path, ''.join(data))
+                return True
+            _client().put_archive.side_effect = put_archive
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "CopyToContainer",
+                    "server_name": "localhost",
+                    "container_names": ["web1", "web2"],
+                    "path": "/etc/app",
+                    "source": "web",
+                    "files": {"extra.conf": "debug = 0\n"},
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            reply = worker.send.call_args[0][2]
+            self.assertEquals(reply['status'], 'completed')
+            self.assertEquals(reply['data']['members'], 2)
+            self.assertEquals(sorted(uploads), ['web1', 'web2'])
+            self.assertEquals(uploads['web1'], uploads['web2'])
+            path, data = uploads['web1']
+            self.assertEquals(path, '/etc/app')
+            self.assertEquals(len(data), reply['data']['bytes'])
+
+            # Sources outside of copy_root are refused
+            uploads.clear()
+            body['parameters']['source'] = '../../etc'
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            self.assertEquals(worker.send.call_args[0][2]['status'], 'failed')
+            self.assertEquals(uploads, {})
+
+            # A failing container fails the copy
+            _client().put_archive.side_effect = docker.errors.APIError(
+                'missing', mock.MagicMock(status_code=404))
+            body['parameters']['source'] = 'web'
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            self.assertEquals(worker.send.call_args[0][2]['status'], 'failed')
+
+            # An API version without put_archive is refused upfront
+            _client().put_archive.reset_mock()
+            worker._config['version'] = '1.15'
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            self.assertEquals(worker.send.call_args[0][2]['status'], 'failed')
+            self.assertEquals(_client().put_archive.call_count, 0)
+        shutil.rmtree(tmpdir)
+
+    def test_build_image(self):
+        """
+        Verify BuildImage streams the context, relays output and reuses
+        an unchanged build.
+        """
+        tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(tmpdir, 'app'))
+        with open(os.path.join(tmpdir, 'app', 'Dockerfile'), 'w') as f:
+            f.write('FROM busybox\n')
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._config['build_root'] = tmpdir
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            contexts = []
+
+            def build(fileobj=None, **kwargs):
+                contexts.append(''.join(fileobj))
+                return iter([
+                    '{"stream": "Step 0 : FROM busybox\\n"}',
+                    '{"stream": "Successfully built abc\\n"}'])
+            _client().build.side_effect = build
+            _client().pull.return_value = ''
+            _client().inspect_image.return_value = {'Id': 'abc'}
+            _client().get_image.return_value = StringIO('image tar')
+            loaded = []
+            _client().load_image.side_effect = (
+                lambda data: loaded.append(''.join(data)))
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "BuildImage",
+                    "server_name": "localhost",
+                    "tag": "app:1",
+                    "source": "app",
+                    "cache_from": ["app:0"],
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            _client().pull.assert_called_once_with(
+                'app:0', stream=True, insecure_registry=False)
+            self.assertEquals(len(contexts), 1)
+            messages = [call[0][2] for call in worker.send.call_args_list]
+            self.assertEquals(
+                [m['stream'] for m in messages if m['status'] == 'building'],
+                ['Step 0 : FROM busybox\n', 'Successfully built abc\n'])
+            reply = messages[-1]
+            self.assertEquals(reply['status'], 'completed')
+            self.assertEquals(reply['data']['image_id'], 'abc')
+            self.assertFalse(reply['data']['cached'])
+            self.assertEquals(
+                reply['data']['context_bytes'], len(contexts[0]))
+
+            # The same context is not sent again but can be distributed
+            _client().inspect_image.side_effect = [
+                {'Id': 'abc'}, docker.errors.APIError(
+                    'missing', mock.MagicMock(status_code=404))]
+            body['parameters']['distribute_to'] = ['other']
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            self.assertEquals(len(contexts), 1)
+            reply = worker.send.call_args[0][2]
+            self.assertEquals(reply['status'], 'completed')
+            self.assertTrue(reply['data']['cached'])
+            self.assertEquals(reply['data']['distributed_to'], ['other'])
+            _client().get_image.assert_called_once_with('app:1')
+            self.assertEquals(loaded, ['image tar'])
+
+            # Build errors in the output fail the build
+            _client().inspect_image.side_effect = None
+            body['parameters'].pop('distribute_to')
+            body['parameters']['nocache'] = True
+            worker.builds.clear()
+            _client().build.side_effect = None
+            _client().build.return_value = [
+                '{"error": "no space", "errorDetail": {"message": "full"}}']
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            reply = worker.send.call_args[0][2]
+            self.assertEquals(reply['status'], 'failed')
+        shutil.rmtree(tmpdir)
+
+    def test_export_import_image(self):
+        """
+        Verify images are saved to and loaded from the archive directory.
+        """
+        tmpdir = tempfile.mkdtemp()
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._config['image_archive'] = tmpdir
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            _client().inspect_image.return_value = {'Id': 'abc'}
+            _client().get_image.return_value = StringIO('image tar' * 100)
+            loaded = []
+            _client().load_image.side_effect = (
+                lambda data: loaded.append(list(data)))
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "ExportImage",
+                    "server_name": "localhost",
+                    "image_name": "app:1",
+                    "compress": True,
+                    "chunk_size": 256,
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            reply = worker.send.call_args[0][2]
+            self.assertEquals(reply['status'], 'completed')
+            self.assertEquals(reply['data']['archive_name'], 'app_1.tar.gz')
+            self.assertEquals(reply['data']['bytes'], 900)
+            self.assertEquals(
+                sorted(os.listdir(tmpdir)),
+                ['app_1.tar.gz', 'app_1.tar.gz.sha256'])
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "ImportImage",
+                    "server_name": "localhost",
+                    "image_name": "app:1",
+                    "chunk_size": 256,
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            reply = worker.send.call_args[0][2]
+            self.assertEquals(reply['status'], 'completed')
+            self.assertEquals(''.join(loaded[0]), 'image tar' * 100)
+            self.assertEquals(max(len(chunk) for chunk in loaded[0]), 256)
+
+            # Corrupted archives are not loaded
+            with open(os.path.join(tmpdir, 'app_1.tar.gz'), 'ab') as f:
+                f.write('junk')
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            self.assertEquals(worker.send.call_args[0][2]['status'], 'failed')
+            self.assertEquals(len(loaded), 1)
+
+            # Archive names can not leave the archive directory
+            body['parameters']['archive_name'] = '../app_1.tar.gz'
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            self.assertEquals(worker.send.call_args[0][2]['status'], 'failed')
+        shutil.rmtree(tmpdir)
+
+    def test_journal_done_after_publish(self):
+        """
+        Verify operations are only journaled done once their final reply
+        was confirmed by the broker.
+        """
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        with open(path, 'w') as config_file:
+            json.dump({
+                'queue': 'docker',
+                'version': '1.15',
+                'publisher': {'confirms': True},
+            }, config_file)
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('reworker.worker.Worker.send')) as (_, send):
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file=path)
+            os.unlink(path)
+            worker._on_open(mock.MagicMock())
+            worker._on_channel_open(mock.MagicMock())
+            worker.journal = mock.MagicMock()
+
+            worker._succeed(
+                self.properties, 'corr', 'StopContainer', {}, True)
+            self.assertEquals(worker.journal.done.call_count, 0)
+            worker.publisher.flush()
+            self.assertEquals(send.call_count, 1)
+            # Published but not confirmed yet
+            self.assertEquals(worker.journal.done.call_count, 0)
+            worker.publisher.on_delivery_confirmation(mock.MagicMock(
+                method=mock.MagicMock(
+                    NAME='Basic.Ack', delivery_tag=1, multiple=False)))
+            worker.journal.done.assert_called_once_with('corr', 'completed')
+
+    def test_msgpack_body(self):
+        """
+        Verify msgpack bodies are decoded once and handed to process.
+        """
+        bodies = []
+
+        def base_process(worker, channel, basic_deliver, properties, body):
+            bodies.append(body)
+            worker.process(
+                channel, basic_deliver, properties, json.loads(body),
+                self.logger)
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('reworker.worker.Worker._process',
+                           autospec=True, side_effect=base_process),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _, _client):
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "StopContainer",
+                    "server_name": "localhost",
+                    "container_name": "testing",
+                },
+            }
+            properties = mock.MagicMock(
+                content_type=dockerworker.encoding.MSGPACK)
+            worker._process(
+                self.channel, self.basic_deliver, properties,
+                dockerworker.encoding.encode(
+                    body, dockerworker.encoding.MSGPACK))
+
+            # The base worker only decoded an empty object and the
+            # subcommand still ran with the msgpack parameters
+            self.assertEquals(bodies, ['{}'])
+            self.assertEquals(self.app_logger.error.call_count, 0)
+            self.assertEquals(
+                worker.send.call_args[0][2]['status'], 'completed')
+            _client().stop.assert_called_once_with("testing", timeout=10)
+            self.assertEquals(worker._decoded.body, None)
+
+            # Undecodable bodies are rejected before the base worker
+            channel = mock.MagicMock()
+            worker._process(channel, self.basic_deliver, properties, '\xc1')
+            self.assertEquals(bodies, ['{}'])
+            channel.basic_reject.assert_called_once_with(
+                delivery_tag=self.basic_deliver.delivery_tag, requeue=False)
+
+    def test_watchdog(self):
+        """
+        Verify the watchdog reports and cancels overrunning subcommands.
+        """
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        with open(path, 'w') as config_file:
+            json.dump({
+                'queue': 'docker',
+                'version': '1.15',
+                'watchdog': {
+                    'deadlines': {'StopContainer': 30},
+                    'cancel': True,
+                    'interval': 3600,
+                },
+            }, config_file)
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file=path)
+            os.unlink(path)
+
+            # The publisher schedules its flushes on the I/O loop
+            worker._on_open(mock.MagicMock())
+            worker._on_channel_open(self.channel)
+
+            # The stop call hangs until the watchdog gives up on it
+            def stop(container_name, timeout=None):
+                for operation in worker.watchdog._running.values():
+                    operation.started -= 60
+                worker.watchdog.check()
+            _client().stop.side_effect = stop
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "StopContainer",
+                    "server_name": "localhost",
+                    "container_name": "test",
+                },
+            }
+            # Watched subcommands run off the I/O thread
+            self.assertTrue(worker.scheduler is not None)
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            worker.scheduler.stop()
+            worker.scheduler.join(5)
+            worker.watchdog.stop()
+
+            # Clients give up on stuck calls after the deadline
+            self.assertEquals(docker.Client.call_args[1]['timeout'], 30)
+            messages = [call[0][2] for call in worker.send.call_args_list]
+            self.assertEquals(
+                [m['status'] for m in messages],
+                ['started', 'overrun', 'failed'])
+            self.assertEquals(messages[-1]['reason'], 'timeout')
+            self.assertEquals(
+                messages[-1]['message'],
+                'StopContainer timed out after 30 seconds')
+            self.assertEquals(len(worker.watchdog), 0)
+
+            # A client timeout firing before the watchdog check fails the
+            # operation the same way
+            worker.send.reset_mock()
+            worker.scheduler = None
+            _client().stop.side_effect = requests.exceptions.ReadTimeout(
+                'read timed out')
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            reply = worker.send.call_args[0][2]
+            self.assertEquals(reply['status'], 'failed')
+            self.assertEquals(reply['reason'], 'timeout')
+            self.assertEquals(
+                reply['message'], 'StopContainer timed out after 30 seconds')
+
+            # Streamed responses are shut down when the operation is
+            # cancelled since docker-py reads them without a timeout
+            operation = worker.watchdog.start('corr', 'PullImage')
+            operation.deadline = 30
+            watchdog.activate(operation)
+            try:
+                worker._create_client('localhost')
+            finally:
+                watchdog.activate(None)
+            hook = _client().hooks['response'].append.call_args[0][0]
+            response = mock.MagicMock()
+            hook(response, stream=False)
+            self.assertEquals(operation.aborts, [])
+            hook(response, stream=True)
+            operation.aborts[0]()
+            _client()._get_raw_response_socket.assert_called_with(response)
+            _client()._get_raw_response_socket().shutdown.assert_called_with(
+                socket.SHUT_RDWR)
+
+
+    def test_watchdog_aborts_pull(self):
+        """
+        Verify cancelling a PullImage shuts down its streamed response.
+        """
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        with open(path, 'w') as config_file:
+            json.dump({
+                'queue': 'docker',
+                'version': '1.15',
+                'watchdog': {
+                    'deadlines': {'PullImage': 30},
+                    'cancel': True,
+                    'interval': 3600,
+                },
+            }, config_file)
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.dockerworker.DockerWorker.notify'),
+                mock.patch('replugin.dockerworker.DockerWorker.send'),
+                mock.patch('docker.Client')) as (_, _, _, _client):
+
+            worker = dockerworker.DockerWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file=path)
+            os.unlink(path)
+
+            worker._on_open(mock.MagicMock())
+            worker._on_channel_open(self.channel)
+
+            aborted = threading.Event()
+            _client()._get_raw_response_socket().shutdown.side_effect = (
+                lambda how: aborted.set())
+
+            # The pull output hangs until the watchdog gives up on it
+            def pull(reference, stream=False, insecure_registry=False):
+                hook = _client().hooks['response'].append.call_args[0][0]
+                hook(mock.MagicMock(), stream=stream)
+
+                def output():
+                    for operation in worker.watchdog._running.values():
+                        operation.started -= 60
+                    worker.watchdog.check()
+                    if not aborted.wait(5):
+                        yield '{"status": "Digest: sha256:abc"}'
+                return output()
+            _client().pull.side_effect = pull
+
+            body = {
+                "parameters": {
+                    "command": "docker",
+                    "subcommand": "PullImage",
+                    "server_name": "localhost",
+                    "image_name": "testing",
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            worker.scheduler.stop()
+            worker.scheduler.join(5)
+            worker.watchdog.stop()
+
+            self.assertTrue(aborted.is_set())
+            _client()._get_raw_response_socket().shutdown.assert_called_with(
+                socket.SHUT_RDWR)
+            messages = [call[0][2] for call in worker.send.call_args_list]
+            self.assertEquals(
+                [m['status'] for m in messages],
+                ['started', 'overrun', 'failed'])
+            self.assertEquals(messages[-1]['reason'], 'timeout')
+            self.assertEquals(len(worker.watchdog), 0)
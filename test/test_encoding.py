@@ -0,0 +1,64 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import unittest
+
+import mock
+
+from . import TestCase
+
+from replugin.dockerworker import encoding
+
+
+class TestEncoding(TestCase):
+
+    def test_json_default(self):
+        """
+        Verify JSON is used unless msgpack is asked for.
+        """
+        properties = mock.MagicMock(content_type='application/json')
+        self.assertEquals(encoding.reply_content_type(properties), None)
+        body = encoding.encode({'status': 'completed'}, None)
+        self.assertEquals(
+            encoding.decode(body, None), {'status': 'completed'})
+        self.assertRaises(
+            encoding.EncodingError, encoding.decode, '{bad', None)
+
+    @unittest.skipIf(encoding.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_round_trip(self):
+        """
+        Verify msgpack requests get msgpack replies which round trip.
+        """
+        properties = mock.MagicMock(content_type=encoding.MSGPACK)
+        self.assertEquals(
+            encoding.reply_content_type(properties), encoding.MSGPACK)
+        reply = {'status': 'completed', 'data': {'container_id': 'abc'}}
+        body = encoding.encode(reply, encoding.MSGPACK)
+        self.assertEquals(encoding.decode(body, encoding.MSGPACK), reply)
+
+    @unittest.skipIf(encoding.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_strings_are_text(self):
+        """
+        Verify byte strings in replies decode as text with raw=False.
+        """
+        reply = {'status': 'completed', 'data': {'name': u'caf\xe9'}}
+        body = encoding.encode(reply, encoding.MSGPACK)
+        decoded = encoding.msgpack.unpackb(body, raw=False)
+        self.assertEquals(decoded, reply)
+        self.assertTrue(isinstance(decoded['status'], unicode))
+        self.assertTrue(isinstance(decoded.keys()[0], unicode))
@@ -0,0 +1,50 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+from . import TestCase
+
+from replugin.dockerworker.images import registry_host, split_reference
+
+
+class TestImages(TestCase):
+
+    def test_split_reference(self):
+        """
+        Verify tags and digests are split from the repository.
+        """
+        self.assertEquals(
+            split_reference('testing'), ('testing', 'latest', None))
+        self.assertEquals(
+            split_reference('registry:5000/app:1.0'),
+            ('registry:5000/app', '1.0', None))
+        self.assertEquals(
+            split_reference('registry:5000/app'),
+            ('registry:5000/app', 'latest', None))
+        self.assertEquals(
+            split_reference('app@sha256:abc'), ('app', None, 'sha256:abc'))
+
+    def test_registry_host(self):
+        """
+        Verify the registry host is found in image names.
+        """
+        self.assertEquals(registry_host('testing'), 'docker.io')
+        self.assertEquals(registry_host('library/testing:1'), 'docker.io')
+        self.assertEquals(
+            registry_host('registry.example.com/app:1'),
+            'registry.example.com')
+        self.assertEquals(registry_host('localhost:5000/app'), 'localhost:5000')
@@ -0,0 +1,114 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import os
+import shutil
+import tempfile
+
+from . import TestCase
+
+from replugin.dockerworker.journal import Journal
+
+
+class TestJournal(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'journal')
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def test_unfinished(self):
+        """
+        Verify operations without a done record are read back with
+        their last phase.
+        """
+        journal = Journal(self.path)
+        self.assertEquals(journal.unfinished, [])
+        journal.accepted('1', 'PullImage', {'image_name': 'a'}, 'me')
+        journal.accepted('2', 'StartContainer', {'c': 'b'}, 'me')
+        journal.accepted('3', 'StopContainer', {'c': 'c'}, 'me')
+        journal.running('2')
+        journal.running('3')
+        journal.done('3', 'completed')
+        # Unknown operations are ignored
+        journal.done('4', 'failed')
+        journal.close()
+        # A torn write from a crash
+        with open(self.path, 'a') as journal_file:
+            journal_file.write('{"corr_id": "1", "pha')
+
+        journal = Journal(self.path)
+        unfinished = dict(
+            (entry['corr_id'], entry) for entry in journal.unfinished)
+        self.assertEquals(sorted(unfinished.keys()), ['1', '2'])
+        self.assertEquals(unfinished['1']['phase'], 'accepted')
+        self.assertEquals(unfinished['1']['params'], {'image_name': 'a'})
+        self.assertEquals(unfinished['2']['phase'], 'running')
+        self.assertEquals(unfinished['2']['reply_to'], 'me')
+        # The journal was compacted to the open operations, keeping
+        # the phase they reached
+        with open(self.path) as journal_file:
+            self.assertEquals(len(journal_file.readlines()), 3)
+        journal.close()
+        journal = Journal(self.path)
+        self.assertEquals(
+            [entry['phase'] for entry in journal.unfinished],
+            ['accepted', 'running'])
+
+        journal.done('1', 'completed')
+        journal.done('2', 'failed')
+        journal.close()
+        self.assertEquals(Journal(self.path).unfinished, [])
+
+    def test_truncate_when_idle(self):
+        """
+        Verify the journal is truncated once idle after compact_after
+        records.
+        """
+        journal = Journal(self.path, compact_after=4)
+        journal.accepted('1', 'PullImage', {}, 'me')
+        journal.done('1', 'completed')
+        self.assertTrue(os.path.getsize(self.path) > 0)
+        journal.accepted('2', 'PullImage', {}, 'me')
+        journal.done('2', 'completed')
+        self.assertEquals(os.path.getsize(self.path), 0)
+        journal.close()
+
+    def test_compact_while_busy(self):
+        """
+        Verify the journal is compacted to the open operations when
+        some are always open.
+        """
+        journal = Journal(self.path, compact_after=4)
+        journal.accepted('long', 'PullImage', {}, 'me')
+        journal.running('long')
+        for corr_id in ('1', '2', '3'):
+            journal.accepted(corr_id, 'StopContainer', {}, 'me')
+            journal.done(corr_id, 'completed')
+        # Only the accepted and running records of the open operation
+        with open(self.path) as journal_file:
+            self.assertEquals(len(journal_file.readlines()), 2)
+        journal.close()
+        unfinished = Journal(self.path).unfinished
+        self.assertEquals(len(unfinished), 1)
+        self.assertEquals(unfinished[0]['corr_id'], 'long')
+        self.assertEquals(unfinished[0]['phase'], 'running')
@@ -0,0 +1,78 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+from . import TestCase
+
+from replugin.dockerworker.profiles import compile_profiles
+from replugin.dockerworker.validation import ValidationError
+
+
+PROFILES = {
+    'web': {
+        'image_name': 'testing',
+        'container_command': '/bin/bash',
+        'container_ports': '443',
+        'port_bindings': {'443': ['0.0.0.0', 443]},
+        'hostname_template': '{container_name}.example.com',
+    },
+}
+
+
+class TestProfiles(TestCase):
+
+    def test_apply(self):
+        """
+        Verify profiles fill in parameters and messages override them.
+        """
+        profile = compile_profiles(PROFILES)['web']
+        params = profile.apply({
+            'subcommand': 'CreateContainer',
+            'server_name': 'localhost',
+            'container_name': 'web1',
+            'container_command': '/bin/sh',
+        })
+        self.assertEquals(params['image_name'], 'testing')
+        self.assertEquals(params['container_command'], '/bin/sh')
+        self.assertEquals(params['container_ports'], ['443'])
+        self.assertEquals(params['container_hostname'], 'web1.example.com')
+
+    def test_deferred_hostname(self):
+        """
+        Verify the hostname template is passed on when there is no
+        container name to fill it with yet.
+        """
+        profile = compile_profiles(PROFILES)['web']
+        params = profile.apply({
+            'subcommand': 'ScaleContainers',
+            'server_name': 'localhost',
+            'container_name_template': 'web-{index}',
+        })
+        self.assertFalse('container_hostname' in params)
+        self.assertEquals(
+            params['hostname_template'], '{container_name}.example.com')
+
+    def test_invalid_profile(self):
+        """
+        Verify bad profiles are rejected when compiled.
+        """
+        self.assertRaises(
+            ValidationError, compile_profiles,
+            {'bad': {'container_binds': ['/test']}})
+        self.assertRaises(
+            ValidationError, compile_profiles,
+            {'bad': {'not_a_key': 'value'}})
@@ -0,0 +1,46 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+from . import TestCase
+
+from replugin.dockerworker import progress
+
+
+class TestProgress(TestCase):
+
+    def test_iter_events_split_chunks(self):
+        """
+        Verify objects split across chunks and concatenated are parsed.
+        """
+        chunks = ['{"status": "Pulling"}{"sta', 'tus": "Done"}\r\n']
+        self.assertEquals(
+            list(progress.iter_events(chunks)),
+            [{'status': 'Pulling'}, {'status': 'Done'}])
+
+    def test_pull_summary(self):
+        """
+        Verify the digest and errors are found in pull output.
+        """
+        output = (
+            '{"status": "Pulling from testing"}'
+            '{"status": "Digest: sha256:abc123"}')
+        self.assertEquals(
+            progress.pull_summary(output), ('sha256:abc123', None))
+
+        output = '{"error": "not found", "errorDetail": {"message": "nope"}}'
+        self.assertEquals(progress.pull_summary(output), (None, 'nope'))
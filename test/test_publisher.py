@@ -0,0 +1,123 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import mock
+
+from . import TestCase
+
+from replugin.dockerworker.publisher import Publisher
+
+
+class TestPublisher(TestCase):
+
+    def test_batched_flush(self):
+        """
+        Verify queued calls only run when a batch is flushed.
+        """
+        sent = []
+        publisher = Publisher()
+        publisher.publish(sent.append, 'started')
+        publisher.publish(sent.append, 'completed')
+        publisher.put(sent.append, 'ack')
+        self.assertEquals(sent, [])
+        self.assertFalse(publisher.wait_empty(0.01))
+        self.assertEquals(publisher.flush(), 3)
+        self.assertEquals(sent, ['started', 'completed', 'ack'])
+        self.assertTrue(publisher.wait_empty(0.01))
+
+    def test_timer_reschedules(self):
+        """
+        Verify the flush timer runs on the connection I/O loop.
+        """
+        connection = mock.MagicMock()
+        channel = mock.MagicMock()
+        publisher = Publisher(flush_interval=0.5, confirms=True)
+        publisher.start(connection, channel)
+        channel.confirm_delivery.assert_called_once_with(
+            publisher.on_delivery_confirmation)
+        connection.add_timeout.assert_called_once_with(
+            0.5, publisher._on_timer)
+        publisher._on_timer()
+        self.assertEquals(connection.add_timeout.call_count, 2)
+
+    def test_batched_confirms(self):
+        """
+        Verify a multiple ack confirms every publish up to its tag.
+        """
+        publisher = Publisher(confirms=True)
+        for _ in range(3):
+            publisher.publish(lambda: None)
+        publisher.flush()
+        self.assertEquals(publisher.unconfirmed, 3)
+
+        frame = mock.MagicMock()
+        frame.method.NAME = 'Basic.Ack'
+        frame.method.delivery_tag = 2
+        frame.method.multiple = True
+        publisher.on_delivery_confirmation(frame)
+        self.assertEquals(publisher.unconfirmed, 1)
+
+        frame.method.NAME = 'Basic.Nack'
+        frame.method.delivery_tag = 3
+        frame.method.multiple = False
+        publisher.on_delivery_confirmation(frame)
+        self.assertEquals(publisher.unconfirmed, 0)
+        self.assertEquals(publisher.nacked, 1)
+
+    def test_nack_retry(self):
+        """
+        Verify nacked publishes are sent again and acks wait for them.
+        """
+        sent = []
+        publisher = Publisher(confirms=True, max_retries=1)
+        publisher.publish(sent.append, 'reply')
+        publisher.put(sent.append, 'ack')
+        publisher.flush()
+        self.assertEquals(sent, ['reply'])
+
+        frame = mock.MagicMock()
+        frame.method.NAME = 'Basic.Nack'
+        frame.method.delivery_tag = 1
+        frame.method.multiple = False
+        publisher.on_delivery_confirmation(frame)
+        self.assertEquals(publisher.nacked, 1)
+        publisher.flush()
+        self.assertEquals(sent, ['reply', 'reply'])
+
+        frame.method.NAME = 'Basic.Ack'
+        frame.method.delivery_tag = 2
+        publisher.on_delivery_confirmation(frame)
+        self.assertEquals(sent, ['reply', 'reply', 'ack'])
+        self.assertEquals(publisher.unconfirmed, 0)
+
+    def test_reopen(self):
+        """
+        Verify a reopened channel resends unconfirmed publishes and
+        keeps a single flush timer.
+        """
+        connection = mock.MagicMock()
+        sent = []
+        publisher = Publisher(confirms=True)
+        publisher.start(connection, mock.MagicMock())
+        publisher.publish(sent.append, 'reply')
+        publisher.flush()
+        publisher.start(connection, mock.MagicMock())
+        self.assertEquals(connection.add_timeout.call_count, 1)
+        self.assertEquals(publisher.flush(), 1)
+        self.assertEquals(sent, ['reply', 'reply'])
+        self.assertEquals(publisher._unconfirmed.keys(), [1])
@@ -0,0 +1,106 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import threading
+
+from . import TestCase
+
+from replugin.dockerworker.ratelimit import RegistryLimiter, TokenBucket
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.waits = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.waits.append(seconds)
+
+
+class TestTokenBucket(TestCase):
+
+    def test_acquire(self):
+        """
+        Verify bursts pass at once and later tokens are spaced by rate.
+        """
+        clock = FakeClock()
+        bucket = TokenBucket(2, burst=2, clock=clock, sleep=clock.sleep)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEquals(clock.waits, [])
+        # Queued callers wait for successive tokens
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEquals(clock.waits, [0.5, 1.0])
+        # Tokens refill over time up to the burst
+        clock.now = 10.0
+        clock.waits = []
+        bucket.acquire()
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEquals(clock.waits, [0.5])
+
+
+class TestRegistryLimiter(TestCase):
+
+    def test_limit_for(self):
+        """
+        Verify registries fall back to the * limits.
+        """
+        limiter = RegistryLimiter({
+            'registry.example.com': {'concurrency': 2},
+            '*': {'rate': 10},
+        })
+        self.assertEquals(
+            limiter.limit_for('registry.example.com').concurrency, 2)
+        self.assertTrue(limiter.limit_for('docker.io').bucket is not None)
+        self.assertEquals(RegistryLimiter({}).limit_for('docker.io'), None)
+
+    def test_concurrency(self):
+        """
+        Verify pulls over the concurrency cap wait instead of failing.
+        """
+        limiter = RegistryLimiter({'registry.example.com': {'concurrency': 2}})
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0, 'done': 0}
+
+        def pull():
+            with limiter.slot('registry.example.com'):
+                with lock:
+                    state['running'] += 1
+                    state['peak'] = max(state['peak'], state['running'])
+                threading.Event().wait(0.01)
+                with lock:
+                    state['running'] -= 1
+                    state['done'] += 1
+
+        threads = [threading.Thread(target=pull) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEquals(state['done'], 6)
+        self.assertEquals(state['peak'], 2)
+
+        # Other registries are not limited
+        with limiter.slot('docker.io'):
+            pass
@@ -0,0 +1,156 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import docker
+import json
+import logging
+import mock
+import os
+import sys
+import tempfile
+
+from StringIO import StringIO
+from contextlib import nested
+
+from . import TestCase
+
+from replugin.dockerworker import replay
+
+
+MQ_CONF = {
+    'server': '127.0.0.1',
+    'port': 5672,
+    'vhost': '/',
+    'user': 'guest',
+    'password': 'guest',
+}
+
+
+def message(subcommand, **params):
+    params.update(
+        command='docker', subcommand=subcommand, server_name='localhost')
+    return {'parameters': params}
+
+
+class TestReplay(TestCase):
+
+    def test_read_trace(self):
+        """
+        Verify both trace line formats are read and ordered by offset.
+        """
+        trace = replay.read_trace([
+            json.dumps({'body': message('PullImage'), 'timestamp': 102.5,
+                        'properties': {'correlation_id': 'b'}}),
+            '',
+            json.dumps({'body': message('StopContainer'),
+                        'timestamp': 100.0}),
+        ])
+        self.assertEquals([t[0] for t in trace], [0.0, 2.5])
+        self.assertEquals(trace[0][2]['correlation_id'], 'replay-2')
+        self.assertEquals(trace[1][2]['correlation_id'], 'b')
+
+        trace = replay.read_trace([json.dumps(message('PullImage'))])
+        self.assertEquals(trace[0][0], 0.0)
+        self.assertEquals(trace[0][2]['reply_to'], 'replay')
+
+    def test_percentile(self):
+        """
+        Verify nearest rank percentiles.
+        """
+        values = range(1, 101)
+        self.assertEquals(replay.percentile(values, 50), 50)
+        self.assertEquals(replay.percentile(values, 99), 99)
+        self.assertEquals(replay.percentile(values, 100), 100)
+        self.assertEquals(replay.percentile([], 50), None)
+
+    def test_fake_docker_client(self):
+        """
+        Verify the stand-in Docker API keeps state like a daemon.
+        """
+        client = replay.FakeDockerClient(replay.FakeDockerHost(), latency=0)
+        self.assertRaises(
+            docker.errors.APIError, client.inspect_image, 'testing')
+        client.pull('testing')
+        self.assertEquals(client.inspect_image('testing')['Id'], 'testing')
+        container_id = client.create_container('testing', name='web')['Id']
+        self.assertRaises(
+            docker.errors.APIError, client.create_container,
+            'testing', name='web')
+        client.start(container_id)
+        self.assertEquals(client.containers()[0]['Names'], ['/web'])
+        client.stop('web')
+        self.assertEquals(client.containers(), [])
+        client.remove_container('web')
+        self.assertRaises(docker.errors.APIError, client.start, 'web')
+
+        failing = replay.FakeDockerClient(
+            replay.FakeDockerHost(), latency=0, error_rate=1.0)
+        self.assertRaises(docker.errors.APIError, failing.pull, 'testing')
+
+    def test_run(self):
+        """
+        Verify a replay reports completions, latency and failures.
+        """
+        lines = [
+            json.dumps(message('PullImage', image_name='testing')),
+            json.dumps(message(
+                'CreateContainer', image_name='testing',
+                container_name='web', container_command='/bin/bash')),
+            json.dumps(message('StartContainer', container_name='web')),
+            json.dumps(message('StopContainer', container_name='nope')),
+        ]
+        with mock.patch('pika.SelectConnection'):
+            worker = replay.ReplayWorker(
+                MQ_CONF,
+                config_file='conf/example.json',
+                logger=logging.getLogger('test'),
+                latency=0)
+        report = replay.Replay(
+            worker, replay.read_trace(lines), speed=0).run()
+        self.assertEquals(report['messages'], 4)
+        self.assertEquals(report['completed'], 3)
+        self.assertEquals(report['failed'], 1)
+        self.assertEquals(report['unanswered'], 0)
+        self.assertEquals(
+            report['failures'],
+            {'StopContainer: No such container is running currently.': 1})
+        self.assertTrue(report['latency']['p50'] is not None)
+        self.assertTrue('throughput' in replay.format_report(report))
+
+    def test_main(self):
+        """
+        Verify main replays a trace file without connecting to a broker.
+        """
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(fd, 'w') as trace_file:
+            trace_file.write(json.dumps(message(
+                'PullImage', image_name='testing')) + '\n')
+        self.addCleanup(os.remove, path)
+        argv = [
+            'replay', path, '-c', 'conf/example.json', '--speed', '0',
+            '--latency', '0']
+        with nested(
+                mock.patch('pika.SelectConnection',
+                           side_effect=AssertionError('connected')),
+                mock.patch('logging.basicConfig'),
+                mock.patch.object(sys, 'argv', argv),
+                mock.patch.object(sys, 'stdout', StringIO())
+        ) as (connection, _, _, stdout):
+            replay.main()
+        self.assertFalse(connection.called)
+        self.assertTrue('completed 1 failed 0' in stdout.getvalue())
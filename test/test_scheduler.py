@@ -0,0 +1,273 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import threading
+
+from . import TestCase
+
+from replugin.dockerworker.adaptive import AdaptiveConcurrency
+from replugin.dockerworker.scheduler import (
+    HostLimits, Lane, LaneScheduler, run_parallel)
+
+
+class TestLane(TestCase):
+
+    def run_blocked(self, lane, jobs):
+        """
+        Queues jobs behind a blocking job so they are ordered together,
+        then lets the lane drain.
+        """
+        gate = threading.Event()
+        lane.submit(gate.wait)
+        for job in jobs:
+            lane.submit(*job[0], **job[1])
+        gate.set()
+        lane.stop()
+        lane.join(5)
+
+    def test_priority_then_deadline_order(self):
+        """
+        Verify higher priority runs first, then earlier deadlines.
+        """
+        order = []
+        lane = Lane('test', 1)
+        self.run_blocked(lane, [
+            ((lambda: order.append('low'),), {'priority': 0}),
+            ((lambda: order.append('late'),), {'priority': 5, 'deadline': 2e10}),
+            ((lambda: order.append('soon'),), {'priority': 5, 'deadline': 1e10}),
+        ])
+        self.assertEquals(order, ['soon', 'late', 'low'])
+
+    def test_expired_job(self):
+        """
+        Verify jobs past their deadline are expired instead of run.
+        """
+        order = []
+        lane = Lane('test', 1)
+        self.run_blocked(lane, [
+            ((lambda: order.append('run'),), {
+                'deadline': 1,
+                'on_expired': lambda: order.append('expired')}),
+        ])
+        self.assertEquals(order, ['expired'])
+
+
+class TestLaneScheduler(TestCase):
+
+    def test_routing(self):
+        """
+        Verify subcommands are routed to their lanes.
+        """
+        scheduler = LaneScheduler(True)
+        self.assertEquals(scheduler.lane_for('StopContainer').name, 'fast')
+        self.assertEquals(scheduler.lane_for('PullImage').name, 'slow')
+        self.assertEquals(scheduler.lane_for('Unknown').name, 'slow')
+        self.assertEquals(scheduler.lanes['fast'].concurrency, 4)
+        scheduler.stop()
+        scheduler.join(5)
+
+    def test_host_cap_and_fairness(self):
+        """
+        Verify per host caps hold and hosts are served round-robin.
+        """
+        order = []
+        peak = {}
+        lock = threading.Lock()
+        gate = threading.Event()
+
+        def job(host):
+            def run():
+                with lock:
+                    order.append(host)
+                    peak[host] = max(
+                        peak.get(host, 0),
+                        scheduler.limits.in_flight[host])
+            return run
+
+        scheduler = LaneScheduler(
+            {'all': {'concurrency': 2}}, host_limit=1)
+        scheduler.submit('StopContainer', gate.wait)
+        scheduler.submit('StopContainer', gate.wait)
+        for _ in range(3):
+            scheduler.submit('StopContainer', job('a'), host='a')
+        scheduler.submit('StopContainer', job('b'), host='b')
+        gate.set()
+        scheduler.stop()
+        scheduler.join(5)
+        # b is not starved behind the backlog on a
+        self.assertEquals(set(order[:2]), set(['a', 'b']))
+        self.assertEquals(len(order), 4)
+        self.assertEquals(peak, {'a': 1, 'b': 1})
+
+    def test_reserved_slots(self):
+        """
+        Verify a lane with reserved slots runs on a host saturated by
+        other lanes.
+        """
+        gate = threading.Event()
+        started = threading.Semaphore(0)
+        stopped = threading.Event()
+        in_flight = []
+
+        def pull():
+            started.release()
+            gate.wait(5)
+
+        def stop():
+            # A job in a reserved slot keeps it when fanning out
+            with scheduler.yield_slot('a'):
+                in_flight.append(dict(scheduler.limits.in_flight))
+            stopped.set()
+
+        scheduler = LaneScheduler({
+            'fast': {
+                'concurrency': 2,
+                'reserved_per_host': 1,
+                'subcommands': ['StopContainer'],
+            },
+            'slow': {'concurrency': 3, 'subcommands': ['PullImage']},
+        }, default_lane='slow', host_limit=2)
+        for _ in range(3):
+            scheduler.submit('PullImage', pull, host='a')
+        started.acquire()
+        started.acquire()
+        # The host is at its cap with pulls; the third pull waits
+        self.assertEquals(scheduler.limits.in_flight, {'a': 2})
+        scheduler.submit('StopContainer', stop, host='a')
+        self.assertTrue(stopped.wait(5))
+        self.assertEquals(in_flight, [{'a': 2}])
+        self.assertFalse(started.acquire(False))
+        gate.set()
+        scheduler.stop()
+        scheduler.join(5)
+        self.assertEquals(scheduler.limits.in_flight, {})
+        self.assertEquals(scheduler.lanes['fast']._reserved, {})
+
+        scheduler.reconfigure({'fast': {'reserved_per_host': 0}})
+        self.assertEquals(scheduler.lanes['fast'].reserved_per_host, 0)
+
+    def test_reconfigure(self):
+        """
+        Verify lanes resize and host caps change in place.
+        """
+        scheduler = LaneScheduler(
+            {'all': {'concurrency': 2}}, host_limit=1)
+        lane = scheduler.lanes['all']
+        scheduler.reconfigure(
+            {'all': {'concurrency': 4}}, host_limit=3,
+            host_overrides={'big': 8})
+        self.assertEquals(lane.concurrency, 4)
+        self.assertEquals(len(lane._threads), 4)
+        self.assertEquals(scheduler.limits.limit_for('small'), 3)
+        self.assertEquals(scheduler.limits.limit_for('big'), 8)
+
+        scheduler.reconfigure({'all': {'concurrency': 1}})
+        # Surplus threads retire once idle
+        for _ in range(100):
+            if len(lane._threads) == 1:
+                break
+            threading.Event().wait(0.01)
+        self.assertEquals(len(lane._threads), 1)
+        self.assertEquals(scheduler.in_flight, 0)
+        scheduler.stop()
+        scheduler.join(5)
+
+    def test_host_slot(self):
+        """
+        Verify host slots count against the host cap of lane jobs.
+        """
+        ran = threading.Event()
+        scheduler = LaneScheduler(
+            {'all': {'concurrency': 1}}, host_limit=1)
+        with scheduler.host_slot('a'):
+            self.assertEquals(scheduler.limits.in_flight, {'a': 1})
+            scheduler.submit('StopContainer', ran.set, host='a')
+            self.assertFalse(ran.wait(0.1))
+        self.assertTrue(ran.wait(5))
+
+        # A job handing its slot to its own fan out
+        def job():
+            with scheduler.yield_slot('a'):
+                with scheduler.host_slot('a'):
+                    state.append(dict(scheduler.limits.in_flight))
+            state.append(dict(scheduler.limits.in_flight))
+            ran.set()
+        state = []
+        ran.clear()
+        scheduler.submit('StopContainer', job, host='a')
+        self.assertTrue(ran.wait(5))
+        self.assertEquals(state, [{'a': 1}, {'a': 1}])
+        scheduler.stop()
+        scheduler.join(5)
+        self.assertEquals(scheduler.limits.in_flight, {})
+
+    def test_adaptive_limits(self):
+        """
+        Verify adaptive caps apply to hosts without an override.
+        """
+        adaptive = AdaptiveConcurrency(initial=3)
+        limits = HostLimits(2, {'pinned': 1}, adaptive)
+        self.assertEquals(limits.limit_for('host1'), 3)
+        self.assertEquals(limits.limit_for('pinned'), 1)
+        self.assertEquals(limits.limit_for(None), None)
+        # Reaching the cap marks the window of the host as saturated
+        limits.acquire('host1')
+        limits.acquire('host1')
+        self.assertFalse('host1' in adaptive._windows)
+        limits.acquire('host1')
+        self.assertTrue(adaptive._windows['host1'][3])
+        limits.acquire('pinned')
+        self.assertFalse('pinned' in adaptive._windows)
+
+        scheduler = LaneScheduler(
+            {'all': {'concurrency': 1}}, adaptive=adaptive)
+        self.assertTrue(scheduler.limits.adaptive is adaptive)
+        self.assertEquals(adaptive.on_change, scheduler.wake)
+        scheduler.stop()
+        scheduler.join(5)
+
+
+class TestRunParallel(TestCase):
+
+    def test_run_parallel(self):
+        """
+        Verify run_parallel keeps order, captures errors and respects
+        its limit.
+        """
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def job(value):
+            def run():
+                with lock:
+                    state['running'] += 1
+                    state['peak'] = max(state['peak'], state['running'])
+                threading.Event().wait(0.01)
+                with lock:
+                    state['running'] -= 1
+                if value is None:
+                    raise ValueError('boom')
+                return value
+            return run
+
+        results = run_parallel(
+            [job(1), job(None), job(3), job(4), job(5)], 2)
+        self.assertEquals([r[0] for r in results], [1, None, 3, 4, 5])
+        self.assertTrue(isinstance(results[1][1], ValueError))
+        self.assertTrue(state['peak'] <= 2)
+        self.assertEquals(run_parallel([], 4), [])
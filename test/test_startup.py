@@ -0,0 +1,57 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import subprocess
+import sys
+import time
+
+from . import TestCase
+
+from replugin.dockerworker import startup
+
+
+class TestStartup(TestCase):
+
+    def test_lazy_module(self):
+        """
+        Verify the module is only imported on first attribute access.
+        """
+        sys.modules.pop('colorsys', None)
+        lazy = startup.LazyModule('colorsys')
+        self.assertFalse('colorsys' in sys.modules)
+        self.assertEquals(lazy.rgb_to_hsv(0, 0, 0), (0, 0, 0))
+        self.assertTrue('colorsys' in sys.modules)
+
+    def test_seconds_since_launch(self):
+        """
+        Verify the launch time is in the past.
+        """
+        started = startup.process_start_time()
+        if started is not None:
+            self.assertTrue(started <= time.time())
+        self.assertTrue(startup.seconds_since_launch() >= 0)
+
+    def test_msgpack_is_lazy(self):
+        """
+        Verify importing the encoding module does not import msgpack.
+        """
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys; import replugin.dockerworker.encoding; '
+            'print("msgpack" in sys.modules)'])
+        self.assertEquals(output.strip(), 'False')
@@ -0,0 +1,75 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import struct
+
+from StringIO import StringIO
+
+from . import TestCase
+
+from replugin.dockerworker.streams import iter_chunks, iter_frames, iter_read
+
+
+def frame(stream, data):
+    return struct.pack('>BxxxL', stream, len(data)) + data
+
+
+class TrickleSocket(object):
+    """
+    Socket returning at most 3 bytes per recv.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def recv(self, size):
+        chunk, self.data = self.data[:min(size, 3)], self.data[min(size, 3):]
+        return chunk
+
+
+class TestStreams(TestCase):
+
+    def test_iter_frames(self):
+        """
+        Verify frames are demultiplexed however the bytes arrive.
+        """
+        raw = frame(1, 'hello\n') + frame(2, 'oops\n') + frame(1, 'bye\n')
+        expected = [(1, 'hello\n'), (2, 'oops\n'), (1, 'bye\n')]
+        self.assertEquals(list(iter_frames(StringIO(raw))), expected)
+        self.assertEquals(list(iter_frames(TrickleSocket(raw))), expected)
+        # A stream cut off mid frame yields what arrived
+        self.assertEquals(
+            list(iter_frames(StringIO(raw[:-2]))),
+            [(1, 'hello\n'), (2, 'oops\n'), (1, 'by')])
+        self.assertEquals(list(iter_frames(StringIO(''))), [])
+
+    def test_iter_chunks(self):
+        """
+        Verify frames are split into bounded chunks.
+        """
+        chunks = list(iter_chunks([(1, 'abcdefg'), (2, 'hi')], 3))
+        self.assertEquals(
+            chunks, [(1, 'abc'), (1, 'def'), (1, 'g'), (2, 'hi')])
+
+    def test_iter_read(self):
+        """
+        Verify a stream is read in bounded chunks until it ends.
+        """
+        self.assertEquals(
+            list(iter_read(StringIO('abcdefg'), 3)), ['abc', 'def', 'g'])
+        self.assertEquals(list(iter_read(StringIO(''))), [])
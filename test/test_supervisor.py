@@ -0,0 +1,62 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import os
+import tempfile
+
+from . import TestCase
+
+from replugin.dockerworker.supervisor import Supervisor, parse_processes
+
+
+class TestSupervisor(TestCase):
+
+    def test_parse_processes(self):
+        """
+        Verify --processes is removed from the arguments.
+        """
+        argv = ['re-worker-docker', '--processes', '4', 'mq.json']
+        self.assertEquals(parse_processes(argv), 4)
+        self.assertEquals(argv, ['re-worker-docker', 'mq.json'])
+
+        argv = ['re-worker-docker', 'mq.json']
+        self.assertEquals(parse_processes(argv), 1)
+
+    def test_restart_crashed_child(self):
+        """
+        Verify a crashed child is restarted with its index and a clean
+        exit is not.
+        """
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+
+        def target(index):
+            with open(path, 'a') as runs:
+                runs.write('%d\n' % index)
+            with open(path) as runs:
+                if len(runs.readlines()) < 2:
+                    raise Exception('crash')
+
+        try:
+            supervisor = Supervisor(target, 1, restart_delay=0)
+            supervisor.run()
+            self.assertEquals(supervisor.restarts, 1)
+            with open(path) as runs:
+                self.assertEquals(runs.readlines(), ['0\n', '0\n'])
+        finally:
+            os.unlink(path)
@@ -0,0 +1,120 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import os
+import shutil
+import tarfile
+import tempfile
+
+from StringIO import StringIO
+
+from . import TestCase
+
+from replugin.dockerworker.tarstream import Archive
+
+
+def read(archive):
+    return tarfile.open(fileobj=StringIO(''.join(archive)))
+
+
+class TestArchive(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_add_bytes(self):
+        """
+        Verify inline files round trip and size matches the stream.
+        """
+        archive = Archive(chunk_size=7)
+        archive.add_bytes('etc/app.conf', 'port = 8080\n' * 100, mtime=1)
+        archive.add_bytes('motd', u'h\xe9llo', mode=0600, mtime=1)
+        stream = ''.join(archive)
+        self.assertEquals(len(stream), archive.size)
+        self.assertEquals(len(stream) % 512, 0)
+        # Every iteration generates the same stream again
+        self.assertEquals(''.join(archive), stream)
+
+        tar = read(archive)
+        self.assertEquals(tar.getnames(), ['etc/app.conf', 'motd'])
+        self.assertEquals(
+            tar.extractfile('etc/app.conf').read(), 'port = 8080\n' * 100)
+        self.assertEquals(tar.extractfile('motd').read(), 'h\xc3\xa9llo')
+        self.assertEquals(tar.getmember('motd').mode, 0600)
+
+    def test_add_directory(self):
+        """
+        Verify directories, files and symlinks are added in order.
+        """
+        os.makedirs(os.path.join(self.tmpdir, 'conf', 'd'))
+        with open(os.path.join(self.tmpdir, 'conf', 'd', 'b'), 'w') as f:
+            f.write('b' * 1000)
+        with open(os.path.join(self.tmpdir, 'a'), 'w') as f:
+            f.write('a')
+        os.symlink('a', os.path.join(self.tmpdir, 'link'))
+
+        archive = Archive()
+        archive.add_directory(self.tmpdir, 'srv')
+        self.assertEquals(len(archive), 5)
+        self.assertEquals(len(''.join(archive)), archive.size)
+
+        tar = read(archive)
+        self.assertEquals(tar.getnames(), [
+            'srv/conf', 'srv/a', 'srv/link', 'srv/conf/d', 'srv/conf/d/b'])
+        self.assertTrue(tar.getmember('srv/conf').isdir())
+        self.assertEquals(tar.getmember('srv/link').linkname, 'a')
+        self.assertEquals(tar.extractfile('srv/conf/d/b').read(), 'b' * 1000)
+
+    def test_shrunk_file(self):
+        """
+        Verify a file shrinking after it was added is zero filled.
+        """
+        path = os.path.join(self.tmpdir, 'log')
+        with open(path, 'w') as f:
+            f.write('x' * 600)
+        archive = Archive()
+        archive.add_directory(self.tmpdir)
+        with open(path, 'w') as f:
+            f.write('x' * 10)
+        self.assertEquals(len(''.join(archive)), archive.size)
+        self.assertEquals(
+            read(archive).extractfile('log').read(), 'x' * 10 + '\0' * 590)
+
+    def test_digest(self):
+        """
+        Verify the digest follows contents but not modification times.
+        """
+        with open(os.path.join(self.tmpdir, 'Dockerfile'), 'w') as f:
+            f.write('FROM scratch\n')
+        archive = Archive()
+        archive.add_directory(self.tmpdir)
+        digest = archive.digest()
+        os.utime(os.path.join(self.tmpdir, 'Dockerfile'), (1, 1))
+        touched = Archive()
+        touched.add_directory(self.tmpdir)
+        self.assertEquals(touched.digest(), digest)
+        self.assertNotEquals(''.join(touched), ''.join(archive))
+
+        with open(os.path.join(self.tmpdir, 'Dockerfile'), 'w') as f:
+            f.write('FROM busybox\n')
+        changed = Archive()
+        changed.add_directory(self.tmpdir)
+        self.assertNotEquals(changed.digest(), digest)
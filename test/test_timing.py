@@ -0,0 +1,86 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import mock
+
+from . import TestCase
+
+from replugin.dockerworker import timing
+
+
+class TestTiming(TestCase):
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        timing.activate(None)
+
+    def test_phases_accumulate(self):
+        """
+        Verify repeated phases add up and are reported in milliseconds.
+        """
+        trace = timing.Trace()
+        trace.add('publishing', 0.001)
+        trace.add('publishing', 0.002)
+        self.assertEquals(trace.as_dict(), {'publishing': 3.0})
+
+    def test_negative_durations(self):
+        """
+        Verify a clock stepped backwards does not produce negative
+        timings.
+        """
+        trace = timing.Trace()
+        trace.add('publishing', 0.002)
+        trace.add('publishing', -5)
+        self.assertEquals(trace.as_dict(), {'publishing': 2.0})
+
+    def test_phase_without_trace(self):
+        """
+        Verify phases are a no-op when no trace is active.
+        """
+        with timing.phase('validating'):
+            pass
+        self.assertEquals(timing.current(), None)
+
+    def test_timed_client(self):
+        """
+        Verify each Docker API call is timed under its own phase.
+        """
+        trace = timing.Trace()
+        timing.activate(trace)
+        client = mock.MagicMock()
+        client.stop.return_value = 'stopped'
+        timed = timing.TimedClient(client)
+        self.assertEquals(timed.stop('testing', timeout=10), 'stopped')
+        client.stop.assert_called_once_with('testing', timeout=10)
+        self.assertEquals(trace.phases.keys(), ['docker.stop'])
+
+    def test_timed_client_observer(self):
+        """
+        Verify the observer sees every call with its duration and error.
+        """
+        observed = []
+        client = mock.MagicMock()
+        client.start.side_effect = ValueError('boom')
+        timed = timing.TimedClient(
+            client, observer=lambda *args: observed.append(args))
+        timed.stop('testing')
+        self.assertRaises(ValueError, timed.start, 'testing')
+        self.assertEquals([o[0] for o in observed], ['stop', 'start'])
+        self.assertEquals(observed[0][2], None)
+        self.assertTrue(isinstance(observed[1][2], ValueError))
+        self.assertTrue(observed[0][1] >= 0)
@@ -0,0 +1,144 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import json
+import os
+import tempfile
+
+from . import TestCase
+
+from replugin.dockerworker import tracing
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+
+
+class TestTracing(TestCase):
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        tracing.activate(None)
+
+    def test_parse_headers(self):
+        """
+        Verify trace ids are read from traceparent, B3 and plain headers.
+        """
+        self.assertEquals(
+            tracing.parse_headers({
+                'traceparent': '00-%s-%s-01' % (TRACE_ID, PARENT_ID)}),
+            (TRACE_ID, PARENT_ID))
+        self.assertEquals(
+            tracing.parse_headers({
+                'X-B3-TraceId': TRACE_ID, 'X-B3-SpanId': PARENT_ID}),
+            (TRACE_ID, PARENT_ID))
+        self.assertEquals(
+            tracing.parse_headers({'trace_id': 'abc'}), ('abc', None))
+        self.assertEquals(tracing.parse_headers(None), (None, None))
+        self.assertEquals(
+            tracing.parse_headers({'traceparent': 'junk'}), (None, None))
+
+    def test_new_id_after_fork(self):
+        """
+        Verify forked processes do not generate the same ids.
+        """
+        self.assertEquals(len(tracing.new_id()), 16)
+        self.assertEquals(len(tracing.new_id(128)), 32)
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            os.write(write_fd, tracing.new_id())
+            os._exit(0)
+        os.close(write_fd)
+        parent_id = tracing.new_id()
+        os.waitpid(pid, 0)
+        child_id = os.read(read_fd, 64)
+        os.close(read_fd)
+        self.assertEquals(len(child_id), 16)
+        self.assertNotEquals(child_id, parent_id)
+
+    def test_nested_spans(self):
+        """
+        Verify spans nest under the active span and export on finish.
+        """
+        spans = []
+        tracer = tracing.Tracer(spans.append, 'test')
+        root = tracer.start_span(
+            'process', {'trace_id': TRACE_ID}, {'correlation_id': 1})
+        tracing.activate(root)
+        with tracing.span('StopContainer'):
+            tracing.record('docker.stop', 0.5, server_name='localhost')
+        try:
+            with tracing.span('failing'):
+                raise ValueError('boom')
+        except ValueError:
+            pass
+        root.finish()
+        root.finish()
+
+        names = [span['name'] for span in spans]
+        self.assertEquals(
+            names, ['docker.stop', 'StopContainer', 'failing', 'process'])
+        by_name = dict((span['name'], span) for span in spans)
+        self.assertTrue(all(s['traceId'] == TRACE_ID for s in spans))
+        self.assertEquals(
+            by_name['docker.stop']['parentId'], by_name['StopContainer']['id'])
+        self.assertEquals(
+            by_name['StopContainer']['parentId'], by_name['process']['id'])
+        self.assertFalse('parentId' in by_name['process'])
+        self.assertEquals(by_name['docker.stop']['duration'], 500000)
+        self.assertEquals(by_name['failing']['tags']['error'], 'boom')
+        self.assertEquals(by_name['process']['tags']['correlation_id'], '1')
+        self.assertEquals(
+            by_name['process']['localEndpoint'], {'serviceName': 'test'})
+
+    def test_no_active_span(self):
+        """
+        Verify span and record do nothing without an active span.
+        """
+        with tracing.span('nothing') as span:
+            self.assertEquals(span, None)
+        tracing.record('docker.stop', 0.1)
+
+    def test_batch_exporter(self):
+        """
+        Verify spans are written in batches and dropped when full.
+        """
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        exporter = tracing.BatchExporter(
+            tracing.FileSink(path), batch_size=2, flush_interval=60,
+            max_queue=3)
+        for number in range(4):
+            exporter({'id': number})
+        exporter.stop()
+        with open(path) as span_file:
+            written = [json.loads(line)['id'] for line in span_file]
+        os.unlink(path)
+        self.assertEquals(sorted(written), [0, 1, 2])
+        self.assertEquals(exporter.dropped, 1)
+
+    def test_from_config(self):
+        """
+        Verify tracing is only enabled with a path or url.
+        """
+        self.assertEquals(tracing.from_config(None), None)
+        self.assertEquals(tracing.from_config({'service_name': 'x'}), None)
+        tracer = tracing.from_config(
+            {'url': 'http://zipkin:9411/api/v2/spans'})
+        self.assertTrue(isinstance(tracer.exporter.sink, tracing.HttpSink))
+        tracer.close()
@@ -0,0 +1,136 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+from . import TestCase
+
+from replugin.dockerworker.validation import (
+    ValidationError, check_requirements, compile_schemas)
+
+
+class TestValidation(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.validators = compile_schemas()
+
+    def test_defaults(self):
+        """
+        Verify optional parameters get their defaults.
+        """
+        params = self.validators['PullImage']({
+            'subcommand': 'PullImage',
+            'server_name': 'localhost',
+            'image_name': 'testing',
+        })
+        self.assertEquals(params['insecure_registry'], False)
+
+        params = self.validators['CreateContainer']({
+            'subcommand': 'CreateContainer',
+            'server_name': 'localhost',
+            'image_name': 'testing',
+            'container_name': 'testing',
+            'container_command': '/bin/bash',
+        })
+        self.assertEquals(params['container_hostname'], None)
+        self.assertEquals(params['container_ports'], None)
+
+    def test_missing_input(self):
+        """
+        Verify missing required parameters are rejected.
+        """
+        self.assertRaises(
+            ValidationError,
+            self.validators['StopContainer'],
+            {'subcommand': 'StopContainer', 'server_name': 'localhost'})
+
+    def test_wrong_type(self):
+        """
+        Verify parameters of the wrong type are rejected.
+        """
+        self.assertRaises(
+            ValidationError,
+            self.validators['StartContainer'],
+            {
+                'subcommand': 'StartContainer',
+                'server_name': 'localhost',
+                'container_name': 'testing',
+                'container_binds': ['/test'],
+            })
+
+    def test_bool_and_minimum(self):
+        """
+        Verify bools are not accepted as numbers and minimums apply.
+        """
+        params = {
+            'subcommand': 'ScaleContainers',
+            'server_name': 'localhost',
+            'image_name': 'testing',
+            'container_name_template': 'web-{index}',
+            'container_command': '/bin/bash',
+        }
+        validator = self.validators['ScaleContainers']
+        for replicas in (True, 0, -1):
+            self.assertRaises(
+                ValidationError, validator, dict(params, replicas=replicas))
+        self.assertEquals(validator(dict(params, replicas=2))['replicas'], 2)
+
+    def test_chunk_size(self):
+        """
+        Verify chunk sizes must be positive.
+        """
+        export = {
+            'subcommand': 'ExportImage',
+            'server_name': 'localhost',
+            'image_name': 'app',
+        }
+        run = {
+            'subcommand': 'ExecInContainer',
+            'server_name': 'localhost',
+            'container_name': 'app',
+            'exec_command': 'true',
+        }
+        for params in (export, run):
+            validator = self.validators[params['subcommand']]
+            for chunk_size in (0, -1, True):
+                self.assertRaises(
+                    ValidationError, validator,
+                    dict(params, chunk_size=chunk_size))
+            self.assertEquals(
+                validator(dict(params, chunk_size=1))['chunk_size'], 1)
+
+    def test_requirements(self):
+        """
+        Verify subcommands needing a newer client or API are refused.
+        """
+        class OldClient(object):
+            pass
+
+        class NewClient(object):
+            def put_archive(self):
+                pass
+
+        check_requirements('StopContainer', OldClient, '1.12')
+        check_requirements('CopyToContainer', NewClient, '1.20')
+        check_requirements('CopyToContainer', NewClient, 'auto')
+        self.assertRaises(
+            ValidationError, check_requirements,
+            'CopyToContainer', OldClient, '1.20')
+        self.assertRaises(
+            ValidationError, check_requirements,
+            'CopyToContainer', NewClient, '1.15')
+        check_requirements('ExecInContainer', NewClient, '1.15')
@@ -0,0 +1,110 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+from . import TestCase
+
+from replugin.dockerworker.watchdog import Watchdog
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestWatchdog(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.overrun = []
+        self.cancelled = []
+
+    def watchdog(self, **kwargs):
+        return Watchdog(
+            deadlines={'PullImage': 10}, clock=self.clock,
+            on_overrun=self.overrun.append,
+            on_cancel=self.cancelled.append, **kwargs)
+
+    def test_deadlines(self):
+        """
+        Verify deadlines come per subcommand with an optional default.
+        """
+        watchdog = self.watchdog()
+        self.assertEquals(watchdog.deadline_for('PullImage'), 10)
+        self.assertEquals(watchdog.deadline_for('StopContainer'), None)
+        # Unwatched subcommands are not tracked
+        watchdog.start('1', 'StopContainer')
+        self.assertEquals(len(watchdog), 0)
+        watchdog.default = 5
+        self.assertEquals(watchdog.deadline_for('StopContainer'), 5)
+
+    def test_overrun(self):
+        """
+        Verify overrunning operations are reported once.
+        """
+        watchdog = self.watchdog()
+        operation = watchdog.start('1', 'PullImage', 'context')
+        self.clock.now = 9
+        self.assertEquals(watchdog.check(), [])
+        self.clock.now = 10
+        self.assertEquals(watchdog.check(), [operation])
+        self.clock.now = 20
+        self.assertEquals(watchdog.check(), [])
+        self.assertEquals(self.overrun, [operation])
+        self.assertEquals(operation.context, 'context')
+        self.assertTrue(operation.overrun)
+        self.assertTrue(watchdog.finish(operation))
+        self.assertEquals(len(watchdog), 0)
+        self.assertEquals(self.cancelled, [])
+
+    def test_cancel(self):
+        """
+        Verify cancelled operations are reported to their caller.
+        """
+        watchdog = self.watchdog(cancel=True)
+        operation = watchdog.start('1', 'PullImage')
+        done = watchdog.start('2', 'PullImage')
+        aborted = []
+        operation.on_abort(lambda: aborted.append('1'))
+        done.on_abort(lambda: aborted.append('2'))
+        self.assertTrue(watchdog.finish(done))
+        self.clock.now = 11
+        watchdog.check()
+        self.assertEquals(self.cancelled, [operation])
+        # Only the cancelled operation is aborted
+        self.assertEquals(aborted, ['1'])
+        self.assertTrue(operation.cancelled)
+        self.assertFalse(done.cancelled)
+        self.assertFalse(watchdog.finish(operation))
+
+    def test_callback_errors(self):
+        """
+        Verify a failing callback does not stop the checks.
+        """
+        def fail(operation):
+            raise ValueError('boom')
+        watchdog = Watchdog(
+            default=1, clock=self.clock, on_overrun=fail, cancel=True,
+            on_cancel=self.cancelled.append)
+        operation = watchdog.start('1', 'StopContainer')
+        self.clock.now = 2
+        watchdog.check()
+        self.assertEquals(self.cancelled, [operation])